@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, os, json, time, argparse, platform, tempfile, subprocess, multiprocessing, traceback
+from deploy_coordinator.cli import Formatter, Output
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.hooks import PreReceive, PostReceive
+from benchmarks.synthetic_repo import SyntheticRepo
+
+# End to end deploys of a synthetic project (see SyntheticRepo), fully offline:
+#	python -m benchmarks.deploy_benchmark --shape medium --repeat 3
+#	python -m benchmarks.deploy_benchmark --shape large --setting incrementalRelease=true
+#	python -m benchmarks.deploy_benchmark --compare results/a.json results/b.json
+# Each run deploys the project's first commit with nothing cached (cold), then
+# a commit changing a few files on top of it (warm; buildfile, submodule
+# mirrors and composer build all cached). Both hooks run as their own process,
+# like git runs them, and report wall time, per-phase times (from the tracer),
+# and the I/O the process and everything it ran did (/proc/self/io: bytes
+# and read/write syscalls; Linux only). Results go to benchmarks/results/.
+
+SHAPES = {
+	'small': {
+		'files': 200, 'sizes': [[512, 60], [4096, 30], [32768, 10]],
+		'submodules': 1, 'submoduleFiles': 50,
+		'composer': True, 'composerPackages': 10, 'packageFiles': 20,
+		'changedFiles': 5, 'bumpedPackages': 0
+	},
+	'medium': {
+		'files': 2000, 'sizes': [[512, 50], [4096, 35], [32768, 13], [262144, 2]],
+		'submodules': 3, 'submoduleFiles': 200,
+		'composer': True, 'composerPackages': 40, 'packageFiles': 50,
+		'changedFiles': 20, 'bumpedPackages': 0
+	},
+	'large': {
+		'files': 20000, 'sizes': [[512, 50], [4096, 35], [32768, 13], [1048576, 2]],
+		'submodules': 5, 'submoduleFiles': 1000,
+		'composer': True, 'composerPackages': 120, 'packageFiles': 100,
+		'changedFiles': 50, 'bumpedPackages': 0
+	}
+}
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class DeployBenchmark(object):
+
+	def __init__(self, shape, settings={}, workDir=None, seed=0, keep=False):
+		self.shape 		= shape
+		self.settings 	= settings
+		self.workDir 	= workDir
+		self.seed 		= seed
+		self.keep 		= keep
+
+	# Runs cold + warm deploys repeat times, each on a fresh copy of the
+	# project (same files every time); returns the results
+	def run(self, repeat=1):
+		workDir = self.workDir
+		if workDir == None:
+			workDir = tempfile.mkdtemp(prefix='deploy_benchmark-')
+		runs = []
+		succeeded = False
+		try:
+			for index in range(repeat):
+				Output.line(Formatter('Run %s of %s' % (index + 1, repeat)).arrowed())
+				runs.append(self.runOnce(os.path.join(workDir, 'run-%s' % (index + 1))))
+			succeeded = True
+		finally:
+			# A given work dir is left alone
+			if succeeded and self.keep != True and self.workDir == None:
+				FileSystem.removeDir(workDir)
+			else:
+				Output.line(Formatter('Work dir kept: %s' % workDir).indent())
+		return {
+			'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'host': self.hostInfo(),
+			'revision': self.revision(),
+			'shape': self.shape,
+			'seed': self.seed,
+			'settings': self.settings,
+			'runs': runs,
+			'median': medianOf(runs)
+		}
+
+	def runOnce(self, runDir):
+		repo = SyntheticRepo(os.path.join(runDir, 'project'), self.shape, self.seed)
+		firstCommit = repo.create()
+		results = {'cold': self.deploy(runDir, repo, PreReceive.ZERO_SHA, firstCommit, 'cold')}
+		secondCommit = repo.change()
+		results['warm'] = self.deploy(runDir, repo, firstCommit, secondCommit, 'warm')
+		return results
+
+	# pre-receive, then post-receive, of one push to master
+	def deploy(self, runDir, repo, oldCommitID, newCommitID, label):
+		inputs 	 = '%s %s refs/heads/master\n' % (oldCommitID, newCommitID)
+		settings = self.hookSettings(runDir, repo)
+		results  = {'commit': newCommitID}
+		for hookName in ['pre', 'post']:
+			metrics = self.runHook(hookName, inputs, settings, runDir, repo, label)
+			if hookName == 'post':
+				metrics['diskUsage'] = {
+					'buildDir': diskUsage(settings['buildDir']),
+					'tmpDir': diskUsage(os.path.join(runDir, 'tmp'))
+				}
+			results[hookName] = metrics
+			Output.line(Formatter('%-5s %-13s %7.2fs' % (label, hookName + '-receive', metrics['seconds'])).indent())
+		return results
+
+	def hookSettings(self, runDir, repo):
+		settings = {
+			'buildDir': os.path.join(runDir, 'www', 'benchmark'),
+			'repoHooksPath': os.path.join(runDir, 'hooks'),
+			'bareRepoPath': repo.bareRepo,
+			'reload': ['none'],
+			'traceSummary': False
+		}
+		settings.update(self.settings)
+		return settings
+
+	# Runs the hook as its own process (in the bare repo, the stub composer
+	# first on the PATH, and everything that lands in the tmp dir kept in
+	# runDir); returns its metrics. Raises if the hook failed
+	def runHook(self, hookName, inputs, settings, runDir, repo, label):
+		logsDir 	= os.path.join(runDir, 'logs')
+		logPath 	= os.path.join(logsDir, '%s-%s-receive.log' % (label, hookName))
+		metricsPath = os.path.join(logsDir, '%s-%s-receive.json' % (label, hookName))
+		tmpDir 		= os.path.join(runDir, 'tmp')
+		for path in [logsDir, tmpDir]:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+		env = dict(os.environ)
+		env.pop('GIT_DIR', None)
+		env['PATH'] 	 = repo.binDir + os.pathsep + env.get('PATH', '')
+		env['TMPDIR'] 	 = tmpDir
+		env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH', '')])
+
+		logHandle = open(logPath, 'w')
+		try:
+			startedAt = time.time()
+			proc = subprocess.Popen(
+				[sys.executable, '-m', 'benchmarks.deploy_benchmark', '--hook', hookName, '--settings', json.dumps(settings), '--metrics', metricsPath],
+				stdin=subprocess.PIPE, stdout=logHandle, stderr=subprocess.STDOUT, cwd=repo.bareRepo, env=env)
+			proc.communicate(inputs)
+			processSeconds = time.time() - startedAt
+		finally:
+			logHandle.close()
+
+		metrics = None
+		if os.path.exists(metricsPath):
+			metrics = json.load(open(metricsPath))
+		if proc.returncode != 0 or metrics == None or metrics['returncode'] != 0:
+			raise Exception('%s-receive failed (%s run); see %s' % (hookName, label, logPath))
+		metrics['processSeconds'] = processSeconds
+		return metrics
+
+	def hostInfo(self):
+		gitVersion = None
+		try:
+			gitVersion = subprocess.check_output(['git', '--version']).strip()
+		except (OSError, subprocess.CalledProcessError):
+			pass
+		return {
+			'platform': platform.platform(),
+			'python': platform.python_version(),
+			'cpus': multiprocessing.cpu_count(),
+			'git': gitVersion
+		}
+
+	# Commit of the code being benchmarked (+ "-dirty" with local changes)
+	def revision(self):
+		packageDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		try:
+			revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=packageDir).strip()
+			if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=packageDir).strip() != '':
+				revision += '-dirty'
+			return revision
+		except (OSError, subprocess.CalledProcessError):
+			return None
+
+
+# Records the trace of the deploy, for the metrics (see runHook)
+class BenchmarkPostReceive(PostReceive):
+
+	tracer = None
+
+	def finishTrace(self, deploys, tracer, profiler):
+		BenchmarkPostReceive.tracer = tracer
+		super(BenchmarkPostReceive, self).finishTrace(deploys, tracer, profiler)
+
+
+# In the hook's process: runs it, then writes its metrics to metricsPath
+def runHook(hookName, settings, metricsPath):
+	inputs 		= sys.stdin.read()
+	ioBefore 	= readIOCounters()
+	startedAt 	= time.time()
+	returncode 	= 1
+	try:
+		{'pre': PreReceive, 'post': BenchmarkPostReceive}[hookName](inputs, settings)
+		returncode = 0
+	except SystemExit as e:
+		returncode = e.code
+		if returncode == None:
+			returncode = 0
+		elif not isinstance(returncode, int):
+			returncode = 1
+	except Exception:
+		traceback.print_exc()
+	finally:
+		sys.stdout.flush()
+		seconds = time.time() - startedAt
+		ioAfter = readIOCounters()
+		metrics = {'returncode': returncode, 'seconds': seconds, 'io': None}
+		if ioBefore != None and ioAfter != None:
+			metrics['io'] = dict([(key, ioAfter[key] - ioBefore[key]) for key in ioAfter.keys()])
+		if BenchmarkPostReceive.tracer != None:
+			metrics.update(traceMetrics(BenchmarkPostReceive.tracer))
+		fileHandle = open(metricsPath, 'w')
+		json.dump(metrics, fileHandle, indent=4)
+		fileHandle.close()
+	sys.exit(returncode)
+
+
+# I/O counters of this process, including the children it waited for
+# (rchar/wchar: bytes read/written, syscr/syscw: read/write syscalls,
+# read_bytes/write_bytes: what actually hit storage); None if unavailable
+def readIOCounters():
+	try:
+		fileHandle = open('/proc/self/io')
+		try:
+			return dict([(line.split(':')[0], int(line.split(':')[1])) for line in fileHandle if ':' in line])
+		finally:
+			fileHandle.close()
+	except (IOError, ValueError):
+		return None
+
+
+# Per-phase times (phases of the deploy, nested ones as "parent > child")
+# and subprocess / filesystem operation totals
+def traceMetrics(tracer):
+	phases = {}
+	def flatten(node, prefix):
+		name = prefix + node['name']
+		phases[name] = {
+			'seconds': node['seconds'],
+			'processes': node['exec'][0], 'processSeconds': node['exec'][1],
+			'fsOps': node['fs'][0], 'fsSeconds': node['fs'][1]
+		}
+		for child in node['children']:
+			flatten(child, name + ' > ')
+	for root in tracer.phaseTree():
+		for child in root['children']:
+			flatten(child, '')
+	spans = tracer.spans
+	return {
+		'phases': phases,
+		'processes': len([span for span in spans if span.category == 'exec']),
+		'fsOps': len([span for span in spans if span.category == 'fs'])
+	}
+
+
+# Bytes allocated under path (hardlinked files counted once)
+def diskUsage(path):
+	total, seen = 0, set()
+	for dirPath, dirNames, fileNames in os.walk(path):
+		for name in dirNames + fileNames:
+			stat = os.lstat(os.path.join(dirPath, name))
+			if (stat.st_dev, stat.st_ino) in seen:
+				continue
+			seen.add((stat.st_dev, stat.st_ino))
+			total += stat.st_blocks * 512
+	return total
+
+
+# Median of every number across the runs (same structure as one run)
+def medianOf(runs):
+	first = runs[0]
+	if isinstance(first, dict):
+		return dict([(key, medianOf([run[key] for run in runs if isinstance(run, dict) and key in run])) for key in first.keys()])
+	if isinstance(first, (int, long, float)) and not isinstance(first, bool):
+		values = sorted(runs)
+		middle = len(values) // 2
+		if len(values) % 2 == 1:
+			return values[middle]
+		return (values[middle - 1] + values[middle]) / 2.0
+	return first
+
+
+# Lines summarizing (the median of) results
+def report(results):
+	median = results['median']
+	lines  = ['%-44s %12s %12s' % ('', 'cold', 'warm')]
+	def row(label, getValue, formatValue):
+		values = []
+		for scenario in ['cold', 'warm']:
+			try:
+				values.append(formatValue(getValue(median[scenario])))
+			except (KeyError, TypeError):
+				values.append('-')
+		lines.append('%-44s %12s %12s' % tuple([label] + values))
+	seconds = lambda value: '%.2fs' % value
+	count 	= lambda value: '%.0f' % value
+	for hookName in ['pre', 'post']:
+		row('%s-receive' % hookName, lambda scenario: scenario[hookName]['seconds'], seconds)
+		for phase in sorted(median['cold'][hookName].get('phases', {}).keys(), key=lambda name: phaseOrder(median['cold'][hookName]['phases'], name)):
+			row('  ' * (phase.count(' > ') + 1) + phase.split(' > ')[-1], lambda scenario: scenario[hookName]['phases'][phase]['seconds'], seconds)
+		row('  bytes written', lambda scenario: scenario[hookName]['io']['wchar'], FileSystem.formatBytes)
+		row('  read / write syscalls', lambda scenario: '%.0f/%.0f' % (scenario[hookName]['io']['syscr'], scenario[hookName]['io']['syscw']), str)
+	row('post-receive processes', lambda scenario: scenario['post']['processes'], count)
+	row('post-receive filesystem operations', lambda scenario: scenario['post']['fsOps'], count)
+	row('build dir on disk', lambda scenario: scenario['post']['diskUsage']['buildDir'], FileSystem.formatBytes)
+	return lines
+
+
+# Phases sorted as they ran: by the order of their top level phase, then name
+def phaseOrder(phases, name):
+	topLevel = ['directories', 'clone', 'submodules', 'storage', 'build', 'move', 'activate', 'cleanup']
+	parts 	 = name.split(' > ')
+	position = len(topLevel)
+	if parts[0] in topLevel:
+		position = topLevel.index(parts[0])
+	return (position, name)
+
+
+# Lines comparing two results files, number by number (other against base)
+def compare(basePath, otherPath):
+	base, other = json.load(open(basePath)), json.load(open(otherPath))
+	baseValues, otherValues = {}, {}
+	flattenNumbers(base['median'], '', baseValues)
+	flattenNumbers(other['median'], '', otherValues)
+	lines = ['%-64s %14s %14s %9s' % ('', os.path.basename(basePath)[0:14], os.path.basename(otherPath)[0:14], 'change')]
+	for key in sorted(set(baseValues.keys()) & set(otherValues.keys())):
+		change = ''
+		if baseValues[key] != 0:
+			change = '%+.1f%%' % ((otherValues[key] - baseValues[key]) * 100.0 / baseValues[key])
+		lines.append('%-64s %14s %14s %9s' % (key, formatNumber(baseValues[key]), formatNumber(otherValues[key]), change))
+	return lines
+
+
+def flattenNumbers(value, prefix, into):
+	if isinstance(value, dict):
+		for key, child in value.items():
+			flattenNumbers(child, prefix + key + '.', into)
+	elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+		into[prefix[:-1]] = value
+
+
+def formatNumber(value):
+	if isinstance(value, float) and not value.is_integer():
+		return '%.3f' % value
+	return '%.0f' % value
+
+
+def parseSetting(setting):
+	if '=' not in setting:
+		raise argparse.ArgumentTypeError('settings are given as key=value')
+	key, value = setting.split('=', 1)
+	try:
+		value = json.loads(value)
+	except ValueError:
+		pass
+	return (key, value)
+
+
+def parseSizes(sizes):
+	try:
+		return [[int(size), float(weight)] for size, weight in [pair.split(':') for pair in sizes.split(',')]]
+	except ValueError:
+		raise argparse.ArgumentTypeError('sizes are given as bytes:weight,bytes:weight,...')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks deploys of a synthetic project, end to end')
+	parser.add_argument('--shape', choices=sorted(SHAPES.keys()), default='small', help='preset project shape (default small)')
+	parser.add_argument('--files', type=int, help='files in the project')
+	parser.add_argument('--sizes', type=parseSizes, help='file size distribution, eg. 512:60,4096:30,32768:10 (bytes:weight)')
+	parser.add_argument('--submodules', type=int, help='number of submodules')
+	parser.add_argument('--submodule-files', type=int, dest='submoduleFiles', help='files per submodule')
+	parser.add_argument('--no-composer', action='store_false', dest='composer', default=None, help='no composer.json/composer.lock')
+	parser.add_argument('--composer-packages', type=int, dest='composerPackages', help='packages the stub composer installs')
+	parser.add_argument('--changed-files', type=int, dest='changedFiles', help='files changed for the warm deploy')
+	parser.add_argument('--bumped-packages', type=int, dest='bumpedPackages', help='composer packages updated for the warm deploy')
+	parser.add_argument('--setting', type=parseSetting, action='append', default=[], metavar='KEY=VALUE', help='post-receive setting (value parsed as JSON if it is), repeatable')
+	parser.add_argument('--repeat', type=int, default=1, help='cold + warm runs to take the median of')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--work-dir', dest='workDir', help='where to build (default: a new tmp dir)')
+	parser.add_argument('--keep', action='store_true', help='keep the work dir')
+	parser.add_argument('--output', help='results file (default: benchmarks/results/<time>-<shape>.json)')
+	parser.add_argument('--compare', nargs=2, metavar=('BASE', 'OTHER'), help='compare two results files')
+	parser.add_argument('--hook', choices=['pre', 'post'], help=argparse.SUPPRESS)
+	parser.add_argument('--settings', help=argparse.SUPPRESS)
+	parser.add_argument('--metrics', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.hook != None:
+		runHook(args.hook, json.loads(args.settings), args.metrics)
+
+	if args.compare != None:
+		for line in compare(args.compare[0], args.compare[1]):
+			Output.line(line)
+		sys.exit(0)
+
+	shape = dict(SHAPES[args.shape])
+	for key in ['files', 'sizes', 'submodules', 'submoduleFiles', 'composer', 'composerPackages', 'changedFiles', 'bumpedPackages']:
+		if getattr(args, key) != None:
+			shape[key] = getattr(args, key)
+
+	benchmark = DeployBenchmark(shape, dict(args.setting), args.workDir, args.seed, args.keep)
+	try:
+		results = benchmark.run(args.repeat)
+	except Exception as e:
+		Output.line(Formatter(e).color('red').indent())
+		sys.exit(1)
+	results['label'] = args.shape
+
+	outputPath = args.output
+	if outputPath == None:
+		outputPath = os.path.join(RESULTS_DIR, '%s-%s.json' % (time.strftime('%Y%m%d-%H%M%S'), args.shape))
+	if not os.path.isdir(os.path.dirname(os.path.abspath(outputPath))):
+		os.makedirs(os.path.dirname(os.path.abspath(outputPath)))
+	fileHandle = open(outputPath, 'w')
+	json.dump(results, fileHandle, indent=4, sort_keys=True)
+	fileHandle.close()
+
+	Output.line('')
+	for line in report(results):
+		Output.line(Formatter(line).indent())
+	Output.line('')
+	Output.line(Formatter('Results written to %s' % outputPath).indent())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, os, json, random, hashlib, subprocess
+
+# Stand-in for composer: `composer --working-dir=X install` writes a vendor
+# dir for the packages in X/composer.lock (each with the number of files and
+# size given by its "dist" entry), without touching the network. Like
+# composer, it leaves alone packages vendor/composer/installed.json lists at
+# the locked version and reference, and writes installed.json (format 2)
+STUB_COMPOSER = '''#!%(python)s
+import sys, os, json, shutil
+workingDir = os.getcwd()
+for arg in sys.argv[1:]:
+	if arg.startswith('--working-dir='):
+		workingDir = arg[len('--working-dir='):]
+lock = json.load(open(os.path.join(workingDir, 'composer.lock')))
+vendorDir = os.path.join(workingDir, 'vendor')
+installedPath = os.path.join(vendorDir, 'composer', 'installed.json')
+installed = {}
+if os.path.isfile(installedPath):
+	listed = json.load(open(installedPath))
+	if isinstance(listed, dict):
+		listed = listed['packages']
+	installed = dict([(package['name'], package) for package in listed])
+locked = dict([(package['name'], package) for package in lock.get('packages', [])])
+for name in installed:
+	if name not in locked and os.path.isdir(os.path.join(vendorDir, name)):
+		shutil.rmtree(os.path.join(vendorDir, name))
+		print('  - Removing %%s' %% name)
+for package in lock.get('packages', []):
+	current = installed.get(package['name'])
+	if current != None and (current['version'], current['dist'].get('reference')) == (package['version'], package['dist'].get('reference')):
+		continue
+	if os.path.isdir(os.path.join(vendorDir, package['name'])):
+		shutil.rmtree(os.path.join(vendorDir, package['name']))
+	packageDir = os.path.join(vendorDir, package['name'], 'src')
+	os.makedirs(packageDir)
+	for index in range(package['dist']['files']):
+		fileHandle = open(os.path.join(packageDir, 'File%%s.php' %% index), 'w')
+		fileHandle.write(('<?php // %%s %%s %%s\\n' %% (package['name'], package['version'], index)).ljust(package['dist']['size'], '#'))
+		fileHandle.close()
+	print('  - Installing %%s (%%s)' %% (package['name'], package['version']))
+if not os.path.isdir(os.path.dirname(installedPath)):
+	os.makedirs(os.path.dirname(installedPath))
+packages = []
+for package in lock.get('packages', []):
+	package = dict(package)
+	package['install-path'] = '../%%s' %% package['name']
+	packages.append(package)
+fileHandle = open(installedPath, 'w')
+json.dump({'packages': packages, 'dev': True, 'dev-package-names': []}, fileHandle, indent=4)
+fileHandle.close()
+fileHandle = open(os.path.join(vendorDir, 'autoload.php'), 'w')
+fileHandle.write('<?php // autoload\\n')
+fileHandle.close()
+print('Generating autoload files')
+'''
+
+# Builds a project to deploy, from a shape (see deploy_benchmark.SHAPES):
+#	files			how many files in the project
+#	sizes			[[bytes, weight], ...] file size distribution
+#	submodules		how many submodules (each its own bare repo, added by file:// url)
+#	submoduleFiles	files per submodule
+#	composer		whether there's a composer.json/composer.lock (in app/)
+#	composerPackages, packageFiles	what the stub composer installs
+#	changedFiles	files touched by each commit after the first
+#	bumpedPackages	composer packages updated by each commit after the first
+# Everything lives under workDir: src/ (work tree), remotes/ (submodules),
+# bare.git (what gets deployed) and bin/ (the stub composer). The same
+# shape and seed always give the same files.
+class SyntheticRepo(object):
+
+	GIT_IDENTITY = {
+		'GIT_AUTHOR_NAME': 'Benchmark', 'GIT_AUTHOR_EMAIL': 'benchmark@localhost',
+		'GIT_COMMITTER_NAME': 'Benchmark', 'GIT_COMMITTER_EMAIL': 'benchmark@localhost'
+	}
+	# Files per directory of the project
+	DIR_SIZE = 50
+
+	def __init__(self, workDir, shape, seed=0):
+		self.workDir 	= os.path.abspath(workDir)
+		self.shape 		= shape
+		self.random 	= random.Random(seed)
+		self.srcDir 	= os.path.join(self.workDir, 'src')
+		self.bareRepo 	= os.path.join(self.workDir, 'bare.git')
+		self.binDir 	= os.path.join(self.workDir, 'bin')
+		self.paths 		= []
+		self.packages 	= []
+		self.commits 	= []
+		self._content 	= None
+
+	# Creates the submodules, the project (first commit) and the bare repo;
+	# returns the commit's SHA
+	def create(self):
+		os.makedirs(self.workDir)
+		self.writeStubComposer()
+
+		submodules = []
+		for index in range(self.shape['submodules']):
+			submodules.append(self.createSubmodule('lib%s' % (index + 1)))
+
+		os.makedirs(self.srcDir)
+		self.git(['init', '-q'], self.srcDir)
+		for index in range(self.shape['files']):
+			path = os.path.join('web', 'app', 'd%s' % (index // self.DIR_SIZE), 'f%s.php' % index)
+			self.writeFile(os.path.join(self.srcDir, path), self.randomSize(), path)
+			self.paths.append(path)
+		self.writeFile(os.path.join(self.srcDir, 'storage', 'cache', '.gitkeep'), 0, '')
+
+		buildFile = {'project': {'name': 'Benchmark'}, 'storage': {'dirs': ['storage/cache']}}
+		if self.shape['composer'] == True:
+			buildFile['composer'] = {'workingDir': 'app'}
+			self.writeComposerFiles(os.path.join(self.srcDir, 'app'))
+		self.writeFile(os.path.join(self.srcDir, 'buildfile.json'), 0, json.dumps(buildFile, indent=4))
+
+		for name, url in submodules:
+			self.git(['-c', 'protocol.file.allow=always', 'submodule', '-q', 'add', url, os.path.join('modules', name)], self.srcDir)
+
+		self.git(['init', '-q', '--bare', self.bareRepo], self.workDir)
+		return self.commit('Initial commit')
+
+	# Touches shape['changedFiles'] files of the project, commits and pushes;
+	# returns the commit's SHA
+	def change(self):
+		for path in self.random.sample(self.paths, min(self.shape['changedFiles'], len(self.paths))):
+			fileHandle = open(os.path.join(self.srcDir, path), 'a')
+			fileHandle.write('// change %s\n' % len(self.commits))
+			fileHandle.close()
+		if self.shape['composer'] == True and self.shape.get('bumpedPackages', 0) > 0:
+			for package in self.random.sample(self.packages, min(self.shape['bumpedPackages'], len(self.packages))):
+				package['version'] 			 = '%s.%s' % (package['version'], len(self.commits))
+				package['dist']['reference'] = hashlib.sha1(package['version']).hexdigest()
+			self.writeLockFiles(os.path.join(self.srcDir, 'app'))
+		return self.commit('Change %s' % len(self.commits))
+
+	def commit(self, message):
+		self.git(['add', '-A'], self.srcDir)
+		self.git(['commit', '-q', '-m', message], self.srcDir)
+		self.git(['push', '-q', self.bareRepo, 'HEAD:refs/heads/master'], self.srcDir)
+		sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.srcDir).strip()
+		self.commits.append(sha)
+		return sha
+
+	# A bare repo of shape['submoduleFiles'] files; returns (name, url)
+	def createSubmodule(self, name):
+		srcDir 	 = os.path.join(self.workDir, 'remotes', name + '-src')
+		bareRepo = os.path.join(self.workDir, 'remotes', name + '.git')
+		os.makedirs(srcDir)
+		self.git(['init', '-q'], srcDir)
+		for index in range(self.shape['submoduleFiles']):
+			path = os.path.join('src', 'd%s' % (index // self.DIR_SIZE), 'C%s.php' % index)
+			self.writeFile(os.path.join(srcDir, path), self.randomSize(), '%s/%s' % (name, path))
+		self.git(['add', '-A'], srcDir)
+		self.git(['commit', '-q', '-m', 'Initial commit'], srcDir)
+		self.git(['clone', '-q', '--bare', srcDir, bareRepo], self.workDir)
+		return (name, 'file://' + bareRepo)
+
+	def writeComposerFiles(self, appDir):
+		self.packages = []
+		for index in range(self.shape['composerPackages']):
+			name, version = 'vendor%s/package%s' % (index % 7, index), '1.%s.0' % index
+			self.packages.append({
+				'name': name,
+				'version': version,
+				'dist': {'files': self.shape['packageFiles'], 'size': self.randomSize(), 'reference': hashlib.sha1(name + version).hexdigest()}
+			})
+		self.writeLockFiles(appDir)
+
+	# composer.json and composer.lock of self.packages
+	def writeLockFiles(self, appDir):
+		composerJson = {'require': dict([(package['name'], package['version']) for package in self.packages])}
+		self.writeFile(os.path.join(appDir, 'composer.json'), 0, json.dumps(composerJson, indent=4))
+		lock = {'hash': hashlib.md5(json.dumps(composerJson, sort_keys=True)).hexdigest(), 'packages': self.packages}
+		self.writeFile(os.path.join(appDir, 'composer.lock'), 0, json.dumps(lock, indent=4))
+
+	def writeStubComposer(self):
+		os.makedirs(self.binDir)
+		path = os.path.join(self.binDir, 'composer')
+		fileHandle = open(path, 'w')
+		fileHandle.write(STUB_COMPOSER % {'python': sys.executable})
+		fileHandle.close()
+		os.chmod(path, 0755)
+
+	# Picks a size from shape['sizes'] (by weight)
+	def randomSize(self):
+		total 	= sum([weight for size, weight in self.shape['sizes']])
+		point 	= self.random.uniform(0, total)
+		for size, weight in self.shape['sizes']:
+			point -= weight
+			if point <= 0:
+				return size
+		return self.shape['sizes'][-1][0]
+
+	# header, padded to size with text from a fixed pool (so files compress
+	# about like source code, and no two files are the same)
+	def writeFile(self, path, size, header):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		header = '<?php // %s\n' % header if path.endswith('.php') else header
+		body = ''
+		if size > len(header):
+			content = self.content()
+			length 	= min(size - len(header), len(content))
+			offset 	= self.random.randint(0, len(content) - length)
+			body 	= content[offset:offset + length]
+		fileHandle = open(path, 'w')
+		fileHandle.write(header + body)
+		fileHandle.close()
+
+	def content(self):
+		if self._content is None:
+			words = ['$value', 'return', 'function', 'array()', 'public', 'static', '$this->', 'if', 'foreach', 'null', '=>', ';', '{', '}']
+			self._content = ' '.join([self.random.choice(words) for index in range(256 * 1024)])
+		return self._content
+
+	def git(self, args, cwd):
+		env = dict(os.environ)
+		env.update(self.GIT_IDENTITY)
+		subprocess.check_call(['git'] + args, cwd=cwd, env=env)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, json, time, argparse, threading
+from formatter import Formatter
+
+# Where Output's events end up. An event is a dict:
+#	type		'line', 'progress' (a line meant to be rewritten in place), 'raw'
+#				(already rendered output, eg. another process' log), 'command'
+#				(a subprocess started: args) or 'commandEnd' (returncode)
+#	message		Formatter or string
+#	level		'info', 'warning' or 'error'
+#	indented	for lines written with Output.line(..., True)
+#	time, phase	(the tracer's current phase, if tracing), command (the ID of
+#				the subprocess the line came from, if any)
+# Every backend has an emit(events), which gets the events of a flush (a
+# single line, or a whole group) under Output's write lock.
+class OutputBackend(object):
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.flush()
+
+
+# The original renderer: ANSI escapes, written and flushed as it comes in
+# (git relays hook output to the pushing terminal)
+class TTYBackend(OutputBackend):
+
+	def __init__(self, stream=None):
+		self.stream = stream
+
+	def emit(self, events):
+		chunks = []
+		for event in events:
+			if event['type'] == 'line':
+				space = ''
+				if event['indented'] == True:
+					space = '        '
+				chunks.append('\033[0G' + space + str(event['message']) + '\n\033[0G\r')
+			elif event['type'] == 'progress':
+				chunks.append('\033[0G%s\r' % event['message'])
+			elif event['type'] == 'raw':
+				chunks.append(event['message'])
+		if chunks:
+			stream = self.stream or sys.stdout
+			stream.write(''.join(chunks))
+			stream.flush()
+
+
+# Base of backends writing in batches: what's written is buffered until
+# batchSize entries are waiting, flushInterval seconds passed since the last
+# flush (checked by a background thread, so output doesn't sit in the buffer
+# while nothing is being written), or a warning/error comes along
+class BufferedBackend(OutputBackend):
+
+	def __init__(self, stream=None, batchSize=200, flushInterval=1.0):
+		self.stream 		= stream
+		self.batchSize 		= batchSize
+		self.flushInterval 	= flushInterval
+		self._buffer 		= []
+		self._flushedAt 	= time.time()
+		self._lock 			= threading.Lock()
+		self._closed 		= threading.Event()
+		self._flusher 		= None
+
+	def write(self, entries, urgent=False):
+		with self._lock:
+			self._buffer.extend(entries)
+			if urgent or len(self._buffer) >= self.batchSize or time.time() - self._flushedAt >= self.flushInterval:
+				self._flushLocked()
+			elif self._flusher is None and len(self._buffer) > 0:
+				self._flusher = threading.Thread(target=self._flushPeriodically, name='OutputFlusher')
+				self._flusher.daemon = True
+				self._flusher.start()
+
+	def flush(self):
+		with self._lock:
+			self._flushLocked()
+
+	# Waits for the flusher thread to stop; left running into interpreter
+	# shutdown (close() runs at exit), it dies with a traceback
+	def close(self):
+		self._closed.set()
+		flusher = self._flusher
+		if flusher is not None and flusher is not threading.current_thread():
+			flusher.join(self.flushInterval + 1)
+		self.flush()
+
+	def _flushLocked(self):
+		self._flushedAt = time.time()
+		if len(self._buffer) == 0:
+			return
+		stream = self.stream or sys.stdout
+		stream.write(''.join(self._buffer))
+		stream.flush()
+		self._buffer = []
+
+	def _flushPeriodically(self):
+		while not self._closed.wait(self.flushInterval):
+			self.flush()
+
+
+# Plain text (no escapes), in batches; for remotes that aren't terminals
+# (CI runners, log files)
+class PlainBackend(BufferedBackend):
+
+	def emit(self, events):
+		entries, urgent = [], False
+		for event in events:
+			if event['type'] == 'line':
+				space = ''
+				if event['indented'] == True:
+					space = '        '
+				entries.append(space + plainText(event['message']) + '\n')
+				urgent = urgent or event['level'] != 'info'
+			elif event['type'] == 'raw':
+				entries.append(plainText(event['message']))
+		if entries:
+			self.write(entries, urgent)
+
+
+# Newline delimited JSON, one object per event:
+#	{"time": ..., "type": "line", "level": "info", "phase": "clone",
+#	 "command": 12, "message": "..."}
+# in batches. With rateLimit, informational lines from a subprocess are held
+# to that many per second (per subprocess); what's left out is counted and
+# reported as a "suppressed" event when the subprocess ends. Without it
+# (eg. for a spool file, see Output.configure) everything is written.
+class EventStreamBackend(BufferedBackend):
+
+	def __init__(self, stream=None, batchSize=200, flushInterval=0.5, rateLimit=None):
+		super(EventStreamBackend, self).__init__(stream, batchSize, flushInterval)
+		self.rateLimit 	 = rateLimit
+		# command: [tokens, refilledAt, suppressed]
+		self._buckets 	 = {}
+
+	def emit(self, events):
+		entries, urgent = [], False
+		for event in events:
+			if event['type'] == 'line' and event['command'] is not None and event['level'] == 'info' and not self._allowed(event):
+				continue
+			if event['type'] == 'commandEnd':
+				entries.extend(self._suppressedEntries(event['command'], event['time'], event['phase']))
+			entries.append(self.encode(event))
+			urgent = urgent or event['level'] != 'info'
+		if entries:
+			self.write(entries, urgent)
+
+	def close(self):
+		with self._lock:
+			for command in self._buckets.keys():
+				self._buffer.extend(self._suppressedEntries(command, time.time(), None))
+		super(EventStreamBackend, self).close()
+
+	@staticmethod
+	def encode(event):
+		record = {
+			'time': round(event['time'], 6),
+			'type': event['type'],
+			'level': event['level'],
+			'phase': event.get('phase'),
+			'command': event.get('command')
+		}
+		if event['type'] == 'line':
+			message = plainText(event['message'])
+			if event['indented'] == True:
+				message = '        ' + message
+			record['message'] = message
+		elif event['type'] in ['progress', 'raw', 'suppressed']:
+			record['message'] = plainText(event['message'])
+		for key in ['args', 'returncode', 'count']:
+			if key in event:
+				record[key] = event[key]
+		if isinstance(record.get('message'), str):
+			record['message'] = record['message'].decode('utf-8', 'replace')
+		return json.dumps(record) + '\n'
+
+	# Token bucket per command, holding one second's worth of lines
+	def _allowed(self, event):
+		if self.rateLimit is None:
+			return True
+		bucket = self._buckets.get(event['command'])
+		if bucket is None:
+			bucket = self._buckets[event['command']] = [float(self.rateLimit), event['time'], 0]
+		bucket[0] = min(float(self.rateLimit), bucket[0] + (event['time'] - bucket[1]) * self.rateLimit)
+		bucket[1] = event['time']
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			return True
+		bucket[2] += 1
+		return False
+
+	def _suppressedEntries(self, command, at, phase):
+		bucket = self._buckets.pop(command, None)
+		if bucket is None or bucket[2] == 0:
+			return []
+		return [self.encode({
+			'time': at, 'type': 'suppressed', 'level': 'info', 'phase': phase, 'command': command, 'count': bucket[2],
+			'message': '%s lines of output left out (rate limited); see the full log' % bucket[2]
+		})]
+
+
+def plainText(message):
+	if isinstance(message, Formatter):
+		return message.plain()
+	if not isinstance(message, basestring):
+		message = str(message)
+	return Formatter.stripped(message)
+
+
+# Writes an event stream file (eg. a spool file) back out through backend
+def replay(path, backend):
+	fileHandle = open(path)
+	try:
+		for line in fileHandle:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			message = record.get('message', '')
+			if isinstance(message, unicode):
+				message = message.encode('utf-8')
+			if record['type'] in ['line', 'suppressed']:
+				if record['level'] == 'error':
+					message = Formatter(message).color('red')
+				elif record['level'] == 'warning':
+					message = Formatter(message).color('yellow')
+				backend.emit([{
+					'type': 'line', 'message': message, 'level': record['level'], 'indented': False,
+					'time': record['time'], 'phase': record.get('phase'), 'command': record.get('command')
+				}])
+			elif record['type'] == 'raw':
+				backend.emit([{
+					'type': 'raw', 'message': message, 'level': record['level'], 'indented': False,
+					'time': record['time'], 'phase': record.get('phase'), 'command': record.get('command')
+				}])
+	finally:
+		fileHandle.close()
+		backend.close()
+
+
+BACKENDS = {
+	'tty': TTYBackend,
+	'plain': PlainBackend,
+	'json': EventStreamBackend
+}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Replays the output of a hook run from its spool file')
+	parser.add_argument('spoolFile')
+	parser.add_argument('--format', choices=sorted(BACKENDS.keys()), default='tty')
+	args = parser.parse_args()
+	replay(args.spoolFile, BACKENDS[args.format]())
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import re
 
+# Styles text for the terminal. Styling is recorded, not applied: the
+# escapes are put around the text once, when it's rendered (str()), and
+# backends that don't want them render it plain (see plain()). Formatters
+# concatenate into Formatters, so that holds for the whole line.
 class Formatter:
 
 	STYLES = {
@@ -12,41 +17,105 @@ class Formatter:
 		'green':'92m',
 		'red':'91m',
 		'yellow':'33m',
-		'cyan':'36m'		
+		'cyan':'36m'
 	}
 
+	# Level of a line, by its color (anything else is 'info')
+	LEVELS = {
+		'red': 'error',
+		'yellow': 'warning'
+	}
+
+	SEVERITY = ['info', 'warning', 'error']
+
+	ANSI_ESCAPE = re.compile(r'\033\[[^a-zA-Z]*[a-zA-Z]')
+
 	def __init__(self, _str):
-		self.string = _str
+		self.parts 	  = [_str]
+		# (escape, plain prefix) pairs, innermost first; each is closed with \033[0m
+		self.wrappers = []
+		self._level   = None
 
 	def __str__(self):
-		return self.string
+		return self.render(True)
 
 	def __add__(self, other):
-		return str(self) + str(other)
+		return Formatter(self)._append(other)
 
 	def __radd__(self, other):
-		return str(other) + str(self)
+		return Formatter(other)._append(self)
+
+	def _append(self, other):
+		self.parts.append(other)
+		return self
 
 	def style(self, style):
 		if isinstance(style, list):
 			for _style in style:
-				self.string = '\033[%s%s\033[0m' % (self.STYLES[_style], self.string)
+				self.wrappers.append(('\033[%s' % self.STYLES[_style], ''))
 		else:
-			self.string = '\033[%s%s\033[0m' % (self.STYLES[style], self.string)
+			self.wrappers.append(('\033[%s' % self.STYLES[style], ''))
 		return self
 
 	def color(self, color):
-		self.string = '\033[%s%s\033[0m' % (self.COLORS[color], self.string)
+		self.wrappers.append(('\033[%s' % self.COLORS[color], ''))
+		self._level = self.LEVELS.get(color, 'info')
 		return self
 
 	def indent(self):
-		self.string = '\033[\010m        %s\033[0m' % self.string
+		self.wrappers.append(('\033[\010m        ', '        '))
 		return self
 
 	def arrowed(self):
-		self.string = '\033[\010m------> %s\033[0m' % self.string
+		self.wrappers.append(('\033[\010m------> ', '------> '))
 		return self
 
+	# Without any escapes (text that came in with escapes is stripped too)
+	def plain(self):
+		return self.render(False)
+
+	# Always a (utf-8) str: parts can be unicode (eg. anything out of JSON)
+	# as well as utf-8 bytes (eg. Output.CHECKMARK)
+	def render(self, ansi):
+		rendered = []
+		for part in self.parts:
+			if isinstance(part, Formatter):
+				rendered.append(part.render(ansi))
+			else:
+				rendered.append(self.encoded(part))
+		text = ''.join(rendered)
+		if ansi:
+			return ''.join([wrapper[0] for wrapper in reversed(self.wrappers)]) + text + '\033[0m' * len(self.wrappers)
+		return ''.join([wrapper[1] for wrapper in reversed(self.wrappers)]) + self.stripped(text)
+
+	# The color's level, or the most severe one of the parts
+	def level(self):
+		if self._level is not None:
+			return self._level
+		level = 'info'
+		for part in self.parts:
+			if isinstance(part, Formatter) and self.SEVERITY.index(part.level()) > self.SEVERITY.index(level):
+				level = part.level()
+		return level
+
+	@staticmethod
+	def encoded(part):
+		if isinstance(part, unicode):
+			return part.encode('utf-8')
+		if isinstance(part, str):
+			return part
+		try:
+			return str(part)
+		except UnicodeError:
+			return unicode(part).encode('utf-8')
+
+	# text without escapes
+	@classmethod
+	def stripped(cls, text):
+		if '\033' in text:
+			return cls.ANSI_ESCAPE.sub('', text)
+		return text
+
 	# @classmethod
 	# def _bold(cls, _str):
 	# 	return '\033[%s%s\033[0m' % (cls.FORMAT_BOLD, _str)
@@ -69,4 +138,4 @@ class Formatter:
 
 	# @classmethod
 	# def _green(cls, _str):
-	# 	return '\033[%s%s\033[0m' % (cls.COLOR_GREEN, _str)
\ No newline at end of file
+	# 	return '\033[%s%s\033[0m' % (cls.COLOR_GREEN, _str)
@@ -1,25 +1,166 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys
+import time, atexit, threading, itertools
+from formatter import Formatter
+from backends import TTYBackend, BACKENDS, EventStreamBackend
+from deploy_coordinator.system.tracer import Tracer
 
+# Everything written goes out as events (see backends.OutputBackend) to the
+# backends in use: the TTY renderer by default, see useBackends()
 class Output:
 
 	CHECKMARK = u'\u2713'.encode('utf-8')
 
-	@staticmethod
-	def line(_str, _indented=False):
-		space = ''
-		if _indented == True:
-			space = '        '
-		sys.stdout.write('\033[0G' + space + str(_str) + '\n\033[0G\r')
-		sys.stdout.flush()
+	# Lines written from a thread that has opened a group are held back and
+	# written out in one go when the group ends, so work running concurrently
+	# in other threads doesn't interleave with it
+	_local 	   = threading.local()
+	_writeLock = threading.Lock()
+	_backends  = [TTYBackend()]
+	_commandIDs = itertools.count(1)
+	_closeAtExit = False
+
+	@classmethod
+	def line(cls, _str, _indented=False, level=None):
+		cls._write(cls._event('line', _str, level, _indented))
 
 	@classmethod
 	def multiLine(cls, _strings, _indented=False):
 		for line in _strings:
 			cls.line(line, _indented)
 
-	@staticmethod
-	def rewrite(_str):
-		sys.stdout.write('\033[0G%s\r' % str(_str))
-		sys.stdout.flush()
\ No newline at end of file
+	@classmethod
+	def rewrite(cls, _str):
+		cls._write(cls._event('progress', _str))
+
+	# Already rendered output (eg. another process' log), written as-is
+	@classmethod
+	def write(cls, rendered):
+		cls._write(cls._event('raw', rendered))
+
+	# A subprocess starting (see Execute); lines written from this thread
+	# until endCommand carry its ID. Returns the ID
+	@classmethod
+	def beginCommand(cls, args):
+		commandID = next(cls._commandIDs)
+		cls._commands().append(commandID)
+		event = cls._event('command', ' '.join(args))
+		event['args'] = args
+		cls._write(event)
+		return commandID
+
+	@classmethod
+	def endCommand(cls, commandID, returncode):
+		event = cls._event('commandEnd', '')
+		event['returncode'] = returncode
+		cls._write(event)
+		commands = cls._commands()
+		if commandID in commands:
+			commands.remove(commandID)
+
+	# Backends by name (BACKENDS: 'tty', 'plain', 'json'), plus (optionally) a
+	# spool file getting every event as JSON, rate limits aside, eg. for replay
+	# later (python -m deploy_coordinator.cli.backends <spoolFile>). rateLimit
+	# is lines per second per subprocess for 'json'
+	@classmethod
+	def configure(cls, name='tty', spoolFile=None, rateLimit=None):
+		if name not in BACKENDS:
+			raise Exception('Unknown output backend: %s (one of %s)' % (name, ', '.join(sorted(BACKENDS.keys()))))
+		backend = BACKENDS[name]()
+		if name == 'json':
+			backend.rateLimit = rateLimit
+		backends = [backend]
+		if spoolFile is not None:
+			backends.append(EventStreamBackend(open(spoolFile, 'a'), batchSize=1000, flushInterval=2.0))
+		cls.useBackends(backends)
+
+	# Replaces the backends in use (the ones replaced are closed); they're
+	# closed (flushed) when the process exits too
+	@classmethod
+	def useBackends(cls, backends):
+		with cls._writeLock:
+			previous 	  = cls._backends
+			cls._backends = list(backends)
+			for backend in previous:
+				if backend not in cls._backends:
+					backend.close()
+			if cls._closeAtExit == False:
+				atexit.register(cls.close)
+				cls._closeAtExit = True
+
+	@classmethod
+	def close(cls):
+		with cls._writeLock:
+			for backend in cls._backends:
+				backend.close()
+
+	# Groups nest; closing an inner group hands its lines to the outer one.
+	# parent (see currentGroup) lets work handed to another thread write into
+	# the group of the thread that handed it over, rather than on its own
+	@classmethod
+	def beginGroup(cls, parent=None):
+		if getattr(cls._local, 'groups', None) is None:
+			cls._local.groups  = []
+			cls._local.parents = []
+		cls._local.groups.append([])
+		cls._local.parents.append(parent)
+
+	@classmethod
+	def endGroup(cls):
+		groups = getattr(cls._local, 'groups', None)
+		if not groups:
+			return
+		buffered = groups.pop()
+		parent 	 = cls._local.parents.pop()
+		if groups:
+			groups[-1].extend(buffered)
+		elif parent is not None:
+			with cls._writeLock:
+				parent.extend(buffered)
+		elif buffered:
+			cls._flush(buffered)
+
+	# This thread's innermost open group (None if there isn't one)
+	@classmethod
+	def currentGroup(cls):
+		groups = getattr(cls._local, 'groups', None)
+		if groups:
+			return groups[-1]
+		return None
+
+	@classmethod
+	def _commands(cls):
+		if getattr(cls._local, 'commands', None) is None:
+			cls._local.commands = []
+		return cls._local.commands
+
+	@classmethod
+	def _event(cls, _type, message, level=None, indented=False):
+		if level is None:
+			level = 'info'
+			if isinstance(message, Formatter):
+				level = message.level()
+		commands = cls._commands()
+		return {
+			'type': _type,
+			'message': message,
+			'level': level,
+			'indented': indented,
+			'time': time.time(),
+			'phase': Tracer.currentPhase(),
+			'command': commands[-1] if commands else None
+		}
+
+	@classmethod
+	def _write(cls, event):
+		groups = getattr(cls._local, 'groups', None)
+		if groups:
+			groups[-1].append(event)
+		else:
+			cls._flush([event])
+
+	@classmethod
+	def _flush(cls, events):
+		with cls._writeLock:
+			for backend in cls._backends:
+				backend.emit(events)
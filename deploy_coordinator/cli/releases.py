@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, os, time, json, shlex, argparse
+from formatter import Formatter
+from output import Output
+from deploy_coordinator.system.activation import Activator, HealthProbe, ReloadStrategy
+from deploy_coordinator.system.buildfile import BuildFile
+from deploy_coordinator.system.parse_json import ParseJson
+from deploy_coordinator.system.composer_cache import ComposerCache
+from deploy_coordinator.system.execute import GitObjectReader
+from deploy_coordinator.system.release_collector import ReleaseCollector
+from deploy_coordinator.system.replicator import Replicator, ReplicaTarget
+
+# The releases kept under a build dir's _application/ (see ReleaseCollector),
+# and switching ln-release between them without building anything, eg. to
+# roll back a bad deploy:
+#	python -m deploy_coordinator.cli.releases /var/www/app list
+#	python -m deploy_coordinator.cli.releases /var/www/app rollback --reload apache-graceful
+#	python -m deploy_coordinator.cli.releases /var/www/app switch 3f2a91c --reload script --hooks-dir /path/to/hooks
+# Switching is the hook's activation (the link swapped in one rename, then the
+# reloads, then the health check if asked for), on a release as it was left.
+# A release whose vendor dir links to a composer cache entry that's gone
+# isn't switched to.
+#
+# A build dir with replicas (see Replicator) is switched along with them,
+# given the hook's "replicas" setting as --replicas: the replicas' links are
+# swapped right before this build dir's (once every replica is known to have
+# the release), and put back if its health check fails. Without --replicas,
+# a build dir that has been replicated from isn't switched (--no-replicas to
+# switch it alone anyway).
+class Releases(object):
+
+	def __init__(self, buildDir, gitDir=None):
+		self.buildDir 		= os.path.join(buildDir, '')
+		self.symlinkPointer = os.path.join(self.buildDir, 'ln-release')
+		self.appBundle 		= os.path.join(self.buildDir, '_application', '')
+		self.collector 		= ReleaseCollector(self.buildDir)
+		self.composerCache 	= ComposerCache(os.path.join(self.buildDir, '_composercache', ''))
+		self.objectReader 	= None
+		if gitDir != None:
+			self.objectReader = GitObjectReader(gitDir)
+
+	def liveCommitID(self):
+		if not os.path.islink(self.symlinkPointer):
+			return None
+		return os.path.basename(os.path.normpath(os.readlink(self.symlinkPointer)))
+
+	# Whether releases have been replicated from this build dir (there are
+	# replica manifests in its _manifests/)
+	def isReplicated(self):
+		manifestDir = os.path.join(self.buildDir, '_manifests')
+		if not os.path.isdir(manifestDir):
+			return False
+		return len([item for item in os.listdir(manifestDir) if item.endswith(Replicator.MANIFEST_SUFFIX)]) > 0
+
+	# Most recently activated first, as dicts of:
+	#	commitID, live, activatedAt (when it last went live, see
+	#	ReleaseCollector.recordActivation()), subject (of the commit, with a git dir), vendorHash (None
+	#	without composer) and vendorOK (whether the cache entry is there)
+	def describe(self):
+		live = self.liveCommitID()
+		releases = []
+		for commitID in self.collector.releases():
+			release = {
+				'commitID': commitID,
+				'live': commitID == live,
+				'activatedAt': self.collector.activatedAt(commitID),
+				'subject': self.subject(commitID),
+				'vendorHash': None,
+				'vendorOK': None
+			}
+			vendorLink = self.vendorLink(commitID)
+			if vendorLink != None and os.path.islink(vendorLink):
+				release['vendorHash'] = os.path.basename(os.path.normpath(os.readlink(vendorLink)))
+				release['vendorOK']   = os.path.isdir(vendorLink)
+			releases.append(release)
+		return releases
+
+	# The release commitID names (a prefix will do); raises unless exactly one
+	def release(self, commitID):
+		matches = [release for release in self.describe() if release['commitID'].startswith(commitID)]
+		if len(matches) == 0:
+			raise Exception('No release %s under %s' % (commitID, self.appBundle))
+		if len(matches) > 1:
+			raise Exception('%s matches %s releases; give more of the commit ID' % (commitID, len(matches)))
+		return matches[0]
+
+	# The most recently activated release that isn't live
+	def previous(self):
+		for release in self.describe():
+			if release['live'] != True:
+				return release
+		raise Exception('No release to roll back to under %s' % self.appBundle)
+
+	# Where the release's vendor symlink is (by the buildfile it was built
+	# from), or None if it doesn't use composer
+	def vendorLink(self, commitID):
+		releaseDir = os.path.join(self.appBundle, commitID)
+		try:
+			buildFile = BuildFile.compile(ParseJson(os.path.join(releaseDir, 'buildfile.json')).data)
+		except (IOError, ValueError):
+			return None
+		if not isinstance(buildFile.composerWorkingDir, basestring):
+			return None
+		return os.path.join(releaseDir, buildFile.composerWorkingDir, 'vendor')
+
+	def subject(self, commitID):
+		if self.objectReader == None:
+			return None
+		commit = self.objectReader.read(commitID)
+		if commit == None or commit[1] != 'commit':
+			return None
+		message = commit[2].split('\n\n', 1)
+		if len(message) < 2:
+			return ''
+		return message[1].strip().split('\n')[0]
+
+	# Puts the release live through activator (see Activator.activate), and
+	# on replicator's targets too if given; raises if its vendor dir is
+	# missing (here or on a replica), unless force, or a replica doesn't have
+	# the release, before anything is switched. The release counts as just
+	# activated afterwards (for retention, and for the composer cache)
+	def switch(self, release, activator, onLine=lambda line: None, force=False, replicator=None):
+		commitID = release['commitID']
+		if release['vendorOK'] == False and force != True:
+			raise Exception('Vendor dir of %s links to a composer cache entry that is gone (%s)' % (commitID[0:10], release['vendorHash']))
+		targets = []
+		if replicator != None:
+			targets = replicator.targets
+		for target in targets:
+			if not os.path.isdir(os.path.join(target.appBundle, commitID)):
+				raise Exception('%s doesn\'t have release %s; nothing was switched' % (target.name, commitID[0:10]))
+			vendorLink = self.vendorLink(commitID)
+			if vendorLink != None and force != True and not os.path.isdir(os.path.join(target.appBundle, os.path.relpath(vendorLink, self.appBundle))):
+				raise Exception('Vendor dir of %s on %s links to a composer cache entry that is gone' % (commitID[0:10], target.name))
+
+		# Replicas right before this build dir, like the hook does
+		if replicator != None:
+			replicator.swap(commitID)
+		try:
+			isLive = activator.activate('_application/' + commitID, onLine)
+		except:
+			if replicator != None:
+				replicator.revert(onLine)
+			raise
+		if replicator != None:
+			if activator.reverted == True:
+				replicator.revert(onLine)
+			else:
+				replicator.reload(onLine)
+		if isLive == True:
+			self.collector.recordActivation(commitID)
+			for target in targets:
+				ReleaseCollector(target.buildDir).recordActivation(commitID)
+			if release['vendorOK'] == True:
+				self.composerCache.hit(release['vendorHash'])
+		return isLive
+
+	@staticmethod
+	def formatAge(seconds):
+		for unit, size in [('d', 86400), ('h', 3600), ('m', 60)]:
+			if seconds >= size:
+				return '%s%s ago' % (int(seconds / size), unit)
+		return '%ss ago' % int(seconds)
+
+
+def listReleases(releases):
+	Output.line(Formatter('Releases in %s' % releases.appBundle).style(['bold']).arrowed())
+	described = releases.describe()
+	if len(described) == 0:
+		Output.line(Formatter('None').color('yellow').indent())
+	for release in described:
+		vendor = 'no vendor'
+		if release['vendorHash'] != None:
+			vendor = 'vendor %s' % release['vendorHash'][0:12]
+			if release['vendorOK'] != True:
+				vendor += ' (MISSING)'
+		line = '%s %s  %-8s  %-24s' % ({True: '*', False: ' '}[release['live']], release['commitID'][0:10], Releases.formatAge(time.time() - release['activatedAt']), vendor)
+		if release['subject'] != None:
+			line += '  %s' % release['subject'][0:60]
+		color = None
+		if release['vendorOK'] == False:
+			color = 'red'
+		elif release['live'] == True:
+			color = 'green'
+		formatted = Formatter(line)
+		if color != None:
+			formatted.color(color)
+		Output.line(formatted.indent())
+
+
+def switchRelease(releases, release, activator, force, replicator=None):
+	if release['live'] == True:
+		Output.line(Formatter('%s is already live; reloading' % release['commitID'][0:10]).color('yellow').arrowed())
+	else:
+		Output.line(Formatter('Switching to %s' % release['commitID'][0:10]).style(['bold']).arrowed())
+	def cbLine(line):
+		Output.line(Formatter(line.rstrip()).indent())
+	isLive = releases.switch(release, activator, cbLine, force, replicator)
+
+	report = activator.report
+	Output.line(Formatter('Symlinked to release (swapped in %.2fms)' % report['swapMs']).indent())
+	for ok, message in report['reloads']:
+		Output.line(Formatter(message).color({True: 'green', False: 'red'}[ok]).indent())
+	if report['probe'] != None:
+		ok, detail, ms = report['probe']
+		Output.line(Formatter('Health check: %s (%.0fms)' % (detail, ms)).color({True: 'green', False: 'red'}[ok]).indent())
+	if replicator != None:
+		for target in replicator.targets:
+			for ok, message in target.activator.report['reloads']:
+				Output.line(Formatter('%s: %s' % (target.name, message)).color({True: 'green', False: 'red'}[ok]).indent())
+		if activator.reverted != True:
+			Output.line(Formatter('Switched %s replica(s) along with this build dir' % len(replicator.targets)).indent())
+	if activator.reverted == True:
+		Output.line(Formatter('Release failed its health check; switched back to %s' % os.path.basename(os.path.normpath(activator.previousTarget))[0:10]).color('red').style(['bold']).indent())
+		return False
+	if isLive != True:
+		Output.line(Formatter('Release failed its health check, and there is no previous release to go back to').color('red').style(['bold']).indent())
+		return False
+	if False in [ok for ok, message in report['reloads']]:
+		return False
+	if replicator != None and False in [ok for target in replicator.targets for ok, message in target.activator.report['reloads']]:
+		return False
+	Output.line(Formatter('%s is live' % release['commitID'][0:10]).color('green').indent())
+	return True
+
+
+# --reload values: a strategy name (see ReloadStrategy.fromSetting) or a URL
+def reloadSetting(value):
+	if value.startswith('http://') or value.startswith('https://'):
+		return {'url': value}
+	return value
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Lists the releases of a build dir and switches between them without building')
+	parser.add_argument('buildDir')
+	parser.add_argument('command', choices=['list', 'switch', 'rollback'], help='rollback: switch to the most recently activated release that isn\'t live')
+	parser.add_argument('commitID', nargs='?', help='release to switch to (a prefix will do)')
+	parser.add_argument('--git-dir', dest='gitDir', help='bare repository, to list commit subjects')
+	parser.add_argument('--reload', dest='reload', action='append', type=reloadSetting, metavar='STRATEGY',
+		help='script, apache-graceful, php-fpm, none, or a URL to request; in the order given (default: script with --hooks-dir, else none)')
+	parser.add_argument('--reload-command', dest='reload', action='append', type=lambda value: {'command': shlex.split(value)}, metavar='COMMAND',
+		help='a command to reload with')
+	parser.add_argument('--hooks-dir', dest='hooksDir', help='repo hooks path, for the script reload (restartapache.sh)')
+	parser.add_argument('--health-url', dest='healthUrl', help='probe after switching; switches back if it isn\'t healthy')
+	parser.add_argument('--health-host', dest='healthHost')
+	parser.add_argument('--health-timeout', dest='healthTimeout', type=float, default=30)
+	parser.add_argument('--force', action='store_true', help='switch even if the vendor dir is missing')
+	parser.add_argument('--replicas', type=json.loads, metavar='JSON',
+		help='the hook\'s "replicas" setting, as JSON; they are switched along with the build dir')
+	parser.add_argument('--no-replicas', dest='noReplicas', action='store_true', help='switch a replicated build dir without its replicas')
+	args = parser.parse_args()
+
+	releases = Releases(args.buildDir, args.gitDir)
+	try:
+		if args.command == 'list':
+			listReleases(releases)
+			sys.exit(0)
+
+		if args.command == 'switch':
+			if args.commitID == None:
+				parser.error('switch needs the commit ID of a release')
+			release = releases.release(args.commitID)
+		else:
+			release = releases.previous()
+
+		reload = args.reload
+		if reload == None:
+			reload = ['none']
+			if args.hooksDir != None:
+				reload = ['script']
+		probe = None
+		if args.healthUrl != None:
+			probe = HealthProbe(args.healthUrl, args.healthHost)
+		replicator = None
+		if args.replicas:
+			replicator = Replicator(releases.buildDir, [ReplicaTarget.fromSetting(replica, args.hooksDir) for replica in args.replicas])
+		elif releases.isReplicated() and args.noReplicas != True:
+			raise Exception('Releases of %s have been replicated; give the replicas (--replicas, the hook\'s "replicas" setting) so they are switched too, or --no-replicas to switch this build dir alone' % releases.buildDir)
+		activator = Activator(releases.symlinkPointer, [ReloadStrategy.fromSetting(name, args.hooksDir) for name in reload], probe, args.healthTimeout)
+		if switchRelease(releases, release, activator, args.force, replicator) != True:
+			sys.exit(1)
+	except Exception as e:
+		Output.line(Formatter(str(e)).color('red'))
+		sys.exit(1)
@@ -1,2 +1,3 @@
 from post_receive import PostReceive
-from pre_receive import PreReceive
\ No newline at end of file
+from pre_receive import PreReceive
+from deploy_daemon import DeployDaemon
\ No newline at end of file
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, os, time, errno, argparse, subprocess, traceback
+from deploy_coordinator.cli import Formatter, Output
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.deploy_queue import DeployQueue
+from deploy_coordinator.system.staging_area import StagingArea
+from deploy_coordinator.hooks.post_receive import PostReceive
+
+# Resident worker running the deploys post-receive hooks queue up (hook
+# setting deployQueue), so a push returns as soon as its deploys are queued:
+#	python -m deploy_coordinator.hooks.deploy_daemon /var/spool/deploy_coord
+# Deploys of one project (environment + buildDir) run one at a time, and of
+# everything queued for it meanwhile only the newest commit gets built; other
+# projects' deploys run alongside, up to --workers. Each deploy runs as its
+# own process (output to the queue's logs/), which records its exit status.
+#
+# Nothing is kept in memory that the spool dir doesn't have, so a restarted
+# daemon picks up where the last one stopped: deploys still running are waited
+# for, and deploys whose process died are cleaned up and run again (unless a
+# newer one is queued, or they've been tried MAX_ATTEMPTS times). Only one
+# daemon runs per spool dir.
+class DeployDaemon(object):
+
+	POLL_INTERVAL 	= 1.0
+	MAX_ATTEMPTS 	= 3
+	# Records and logs of finished deploys are kept this long (seconds)
+	HISTORY_MAX_AGE = 7 * 86400
+
+	def __init__(self, spoolDir, maxWorkers=4):
+		self.spoolDir 	= spoolDir
+		self.queue 		= DeployQueue(spoolDir)
+		self.maxWorkers = max(1, int(maxWorkers))
+		# key: Popen of deploys this daemon started
+		self.children 	= {}
+		self._prunedAt 	= 0
+
+	def run(self):
+		daemonLock = FileLock(os.path.join(self.spoolDir, '.daemon.lock'))
+		if daemonLock.acquire(blocking=False) != True:
+			raise Exception('Another deploy daemon is running for %s' % self.spoolDir)
+		Output.line(Formatter('Deploy daemon watching %s (%s workers)' % (self.spoolDir, self.maxWorkers)).arrowed())
+		while True:
+			self.tick()
+			time.sleep(self.POLL_INTERVAL)
+
+	def tick(self):
+		for job in self.queue.runningJobs():
+			self.check(job)
+
+		running = len(self.queue.runningJobs())
+		for key in self.queue.pendingKeys():
+			if running >= self.maxWorkers:
+				break
+			job = self.queue.claim(key)
+			if job == None:
+				continue
+			self.spawn(job)
+			running += 1
+
+		if time.time() - self._prunedAt > 3600:
+			self.queue.prune(self.HISTORY_MAX_AGE)
+			self._prunedAt = time.time()
+
+	def spawn(self, job):
+		self.log(job, 'started (attempt %s)' % job['attempts'])
+		logHandle = open(self.queue.logPathFor(job['jobID']), 'a')
+		try:
+			child = subprocess.Popen(
+				[sys.executable, '-m', 'deploy_coordinator.hooks.deploy_daemon', self.spoolDir, '--run', job['key']],
+				stdout=logHandle, stderr=subprocess.STDOUT, cwd=job['settings'].get('bareRepoPath'),
+				preexec_fn=os.setsid, close_fds=True)
+		finally:
+			logHandle.close()
+		self.children[job['key']] = child
+		self.queue.updateRunning(job['key'], {'pid': child.pid})
+
+	# Finishes the project's running deploy once its process is gone
+	def check(self, job):
+		key 	= job['key']
+		child 	= self.children.get(key)
+		if child != None:
+			if child.poll() == None:
+				return
+			del self.children[key]
+		elif job.get('pid') != None and self.isAlive(job['pid']):
+			# Started by an earlier daemon and still going
+			return
+
+		result = self.queue.result(job['jobID'])
+		if result != None:
+			status = 'deployed'
+			if result['returncode'] != 0:
+				status = 'failed'
+			self.queue.finish(key, status)
+			self.log(job, status)
+		else:
+			self.recover(job)
+
+	# The deploy's process died without recording a result (killed, machine
+	# went down...): drop what it left behind, then run it again
+	def recover(self, job):
+		settings 	= job['settings']
+		buildDir 	= os.path.join(settings['buildDir'], '')
+		releaseDir 	= os.path.join(buildDir, '_application', job['newCommitID'])
+		symlinkPointer = os.path.join(buildDir, 'ln-release')
+		try:
+			workspace = StagingArea(buildDir, settings.get('stagingDir')).pathFor(os.path.join(job['environment'], job['newCommitID']))
+			if os.path.isdir(workspace):
+				FileSystem.removeDir(workspace)
+			# Where it was staged if the staging dir couldn't be created
+			FileSystem.removeDir(FileSystem.tempDirFor(os.path.join('builds', job['environment'], job['newCommitID'])))
+			# Moved into place, but never went live
+			isLive = FileSystem.isSymlink(symlinkPointer) and os.path.basename(os.path.normpath(os.readlink(symlinkPointer))) == job['newCommitID']
+			if os.path.isdir(releaseDir) and not isLive:
+				FileSystem.removeDir(releaseDir)
+		except (IOError, OSError) as e:
+			self.log(job, 'cleanup failed: %s' % e)
+
+		if self.queue.hasNewerPending(job['key'], job['jobID']) or job['attempts'] >= self.MAX_ATTEMPTS:
+			self.queue.finish(job['key'], 'interrupted')
+			self.log(job, 'interrupted')
+		else:
+			self.queue.requeue(job['key'])
+			self.log(job, 'interrupted; queued again')
+
+	@staticmethod
+	def isAlive(pid):
+		try:
+			os.kill(pid, 0)
+		except OSError as e:
+			return e.errno == errno.EPERM
+		return True
+
+	def log(self, job, message):
+		Output.line(Formatter('%s %s [%s...] %s: %s' % (
+			time.strftime('%Y-%m-%d %H:%M:%S'), job['environment'], job['newCommitID'][0:10], job['jobID'], message
+		)).indent())
+
+
+# Runs the project's claimed deploy in this process (spawned by the daemon)
+# and records how it went
+def runQueuedDeploy(spoolDir, key):
+	queue 		= DeployQueue(spoolDir)
+	job 		= queue.runningJob(key)
+	returncode 	= 1
+	try:
+		PostReceive(job['input'], job['settings'])
+		returncode = 0
+	except SystemExit as e:
+		returncode = e.code
+		if returncode == None:
+			returncode = 0
+		elif not isinstance(returncode, int):
+			returncode = 1
+	except Exception:
+		traceback.print_exc()
+	finally:
+		sys.stdout.flush()
+		queue.writeResult(job['jobID'], returncode)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Runs deploys queued by post-receive hooks')
+	parser.add_argument('spoolDir')
+	parser.add_argument('--workers', type=int, default=4, help='deploys (of different projects) running at once')
+	parser.add_argument('--run', metavar='KEY', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	if args.run != None:
+		runQueuedDeploy(args.spoolDir, args.run)
+	else:
+		DeployDaemon(args.spoolDir, args.workers).run()
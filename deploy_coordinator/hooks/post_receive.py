@@ -1,11 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys, os, subprocess, tempfile, ConfigParser
+import sys, os, time, tempfile, ConfigParser
 from pre_receive import PreReceive
 from deploy_coordinator.cli import Formatter, Output
-from deploy_coordinator.system.execute import Execute, Git, Composer
+from deploy_coordinator.system.execute import Composer
 from deploy_coordinator.system.file_system import FileSystem
 from deploy_coordinator.system.parse_json import ParseJson
+from deploy_coordinator.system.release_builder import ReleaseBuilder
+from deploy_coordinator.system.export_filter import ExportFilter
+from deploy_coordinator.system.buildfile import BuildFile
+from deploy_coordinator.system.object_store import ObjectStore
+from deploy_coordinator.system.composer_cache import ComposerCache
+from deploy_coordinator.system.package_store import PackageStore
+from deploy_coordinator.system.artifact_cache import ArtifactCache
+from deploy_coordinator.system.task_scheduler import TaskScheduler, BuildTask
+from deploy_coordinator.system.submodule_cache import SubmoduleCache
+from deploy_coordinator.system.worker_pool import WorkerPool, CancelledError
+from deploy_coordinator.system.deploy_queue import DeployQueue
+from deploy_coordinator.system.release_collector import ReleaseCollector
+from deploy_coordinator.system.staging_area import StagingArea
+from deploy_coordinator.system.replicator import Replicator, ReplicaTarget
+from deploy_coordinator.system.tracer import Tracer, Profiler
+from deploy_coordinator.system.activation import Activator, HealthProbe, ReloadStrategy
+from deploy_coordinator.system.warmup import Warmup
 
 def abortBuild():
 	Output.multiLine([
@@ -13,33 +30,219 @@ def abortBuild():
 		Formatter('Build aborted; nothing changed with current deploy.').color('red').style(['bold']),
 		''
 	]);
-	sys.exit(0)
+	# Git ignores post-receive's exit status, but the deploy daemon doesn't
+	sys.exit(1)
+
+
+# Composer, if relevant (note - this is all still happening in the tmp dir).
+# Raises on failure. Runs on its own, or as the built-in "composer" task when
+# the buildfile declares tasks (see runBuildTasks)
+def composerPhase(PostReceiveInstance):
+	Output.multiLine([
+		'',
+		Formatter('Inspecting composer settings').arrowed()
+	])
+
+	# If composer key not defined, don't do anything
+	if PostReceiveInstance.parsedBuildFile().composer == None:
+		Output.line(Formatter('No composer run specified; moving on....').indent())
+
+	# Composer is defined; look at the composer.workingDir key and run
+	else:
+		composerWD = PostReceiveInstance.parsedBuildFile().composerWorkingDir
+		if composerWD == None:
+			raise Exception('No composer run specified in buildfile')
+		
+		composerWDPathTmp 	 = os.path.join(PostReceiveInstance.tmpDir(), composerWD)
+		composerFilePath  	 = os.path.join(composerWDPathTmp, 'composer.json')
+		composerLockFilePath = os.path.join(composerWDPathTmp, 'composer.lock')
+
+		# Ensure composer.json file exists in the target directory
+		if not FileSystem.fileExists(composerFilePath):
+			raise Exception('Missing composer file (composer.json)')
+
+		# Ensure composer.lock file exists in the target directory
+		if not FileSystem.fileExists(composerLockFilePath):
+			raise Exception('Missing composer file (composer.lock)')
+
+		# Try to parse the composer lock file (which is JSON)
+		try:
+			parsedLockFile = ParseJson(composerLockFilePath)
+		except ValueError, e:
+			raise Exception('Unable to parse the composer.lock file')
+
+		# Get the hash key from the composer lock file to see if we already
+		# have a build to check for
+		composerHash = parsedLockFile.key('hash')
+		# A vendor dir without packages-dev is a different build of the lock file
+		composerDev  = PostReceiveInstance.parsedBuildFile().composerDev != False
+		if not composerDev:
+			composerHash = composerHash + '-no-dev'
+		# In the tmp directory, what is the full path to the vendor dir (whether it exists or not, yet);
+		# this is where we'll generate a symlink to point to the permanent/cached composer builds
+		vendorDirInTmp = os.path.join(composerWDPathTmp, 'vendor')
+		# Full path to the permanent/cached build (eg. what the vendor directory should symlink to)
+		permBuildDir   = os.path.join(PostReceiveInstance.locComposerCache, composerHash)
+		# An incremental build carries over the previous release's vendor symlink; drop
+		# it so composer can never install through it into an existing cache entry
+		if FileSystem.isSymlink(vendorDirInTmp):
+			FileSystem.remove(vendorDirInTmp)
+
+		# Check the composercache directory (which is always permanent) to see if a build
+		# already exists w/ the same value as the hash in the lock file. If not, we'll run a composer
+		# install... Holding the hash's lock while doing so means a concurrent deploy with the
+		# same lock file waits for this build instead of duplicating it (and vice versa)
+		composerCache = PostReceiveInstance.composerCache()
+		def cbWaiting():
+			Output.line(Formatter('Waiting for another deploy building the same dependencies...').color('yellow').indent())
+		hashLock = composerCache.acquire(composerHash, cbWaiting)
+		try:
+			if composerCache.exists(composerHash):
+				composerCache.hit(composerHash)
+				Output.line(Formatter(Formatter('Using cached composer dependencies ->').color('green') + ' ' + composerHash).indent())
+			else:
+				Output.line(Formatter('Installing composer dependencies for path: ' + Formatter(composerWD).style(['underline'])).indent())
+
+				# Start out with the packages the package store already has (from
+				# vendor builds of other lock files); composer installs the rest
+				packageStore = PostReceiveInstance.packageStore()
+				if packageStore != None:
+					try:
+						linked, total = packageStore.assemble(vendorDirInTmp, parsedLockFile.data, composerDev)
+						Output.line(Formatter('Reusing %s of %s package(s) from the package store' % (linked, total)).indent())
+					except (IOError, OSError) as e:
+						if FileSystem.exists(vendorDirInTmp):
+							FileSystem.removeDir(vendorDirInTmp)
+						Output.line(Formatter('Failed linking packages from the package store (%s); installing all of them' % e).color('yellow').indent())
+
+				# Execute composer (fails silently, thats why we check for existence of vendorDirInTmp)
+				composerArgs = ['--working-dir=%s' % composerWDPathTmp, 'install']
+				if not composerDev:
+					composerArgs.append('--no-dev')
+				composerProc = Composer(composerArgs)
+
+				# Ensure the system call itself didn't return any errors
+				if not composerProc.process.returncode == 0:
+					# @todo: log error output somewhere
+					raise Exception('Executing composer failed hard; probably a syntax error...')
+				# Did the run work (kind of a double check, but most important b/c the dir needs to exist)
+				if FileSystem.exists(vendorDirInTmp):
+					# Move "vendor" dir from location in tmp dir to the permanent _composercache dir,
+					# named after the composer.lock file's hash value (atomically)
+					composerCache.publish(composerHash, vendorDirInTmp)
+					# Its packages go into the package store, for the next lock file
+					if packageStore != None:
+						try:
+							stored = packageStore.ingest(permBuildDir, parsedLockFile.data)
+							Output.line(Formatter('Package store: %s new package(s)' % stored).indent())
+						except (IOError, OSError) as e:
+							Output.line(Formatter('Failed adding packages to the package store (%s), no biggie' % e).color('yellow').indent())
+					# Output
+					Output.line(Formatter(Formatter('Using lock file version: ').color('green') + Formatter(composerHash).style(['underline'])).indent())
+				else:
+					raise Exception('Composer run failed')
+		finally:
+			hashLock.release()
+
+		# Create a symlink for the vendor dir (which is no longer there after having been
+		# moving/renamed above, OR it already existed hence the "cache") pointing at permBuildDir;
+		# which is (what was previously) the vendor directory, renamed to the hash from the lockfile.
+		# This always happens, as we're symlinking to what we now know to be the cached directory, whether
+		# it was freshly created or not from above.
+		FileSystem.genSymlink(permBuildDir, vendorDirInTmp)
+
+
+# Runs the buildfile's "tasks" graph (in the tmp dir), with the composer
+# phase as a built-in task others can depend on, eg:
+#	"tasks": {
+#		"assets": {"command": "npm install && npm run build", "workingDir": "web/theme"},
+#		"warm": {"command": "php bin/warm.php", "dependsOn": ["composer", "assets"]}
+#	}
+# Independent tasks run at the same time (buildfile key taskWorkers, defaults
+# to the number of CPUs). Any failure aborts the build once the rest finished.
+def runBuildTasks(PostReceiveInstance):
+	Output.multiLine([
+		'',
+		Formatter('Running build tasks').arrowed()
+	])
+	try:
+		buildTasks = PostReceiveInstance.parsedBuildFile().tasks
+		if not isinstance(buildTasks, dict):
+			raise Exception('Tasks in buildfile must be an object of name: {command, ...}')
+		scheduler = TaskScheduler(PostReceiveInstance.parsedBuildFile().taskWorkers)
+		composerTask = scheduler.add(BuildTask('composer', lambda task: composerPhase(PostReceiveInstance)))
+		taskEnv = {
+			'DEPLOY_BUILD_DIR': PostReceiveInstance.tmpDir(),
+			'DEPLOY_COMMIT_ID': PostReceiveInstance.newCommitID
+		}
+		for name in sorted(buildTasks.keys()):
+			scheduler.add(BuildTask.fromSpec(name, buildTasks[name], PostReceiveInstance.tmpDir(), taskEnv))
+		# Tasks declaring inputs and outputs are skipped when the artifact
+		# cache has their outputs
+		cacheKeys = {}
+		artifactCache = PostReceiveInstance.artifactCache()
+		treeEntries = PostReceiveInstance.releaseBuilder().treeEntries(PostReceiveInstance.newCommitID)
+		if treeEntries != None:
+			composerTask.resultKey = PostReceiveInstance.composerResultKey(treeEntries)
+			cacheKeys = scheduler.useCache(artifactCache, PostReceiveInstance.tmpDir(), treeEntries)
+		failed = scheduler.run()
+	except Exception as e:
+		Output.line(Formatter(e).color('red').indent())
+		abortBuild()
+
+	# Timing per task
+	Output.line('')
+	for task in scheduler.tasks:
+		color = {'done': 'green', 'failed': 'red'}.get(task.status, 'yellow')
+		status = task.status
+		if task.cacheStatus == 'hit':
+			status = 'cached'
+		Output.line(Formatter('%-24s %-8s %7.2fs' % (task.name, status, task.duration())).color(color).indent())
+
+	# Hit rate, and the cache trimmed (entries this build used stay)
+	if len(cacheKeys) > 0:
+		try:
+			artifactCache.evict(cacheKeys.values())
+			artifactCache.writeStats()
+			line = 'Artifact cache: %(hits)s hit(s), %(misses)s miss(es), %(evicted)s evicted' % artifactCache.stats
+			if artifactCache.hitRate() != None:
+				line += '; %.0f%% hit rate overall' % (artifactCache.hitRate() * 100)
+			Output.line(Formatter(line).indent())
+		except:
+			Output.line(Formatter('Failed trimming artifact cache, no biggie').color('yellow').indent())
+	if len(failed) > 0:
+		abortBuild()
 
 
 # How this works: the corresponding hook file in the git repo
-# just instantiates the PreReceive object declared below, and
-# the PreReceive init method passes itself to this function to
-# perform any logic / tasks
+# just instantiates the PostReceive object declared below, and
+# the PostReceive init method passes an instance per deploy (see
+# deployTargets) to this function to perform any logic / tasks
 def postReceiveRunner(PostReceiveInstance):
-	# Check branch name
-	if PostReceiveInstance.branchIsMaster() != True:
-		Output.multiLine([
-			'',
-			Formatter('Only master branches are deployed; but your branch push was recieved.').color('yellow'),
-			Formatter('Push completed').color('cyan'),
-			''
-		])
-		sys.exit(0)
-	else:
-		Output.multiLine([
-			Formatter(
-				"Commit Accepted, branch: " + 
-				Formatter(PostReceiveInstance.branchName).style('underline') + 
-				Formatter(" [%s...]" % PostReceiveInstance.newCommitID[0:10]).color('cyan')
-			).arrowed(),
-			''
-		])
+	Output.multiLine([
+		Formatter(
+			"Commit Accepted, branch: " + 
+			Formatter(PostReceiveInstance.branchName).style('underline') + 
+			Formatter(" [%s...]" % PostReceiveInstance.newCommitID[0:10]).color('cyan') +
+			" -> %s" % PostReceiveInstance.environmentName
+		).arrowed(),
+		''
+	])
+
+	# Loaded from the cache pre-receive filled; compiled (and checked) here if
+	# it's not in there
+	buildFile = PostReceiveInstance.parsedBuildFile()
+	if buildFile == None or buildFile.isValid() != True:
+		errors = ['Buildfile contains invalid JSON']
+		if PostReceiveInstance.hasBuildFile() != True:
+			errors = ['Project must contain buildfile.json in the project root!']
+		elif buildFile != None:
+			errors = ['Buildfile: %s' % error for error in buildFile.errors]
+		for error in errors:
+			Output.line(Formatter(error).color('red').indent())
+		abortBuild()
 
+	Tracer.phase('directories')
 	# Ensure directory structure is in place (os.makedirS creates all directories
 	# leading up to the leaf)
 	try:
@@ -54,26 +257,73 @@ def postReceiveRunner(PostReceiveInstance):
 	except:
 		Output.line(Formatter('Unable to create bundle directory for project').color('red').indent())
 
+	Tracer.phase('staging')
+	# Builds are staged on the releases' filesystem (see stagingArea()); check
+	# that holds, and that there's room for this one before writing anything
+	try:
+		Output.line(Formatter('Staging build').arrowed())
+		staging = PostReceiveInstance.stagingArea()
+		staging.prepare()
+		if staging.fallbackReason != None:
+			Output.line(Formatter('%s; the release will be copied into place, not renamed' % staging.fallbackReason).color('yellow').indent())
+		treeStats = PostReceiveInstance.releaseBuilder().treeStats(PostReceiveInstance.newCommitID)
+		if treeStats == None:
+			raise Exception('Unable to list tree @ %s' % PostReceiveInstance.newCommitID)
+		for ok, message in staging.checkSpace(treeStats[0], treeStats[1], PostReceiveInstance.stagingMinFreeBytes, PostReceiveInstance.stagingMinFreeInodes):
+			if ok != True:
+				Output.line(Formatter('Not enough free space (%s and %s inodes have to be left), %s' % (
+					FileSystem.formatBytes(PostReceiveInstance.stagingMinFreeBytes), PostReceiveInstance.stagingMinFreeInodes, message)).color('red').indent())
+				abortBuild()
+			Output.line(Formatter(message).indent())
+	except Exception as e:
+		Output.line(Formatter('Unable to set up staging area: %s' % e).color('red').indent())
+		abortBuild()
+
+	Tracer.phase('clone')
 	# Copy to /tmp directory so we can monkey with code there
 	try:
 		Output.line(Formatter('Cloning code to tmp dir').arrowed())
 		# Clone the entire project to a tmp directory and check it worked
 		if PostReceiveInstance.cloneProjectToTmpDir() != True:
 			raise Exception('Unable to clone to tmp dir')
+		builder = PostReceiveInstance.releaseBuilder()
+		if builder.mode == 'incremental':
+			Output.line(Formatter(
+				Formatter('Incremental from previous release (%s): ' % builder.linkMode).color('green') +
+				'%(added)s added, %(modified)s modified, %(deleted)s deleted' % builder.stats
+			).indent())
+			if builder.stats['copied'] > 0:
+				Output.line(Formatter('Copied %s file(s) git doesn\'t track, rather than linking them' % builder.stats['copied']).indent())
+		elif PostReceiveInstance.incrementalRelease == True:
+			Output.line(Formatter('Full checkout; %s' % builder.reason).color('yellow').indent())
+		if builder.stats['excluded'] > 0:
+			Output.line(Formatter('Export rules: %s path(s) left out' % builder.stats['excluded']).indent())
+		if builder.objectStore is not None:
+			storeStats = builder.objectStore.stats
+			Output.line(Formatter(
+				Formatter('Object store: ').color('green') +
+				'reused %s blobs (%s saved), stored %s new (%s)' % (
+					storeStats['blobsReused'], FileSystem.formatBytes(storeStats['bytesSaved']),
+					storeStats['blobsStored'], FileSystem.formatBytes(storeStats['bytesStored']))
+			).indent())
+			if storeStats['copiedCrossDevice'] > 0:
+				Output.line(Formatter('Object store is on a different filesystem than the tmp dir; %s files were copied, not linked' % storeStats['copiedCrossDevice']).color('yellow').indent())
 	except Exception as e:
 		Output.line(Formatter(e.args[0]).color('red').indent())
 		abortBuild()
 
+	Tracer.phase('submodules')
 	# SUBMODULES
 	PostReceiveInstance.inspectSubmodules()
 
 
+	Tracer.phase('storage')
 	# Pre-processing (eg. remove data dirs FROM THE CLONED tmp dir - which should
 	# not contain anything), then setup symlinks to permanent storage)
 	try:
 		Output.line(Formatter('Applying buildfile rules').arrowed())
 		# Work on permanent storage dirs
-		permStorageDirs = PostReceiveInstance.parsedBuildFile().key('storage.dirs')
+		permStorageDirs = PostReceiveInstance.parsedBuildFile().storageDirs
 		if permStorageDirs == None:
 			Output.line(Formatter('Warning: no permanent storage dirs defined').color('yellow').indent())
 		else:
@@ -87,13 +337,20 @@ def postReceiveRunner(PostReceiveInstance):
 			for relativePath in permStorageDirs:
 				fullPath = os.path.abspath(os.path.join(PostReceiveInstance.tmpDir(), relativePath))
 
-				# delete IN THE TMP FOLDER if exists (was dumped by git during export)
-				if os.path.exists(fullPath) == True:
+				# delete IN THE TMP FOLDER if exists (was dumped by git during export,
+				# or is the symlink carried over from the previous release)
+				if FileSystem.isSymlink(fullPath) == True:
+					FileSystem.remove(fullPath)
+				elif os.path.exists(fullPath) == True:
 					if os.path.isdir(fullPath) == True:
 						FileSystem.removeDir(fullPath)
 					else:
 						os.remove(fullPath)
 
+				# its parent may not be there if export rules left everything in it out
+				if not os.path.isdir(os.path.dirname(fullPath)):
+					os.makedirs(os.path.dirname(fullPath))
+
 				# ensure permanent directory is created, now in the BUNDLE path
 				generatedPermanentPath = os.path.join(PostReceiveInstance.locPermanentDirs, relativePath)
 				if not os.path.exists(generatedPermanentPath):
@@ -108,127 +365,260 @@ def postReceiveRunner(PostReceiveInstance):
 		Output.line(Formatter(e).color('red').indent())
 		abortBuild()
 
-	# Composer, if relevant (note - this is all still happening in the tmp dir)
+	Tracer.phase('build')
+	# Whatever the build may write in place mustn't be linked to other releases
+	try:
+		copied = PostReceiveInstance.releaseBuilder().copyWritable(PostReceiveInstance.tmpDir(), PostReceiveInstance.writablePaths())
+		if copied > 0:
+			Output.line(Formatter('Copied %s linked file(s) where the build writes, rather than linking them' % copied).indent())
+	except (IOError, OSError) as e:
+		Output.line(Formatter('Unable to copy the files the build writes to: %s' % e).color('red').indent())
+		abortBuild()
+
+	# Composer, then any tasks from the buildfile
 	# @todo: currently we're setting it such that if no composer settings exist, the
 	# build will abort. should be made optional (eg. skip this if not relevant and continue build)
+	if PostReceiveInstance.parsedBuildFile().tasks == None:
+		try:
+			with Tracer.span('composer'):
+				composerPhase(PostReceiveInstance)
+		except Exception as e:
+			Output.line(Formatter(e).color('yellow').indent())
+			abortBuild()
+	else:
+		runBuildTasks(PostReceiveInstance)
+
+
+	# --------------------------------------------------------------------
+	# Building things in the /tmp dir done; move and link for final deployment
+	# Move from /tmp directory to final destination (still keeping newCommitID name)
+	Tracer.phase('move')
 	try:
 		Output.multiLine([
 			'',
-			Formatter('Inspecting composer settings').arrowed()
+			Formatter('Moving build to release directory').arrowed()
 		])
-
-		# If composer key not defined, don't do anything
-		if PostReceiveInstance.parsedBuildFile().key('composer') == None:
-			Output.line(Formatter('No composer run specified; moving on....').indent())
-
-		# Composer is defined; look at the composer.workingDir key and run
+		# Left behind by an earlier deploy of the commit that never went (or stayed) live
+		releaseDir = os.path.join(PostReceiveInstance.locAppBundle, PostReceiveInstance.newCommitID)
+		if os.path.isdir(releaseDir) and PostReceiveInstance.liveCommitID() != PostReceiveInstance.newCommitID:
+			PostReceiveInstance.releaseCollector().discard(releaseDir)
+		startedAt = time.time()
+		staging = PostReceiveInstance.stagingArea()
+		if staging.publish(PostReceiveInstance.tmpDir(), releaseDir) == 'rename':
+			Output.line(Formatter('Published in a single rename (%.2fms)' % ((time.time() - startedAt) * 1000)).indent())
 		else:
-			composerWD = PostReceiveInstance.parsedBuildFile().key('composer.workingDir')
-			if composerWD == None:
-				raise Exception('No composer run specified in buildfile')
-			
-			composerWDPathTmp 	 = os.path.join(PostReceiveInstance.tmpDir(), composerWD)
-			composerFilePath  	 = os.path.join(composerWDPathTmp, 'composer.json')
-			composerLockFilePath = os.path.join(composerWDPathTmp, 'composer.lock')
-
-			# Ensure composer.json file exists in the target directory
-			if not FileSystem.fileExists(composerFilePath):
-				raise Exception('Missing composer file (composer.json)')
+			Output.line(Formatter('Copied into place, then renamed (%.2fs); %s' % (time.time() - startedAt, staging.fallbackReason)).color('yellow').indent())
+	except:
+		Output.line(Formatter('Could not copy from tmp to release directory').color('red').indent())
+		abortBuild()
 
-			# Ensure composer.lock file exists in the target directory
-			if not FileSystem.fileExists(composerLockFilePath):
-				raise Exception('Missing composer file (composer.lock)')
+	# Preload list and URL warmup (hook setting warmup); activation waits for
+	# it, up to its timeout. Before replication, so replicas get the preload
+	# script too. Never fails the deploy
+	if PostReceiveInstance.warmupSettings not in [None, False]:
+		Tracer.phase('warmup')
+		Output.multiLine([
+			'',
+			Formatter('Warming up release').arrowed()
+		])
+		try:
+			warmup = PostReceiveInstance.warmup(releaseDir)
+			if len(warmup.urls) > 0:
+				Activator(PostReceiveInstance.warmupPointer).swap('_application/' + PostReceiveInstance.newCommitID)
+			warmupReport = warmup.run()
+			if warmupReport['preload'] == 'skipped':
+				Output.line(Formatter('Preload list skipped: no time left within %ss' % warmup.timeout).color('yellow').indent())
+			elif warmupReport['preload'] != None:
+				line = 'Preload list: %s file(s), %s from the composer classmap, in %s (%.0fms)' % (
+					warmupReport['preloadFiles'], warmupReport['classmapFiles'], warmup.preloadName, warmupReport['preloadMs'])
+				if warmupReport['preload'] == 'partial':
+					Output.line(Formatter(line + '; partial, the %ss timeout passed while listing files' % warmup.timeout).color('yellow').indent())
+				else:
+					Output.line(Formatter(line).indent())
+			if len(warmup.urls) > 0:
+				line = 'Requested %s URL(s), %s concurrently: %s error(s)' % (warmupReport['requests'], warmup.concurrency, len(warmupReport['errors']))
+				if warmup.requestTimes() != None:
+					line += ', median %.0fms, slowest %.0fms' % warmup.requestTimes()
+				Output.line(Formatter(line).color({True: 'green', False: 'yellow'}[len(warmupReport['errors']) == 0]).indent())
+				for url, detail in warmupReport['errors']:
+					Output.line(Formatter('%s: %s' % (url, detail)).color('yellow').indent())
+				if warmupReport['skipped'] > 0:
+					Output.line(Formatter('%s URL(s) not requested within %ss' % (warmupReport['skipped'], warmup.timeout)).color('yellow').indent())
+			Output.line(Formatter('Warmed up in %.2fs' % warmupReport['seconds']).indent())
+		except Exception as e:
+			Output.line(Formatter('Warmup failed: %s' % e).color('yellow').indent())
 
-			# Try to parse the composer lock file (which is JSON)
+	# Every replica receives the release before anything goes live anywhere
+	replicator = None
+	if len(PostReceiveInstance.replicas) > 0:
+		Tracer.phase('replicate')
+		Output.multiLine([
+			'',
+			Formatter('Replicating release to %s target(s)' % len(PostReceiveInstance.replicas)).arrowed()
+		])
+		try:
+			replicator = PostReceiveInstance.replicator()
+			failures = replicator.prepare(PostReceiveInstance.newCommitID, releaseDir, PostReceiveInstance.liveCommitID())
+		except Exception as e:
+			failures = [(None, e)]
+		if replicator != None and len(failures) == 0:
+			Output.line(Formatter('Release manifest: hashed %s file(s) (%s)' % (replicator.stats['filesHashed'], FileSystem.formatBytes(replicator.stats['bytesHashed']))).indent())
+			for target in replicator.targets:
+				if target.stats['alreadyLive'] == True:
+					Output.line(Formatter('%s: already live there' % target.name).color('yellow').indent())
+					continue
+				line = '%s: %s file(s) copied (%s), %s linked' % (target.name, target.stats['filesCopied'], FileSystem.formatBytes(target.stats['bytesCopied']), target.stats['filesLinked'])
+				if len(target.stats['vendorEntries']) > 0:
+					line += ', vendor %s received' % ', '.join([lockHash[0:12] for lockHash in target.stats['vendorEntries']])
+				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' %s (%.2fs)' % (line, target.stats['seconds'])).indent())
+		else:
+			for target, error in failures:
+				name = 'Replication'
+				if target != None:
+					name = target.name
+				Output.line(Formatter('%s: %s' % (name, error)).color('red').style(['bold']).indent())
+			Output.line(Formatter('Not every replica received the release; nothing was switched').color('red').indent())
 			try:
-				parsedLockFile = ParseJson(composerLockFilePath)
-			except ValueError, e:
-				raise Exception('Unable to parse the composer.lock file')
-
-			# Get the hash key from the composer lock file to see if we already
-			# have a build to check for
-			composerHash = parsedLockFile.key('hash')
-			# In the tmp directory, what is the full path to the vendor dir (whether it exists or not, yet);
-			# this is where we'll generate a symlink to point to the permanent/cached composer builds
-			vendorDirInTmp = os.path.join(composerWDPathTmp, 'vendor')
-			# Full path to the permanent/cached build (eg. what the vendor directory should symlink to)
-			permBuildDir   = os.path.join(PostReceiveInstance.locComposerCache, composerHash)
-
-			# Check the composercache directory (which is always permanent) to see if a build
-			# already exists w/ the same value as the hash in the lock file. If not, we'll run a composer
-			# install...
-			if FileSystem.exists(os.path.join(PostReceiveInstance.locComposerCache, composerHash)):
-				Output.line(Formatter(Formatter('Using cached composer dependencies ->').color('green') + ' ' + composerHash).indent())
-			else:
-				Output.line(Formatter('Installing composer dependencies for path: ' + Formatter(composerWD).style(['underline'])).indent())
-				
-				# Execute composer (fails silently, thats why we check for existence of vendorDirInTmp)
-				composerProc = Composer(['--working-dir=%s' % composerWDPathTmp, 'install'])
+				if replicator != None:
+					replicator.discard(PostReceiveInstance.newCommitID)
+				PostReceiveInstance.releaseCollector().discard(releaseDir)
+			except:
+				pass
+			abortBuild()
 
-				# Ensure the system call itself didn't return any errors
-				if not composerProc.process.returncode == 0:
-					# @todo: log error output somewhere
-					raise Exception('Executing composer failed hard; probably a syntax error...')
-				# Did the run work (kind of a double check, but most important b/c the dir needs to exist)
-				if FileSystem.exists(vendorDirInTmp):
-					# Copy "vendor" dir from location in tmp dir to the permanent _composercache dir,
-					# noting that it'll still be named 'vendor' in the permanent dir
-					FileSystem.mvFromTo(vendorDirInTmp, PostReceiveInstance.locComposerCache)
-					# Rename from "vendor" to the composer.lock file's hash value
-					os.rename(
-						os.path.join(PostReceiveInstance.locComposerCache, 'vendor'),
-						permBuildDir
-					)
-					# Output
-					Output.line(Formatter(Formatter('Using lock file version: ').color('green') + Formatter(composerHash).style(['underline'])).indent())
-				else:
-					raise Exception('Composer run failed')
-
-			
-			# Create a symlink for the vendor dir (which is no longer there after having been
-			# moving/renamed above, OR it already existed hence the "cache") pointing at permBuildDir;
-			# which is (what was previously) the vendor directory, renamed to the hash from the lockfile.
-			# This always happens, as we're symlinking to what we now know to be the cached directory, whether
-			# it was freshly created or not from above.
-			FileSystem.genSymlink(permBuildDir, vendorDirInTmp)
-		
+	Tracer.phase('activate')
+	# Point ln-release at the release and get the web server onto it
+	Output.multiLine([
+		'',
+		Formatter('Activating release').style(['bold']).arrowed()
+	])
+	try:
+		activator = PostReceiveInstance.activator()
 	except Exception as e:
-		Output.line(Formatter(e).color('yellow').indent())
+		Output.line(Formatter(e).color('red').indent())
 		abortBuild()
-
-
-	# --------------------------------------------------------------------
-	# Building things in the /tmp dir done; move and link for final deployment
+	def cbLine(line):
+		Output.line(Formatter(line.rstrip()).indent())
+	# Replicas are switched right before this build dir (they all have the
+	# release by now), and reloaded after it
+	if replicator != None:
+		try:
+			replicator.swap(PostReceiveInstance.newCommitID)
+		except Exception as e:
+			Output.line(Formatter('Failed switching a replica; none were switched (%s)' % e).color('red').style(['bold']).indent())
+			abortBuild()
 	try:
-		# Move from /tmp directory to final destination (still keeping newCommitID name)
+		# NOTE: instead of placing PostReceiveInstance.locAppBundle + ...newCommitID,
+		# we are just doing _application/ so that the symlink is a RELATIVE path
+		isLive = activator.activate('_application/' + PostReceiveInstance.newCommitID, cbLine)
+	except Exception as e:
+		Output.line(Formatter('EMERGENCY: Failed creating symlink pointer to latest release (%s)' % e).color('red').style(['bold']).indent())
+		if replicator != None:
+			replicator.revert(cbLine)
+		abortBuild()
+
+	report = activator.report
+	Output.line(Formatter('Symlinked to release (swapped in %.2fms)' % report['swapMs']).indent())
+	for ok, message in report['reloads']:
+		Output.line(Formatter(message).color({True: 'green', False: 'red'}[ok]).indent())
+	if report['probe'] != None:
+		ok, detail, ms = report['probe']
+		Output.line(Formatter('Health check: %s (%.0fms)' % (detail, ms)).color({True: 'green', False: 'red'}[ok]).indent())
+		Output.line(Formatter('Site unavailable for %.0fms, degraded for %.0fms while activating' % (report['unavailableMs'], report['degradedMs'])).indent())
+	if replicator != None:
+		if activator.reverted == True:
+			replicator.revert(cbLine)
+			replicator.discard(PostReceiveInstance.newCommitID)
+		else:
+			replicator.reload(cbLine)
+		for target in replicator.targets:
+			for ok, message in target.activator.report['reloads']:
+				Output.line(Formatter('%s: %s' % (target.name, message)).color({True: 'green', False: 'red'}[ok]).indent())
+		if activator.reverted != True:
+			Output.line(Formatter('Switched %s replica(s) along with this build dir' % len(replicator.targets)).indent())
+	if activator.reverted == True:
+		Output.line(Formatter('Release failed its health check; reverted to the previous release').color('red').style(['bold']).indent())
 		try:
-			Output.multiLine([
-				'',
-				Formatter('Moving build to release directory').arrowed()
-			])
-			FileSystem.mvFromTo(PostReceiveInstance.tmpDir(), PostReceiveInstance.locAppBundle)
+			FileSystem.removeDir(os.path.join(PostReceiveInstance.locAppBundle, PostReceiveInstance.newCommitID))
 		except:
-			raise Exception('Could not copy from tmp to release directory')
+			pass
+		abortBuild()
+	elif isLive != True:
+		Output.line(Formatter('Release failed its health check, and there is no previous release to go back to').color('red').style(['bold']).indent())
 
-		# Ensure symlink is pointing at the directory
+	Tracer.phase('cleanup')
+	try:
+		# Record what the live release looks like, so the next incremental build
+		# can tell whether it's safe to build on top of it
+		if PostReceiveInstance.incrementalRelease == True:
+			try:
+				PostReceiveInstance.releaseBuilder().writeManifest(PostReceiveInstance.newCommitID, os.path.join(PostReceiveInstance.locAppBundle, PostReceiveInstance.newCommitID))
+			except:
+				Output.line(Formatter('Failed writing release manifest; next build will be a full checkout').color('yellow').indent())
+
+		# Retire releases the retention policy lets go of (see releaseCollector());
+		# they're deleted after the hook is done, unless releaseCleanup is 'inline'
 		try:
-			# First, delete symlink if it already exists
-			if FileSystem.isSymlink(PostReceiveInstance.symlinkPointer):
-				FileSystem.remove(PostReceiveInstance.symlinkPointer)
-			# Now create the symlink. NOTE: instead of placing PostReceiveInstance.locAppBundle + ...newCommitID,
-			# we are just doing _application/ so that the symlink is a RELATIVE path
-			FileSystem.genSymlink(('_application/' + PostReceiveInstance.newCommitID), PostReceiveInstance.symlinkPointer)
-			# Show output
-			Output.line(Formatter('Symlinked to release').indent())
+			collector = PostReceiveInstance.releaseCollector()
+			collector.recordActivation(PostReceiveInstance.newCommitID)
+			retired = collector.retire(PostReceiveInstance.newCommitID)
+			PostReceiveInstance.releaseBuilder().purgeManifestsExcept([PostReceiveInstance.newCommitID])
+			Output.line(Formatter('Retired %s old release(s); %s kept' % (len(retired), len(collector.releases()))).indent())
 		except:
-			raise Exception('EMERGENCY: Failed creating symlink pointer to latest release')
+			collector = None
+			Output.line(Formatter('Failed retiring old releases, no biggie').color('yellow'))
 
-		# Purge stale (previous) deploys
+		# Trim the composer cache; vendor builds of releases still around stay
 		try:
-			FileSystem.purgeOtherDirectoriesInDirectoryExcept(PostReceiveInstance.locAppBundle, [PostReceiveInstance.newCommitID])
-			Output.line(Formatter('Purged old deploys').indent())
+			composerCache = PostReceiveInstance.composerCache()
+			composerCache.evict(PostReceiveInstance.vendorHashesInUse())
+			# Only reported when the composer phase went through the cache (there
+			# was a lock file to look up)
+			if composerCache.stats['hits'] + composerCache.stats['misses'] > 0:
+				composerCache.writeStats()
+				Output.line(Formatter('Composer cache: %(hits)s hit(s), %(misses)s miss(es), %(evicted)s evicted' % composerCache.stats).indent())
+			elif composerCache.stats['evicted'] > 0:
+				composerCache.writeStats()
+			# Packages only evicted vendor builds were linking to go too
+			packageStore = PostReceiveInstance.packageStore()
+			if composerCache.stats['evicted'] > 0 and packageStore != None:
+				Output.line(Formatter('Package store: removed %s package(s) no longer in use' % packageStore.collectGarbage()).indent())
 		except:
-			Output.line(Formatter('Failed purging stale deploys, no biggie').color('yellow'))
+			Output.line(Formatter('Failed trimming composer cache, no biggie').color('yellow'))
+
+		# Replicas keep releases (and vendor dirs) by the same policy
+		if replicator != None:
+			for target in replicator.targets:
+				try:
+					targetCollector = target.retire(PostReceiveInstance.newCommitID, PostReceiveInstance.releasesKept, PostReceiveInstance.releaseMaxAge,
+						PostReceiveInstance.releaseDeleteRate, PostReceiveInstance.releaseDeleteIdle)
+					target.trimComposerCache(PostReceiveInstance.composerCacheMaxBytes, PostReceiveInstance.composerCacheMaxEntries)
+					if targetCollector.hasTrash():
+						if PostReceiveInstance.releaseCleanup == 'inline':
+							targetCollector.collect()
+						else:
+							targetCollector.spawn()
+				except:
+					Output.line(Formatter('%s: failed retiring old releases, no biggie' % target.name).color('yellow').indent())
+
+		# Retired releases get deleted, then objects only they were linking to
+		if collector != None and collector.hasTrash():
+			objectStore = PostReceiveInstance.releaseBuilder().objectStore
+			try:
+				if PostReceiveInstance.releaseCleanup == 'inline':
+					collector.collect()
+					Output.line(Formatter('Deleted retired releases: %s files (%s)' % (collector.stats['filesDeleted'], FileSystem.formatBytes(collector.stats['bytesFreed']))).indent())
+					if objectStore is not None:
+						removed, freed = objectStore.collectGarbage()
+						Output.line(Formatter('Object store GC: removed %s blobs (%s)' % (removed, FileSystem.formatBytes(freed))).indent())
+				else:
+					objectStoreDir = None
+					if objectStore is not None:
+						objectStoreDir = objectStore.storeDir
+					pid = collector.spawn(objectStoreDir, PostReceiveInstance.bareRepoPath)
+					Output.line(Formatter('Deleting retired releases in the background (pid %s; log in %s.log)' % (pid, collector.trashDir)).indent())
+			except:
+				Output.line(Formatter('Failed deleting retired releases, no biggie').color('yellow'))
 
 		# Notify this first step of stuff above is OK
 		Output.line(Formatter('Project build OK').color('green').indent())
@@ -237,66 +627,401 @@ def postReceiveRunner(PostReceiveInstance):
 		Output.line(Formatter(e).color('yellow').indent())
 		Output.line(Formatter('This occurred during final build phase :(').color('red'))
 
-	try:
-		Output.multiLine([
-			'',
-			Formatter('Rebooting web server').style(['bold']).arrowed()
-		])
-		# Note, this depends on a) the shell script is executable, and b) more importantly,
-		# that the user (probably git) executing this script has been given PASSWORDLESS
-		# sudo access to run the commands contained w/in restartapache.sh.
-		# So: $: touch /etc/sudoers.d/gitdeploys
-		# $: sudo visudo /etc/sudoers.d/gitdeploys
-		# and add this line:
-		# {user}	ALL=NOPASSWD:/etc/init.d/apache2 stop, /etc/init.d/apache2 start
-		# whereas user probably = git
-		# Also, to eliminate the could not reliably determine hostname, setup
-		# servername.conf in /etc/apache2/conf-available with
-		# ServerName localhost
-		# then sudo a2enconf servername
-		restartApacheShellScript = os.path.join(PostReceiveInstance.repoHooksPath, 'restartapache.sh')
-		subproc = subprocess.Popen(restartApacheShellScript, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-		for line in iter(subproc.stdout.readline, ''):
-			Output.line(Formatter(line.rstrip()).indent())
-		for line in iter(subproc.stderr.readline, ''):
-			Output.line(Formatter(line.rstrip()).color('red').indent())
-		subproc.communicate()[0]
-		if subproc.returncode != 0:
-			Output.line(Formatter('Apache failed to restart!').color('red').style(['bold', 'underline']).indent())
-		else:
-			Output.line(Formatter('Apache restarted').color('green').indent())
-
-	except Exception as e:
-		Output.line(Formatter(e).color('red').indent())
-
 	# NOTICE, this is the LAST thing in the function
 	Output.line('')
-	sys.exit(0)
 
 # NOTE: since PreReceive gets the same arguments passed by stdin, in the
 # same order form Git, its OK to extend the PreReceive class. THAT IS NOW ALWAYS 
 # THE CASE with other Git hooks regarding whats passed to stdin.
 class PostReceive(PreReceive):
 
-	def __init__(self, inputs, settings={}):
+	# Default for buildfile key submodules.workers
+	SUBMODULE_WORKERS = 4
+
+	def _configure(self, settings):
+		super(PostReceive, self)._configure(settings)
 		# ensure trailing slash with '' at the end
 		self.buildDir 			= os.path.join(settings['buildDir'], '')
 		self.symlinkPointer		= os.path.join(self.buildDir, 'ln-release')
 		self.locPermanentDirs	= os.path.join(self.buildDir, '_permanent', '')
 		self.locAppBundle		= os.path.join(self.buildDir, '_application', '')
 		self.locComposerCache	= os.path.join(self.buildDir, '_composercache', '')
+		self.locManifests		= os.path.join(self.buildDir, '_manifests', '')
 		self.repoHooksPath		= settings['repoHooksPath']
 		self.bareRepoPath		= settings['bareRepoPath']
-		super(PostReceive, self).__init__(inputs)
+		# Bare mirrors of submodule remotes; long-lived and shareable between projects
+		self.submoduleCacheDir	= settings.get('submoduleCacheDir', os.path.join(tempfile.gettempdir(), 'deploy_coord', 'mirrors'))
+		# Build releases on top of the live one, writing only what changed
+		self.incrementalRelease	= settings.get('incrementalRelease', False)
+		# How the live release is copied: 'auto' (reflink if possible, else hardlink), 'reflink' or 'hardlink'
+		self.incrementalLinkMode = settings.get('incrementalLinkMode', 'auto')
+		# Limits for the composer cache (least recently used entries go first)
+		self.composerCacheMaxBytes	 = settings.get('composerCacheMaxBytes', None)
+		self.composerCacheMaxEntries = settings.get('composerCacheMaxEntries', None)
+		# Where outputs of build tasks are cached (see artifactCache()), and its limits
+		self.artifactCacheDir	= settings.get('artifactCacheDir', os.path.join(self.buildDir, '_artifactcache'))
+		self.artifactCacheMaxBytes	 = settings.get('artifactCacheMaxBytes', None)
+		self.artifactCacheMaxEntries = settings.get('artifactCacheMaxEntries', None)
+		self.artifactCacheCompress	 = settings.get('artifactCacheCompress', False)
+		# Share unchanged packages between vendor builds of different lock files
+		self.composerPackageStore = settings.get('composerPackageStore', True)
+		# Optional content-addressed store release files get hardlinked from
+		self.objectStoreDir		= settings.get('objectStoreDir', None)
+		# How the web server gets onto a new release, in order; see reloadStrategies()
+		self.reloadStrategyNames = settings.get('reload', ['script'])
+		# Optional probe of the new release, eg. {'url': 'http://127.0.0.1/health', 'host': 'example.com'}
+		self.healthCheck		= settings.get('healthCheck', None)
+		# Retention of old releases, and how they get deleted; see releaseCollector()
+		self.releasesKept		= settings.get('releasesKept', 3)
+		self.releaseMaxAge		= settings.get('releaseMaxAge', None)
+		self.releaseDeleteRate	= settings.get('releaseDeleteRate', 500)
+		self.releaseDeleteIdle	= settings.get('releaseDeleteIdle', True)
+		self.releaseCleanup		= settings.get('releaseCleanup', 'background')
+		# Where builds are put together (default <buildDir>/_staging), and the
+		# free space / inodes that have to be left after one; see stagingArea()
+		self.stagingDir			= settings.get('stagingDir', None)
+		self.stagingMinFreeBytes = settings.get('stagingMinFreeBytes', 100 * 1024 * 1024)
+		self.stagingMinFreeInodes = settings.get('stagingMinFreeInodes', 10000)
+		# Other build dirs the release goes to (and goes live in, together with
+		# this one), and how many are written at once; see replicator()
+		self.replicas			= settings.get('replicas', [])
+		self.replicaWorkers		= settings.get('replicaWorkers', 4)
+		# Warm the release up before it goes live (see warmup()); URLs are
+		# requested through a vhost serving ln-warmup
+		self.warmupSettings		= settings.get('warmup', None)
+		self.warmupPointer		= os.path.join(self.buildDir, 'ln-warmup')
 
+	# A single deploy runs right here; several (branches going to different
+	# environments in one push) run at the same time, each in its own work
+	# dirs, with each one's output written as a block once it's done
 	def _hookProcess(self):
-		postReceiveRunner(self)
+		deploys = self.deployTargets()
+		if len(deploys) == 0:
+			Output.multiLine([
+				'',
+				Formatter('No deployable branches in this push; but your push was recieved.').color('yellow'),
+				Formatter('Push completed').color('cyan'),
+				''
+			])
+			sys.exit(0)
+
+		buildDirs = [deploy.buildDir for deploy in deploys]
+		if len(set(buildDirs)) != len(buildDirs):
+			Output.line(Formatter('Several deploys in this push go to the same buildDir; nothing deployed').color('red'))
+			abortBuild()
+
+		if self.settings.get('deployQueue') != None:
+			self.enqueueDeploys(deploys)
+			sys.exit(0)
+
+		tracer 	 = Tracer.start()
+		profiler = None
+		if self.settings.get('profileDir') != None:
+			profiler = Profiler.start()
+		try:
+			if len(deploys) == 1:
+				self.runDeploy(deploys[0])
+				sys.exit(0)
+
+			pool = WorkerPool(len(deploys), failFast=False)
+			for deploy in deploys:
+				pool.submit(self.runGroupedDeploy, deploy)
+			jobs = pool.join()
+
+			Output.multiLine([
+				'',
+				Formatter('Deploys').style(['bold']).arrowed()
+			])
+			for deploy, job in zip(deploys, jobs):
+				status = {'done': 'deployed'}.get(job.status, 'failed')
+				color  = {'done': 'green'}.get(job.status, 'red')
+				Output.line(Formatter('%-16s %-24s %-9s %7.2fs' % (deploy.environmentName, deploy.branchName, status, job.duration())).color(color).indent())
+			Output.line('')
+			if len(pool.failures()) > 0:
+				sys.exit(1)
+			sys.exit(0)
+		finally:
+			self.finishTrace(deploys, tracer, profiler)
+
+	# Timing summary of the phases (hook setting traceSummary, on by default),
+	# plus the Chrome trace (traceDir) and cProfile stats (profileDir) if asked for
+	def finishTrace(self, deploys, tracer, profiler):
+		tracer.stop()
+		baseName = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), '-'.join(['%s-%s' % (deploy.environmentName, deploy.newCommitID[0:10]) for deploy in deploys]))
+		try:
+			if self.settings.get('traceSummary', True) == True:
+				Output.line(Formatter('Timing').style(['bold']).arrowed())
+				for line in tracer.summary():
+					Output.line(Formatter(line).indent())
+			if self.settings.get('traceDir') != None:
+				tracePath = os.path.join(self.settings['traceDir'], baseName + '.json')
+				tracer.writeChromeTrace(tracePath)
+				Output.line(Formatter('Trace written to %s (open in chrome://tracing)' % tracePath).indent())
+			if profiler != None:
+				profilePath = os.path.join(self.settings['profileDir'], baseName + '.pstats')
+				profiler.stop(profilePath)
+				Output.line(Formatter('Profile written to %s' % profilePath).indent())
+			Output.line('')
+		except Exception as e:
+			Output.line(Formatter('Failed writing trace: %s' % e).color('yellow').indent())
+
+	# Hands the deploys to the deploy daemon (see DeployDaemon) instead of
+	# building here. With deployQueueTail, follows their output until they're
+	# done (True), or for at most that many seconds; the deploys carry on
+	# regardless if the connection drops
+	def enqueueDeploys(self, deploys):
+		queue = DeployQueue(self.settings['deployQueue'])
+		queued = []
+		for deploy in deploys:
+			jobID = queue.enqueue(deploy.queueJob())
+			queued.append((deploy, jobID))
+			Output.line(Formatter(
+				"Deploy queued, branch: " +
+				Formatter(deploy.branchName).style('underline') +
+				Formatter(" [%s...]" % deploy.newCommitID[0:10]).color('cyan') +
+				" -> %s" % deploy.environmentName
+			).arrowed())
+
+		tail = self.settings.get('deployQueueTail', False)
+		if tail == False:
+			Output.line('')
+			return
+		timeout = None
+		if tail != True:
+			timeout = tail
+		for deploy, jobID in queued:
+			status = queue.follow(jobID, Output.write, timeout)
+			if status == None:
+				Output.line(Formatter('Still deploying; log: %s' % queue.logPathFor(jobID)).color('yellow').indent())
+			else:
+				color = {'deployed': 'green', 'superseded': 'cyan'}.get(status, 'red')
+				Output.line(Formatter('%s: %s' % (deploy.environmentName, status)).color(color).indent())
+		Output.line('')
+
+	# What the deploy daemon needs to run this deploy (settings without the
+	# queue's, and limited to this environment)
+	def queueJob(self):
+		settings = dict([(key, value) for key, value in self.settings.items() if key not in ['deployQueue', 'deployQueueTail']])
+		settings['environments'] = {self.environmentName: self.configuredEnvironments()[self.environmentName]}
+		return {
+			'key': DeployQueue.keyFor(self.environmentName, self.buildDir),
+			'environment': self.environmentName,
+			'branch': self.branchName,
+			'newCommitID': self.newCommitID,
+			'input': ' '.join(self.refUpdates[0]),
+			'settings': settings
+		}
+
+	def runDeploy(self, deploy):
+		with Tracer.span('deploy %s' % deploy.environmentName, branch=deploy.branchName, commit=deploy.newCommitID):
+			postReceiveRunner(deploy)
+
+	# Runs in a worker thread; abortBuild() ends just this deploy
+	def runGroupedDeploy(self, deploy):
+		Output.beginGroup()
+		try:
+			self.runDeploy(deploy)
+		finally:
+			Output.endGroup()
+
+	# Same repository for every environment
+	def gitDir(self):
+		return self.settings['bareRepoPath']
+
+	def releaseBuilder(self):
+		if hasattr(self, '_releaseBuilder') == False:
+			objectStore = None
+			if self.objectStoreDir != None:
+				objectStore = ObjectStore(self.objectStoreDir, self.objectReader())
+			self._releaseBuilder = ReleaseBuilder(self.objectReader(), self.locManifests, objectStore, self.exportFilter())
+		return self._releaseBuilder
+
+	# The buildfile's export.include / export.exclude rules (None without any)
+	def exportFilter(self):
+		if hasattr(self, '_exportFilter') == False:
+			self._exportFilter = self.exportFilterFor(self.parsedBuildFile())
+		return self._exportFilter
+
+	@staticmethod
+	def exportFilterFor(buildFile):
+		if buildFile == None or (buildFile.exportInclude == None and buildFile.exportExclude == None):
+			return None
+		return ExportFilter(buildFile.exportInclude, buildFile.exportExclude)
+
+	# Export rules of the buildfile commitID was built with
+	def exportFilterOf(self, commitID):
+		result = self.objectReader().read('%s:%s' % (commitID, self.BUILDFILE_NAME))
+		if result == None or result[1] != 'blob':
+			return None
+		try:
+			return self.exportFilterFor(BuildFile.fromString(result[2]))
+		except ValueError:
+			return None
+
+	# Keeps the live release, the releasesKept most recently activated ones
+	# (the live one included) and any activated less than releaseMaxAge
+	# seconds ago; the rest are deleted at releaseDeleteRate files a second,
+	# in the idle I/O class (releaseDeleteIdle)
+	def releaseCollector(self):
+		if hasattr(self, '_releaseCollector') == False:
+			self._releaseCollector = ReleaseCollector(self.buildDir, self.releasesKept, self.releaseMaxAge, self.releaseDeleteRate, self.releaseDeleteIdle)
+		return self._releaseCollector
+
+	# Builds are staged on the filesystem of the releases, so they're
+	# published (and vendor dirs moved into the composer cache) by renaming
+	def stagingArea(self):
+		if hasattr(self, '_stagingArea') == False:
+			self._stagingArea = StagingArea(self.buildDir, self.stagingDir)
+		return self._stagingArea
+
+	# The build's workspace in the staging area, per environment
+	def tmpDir(self):
+		if hasattr(self, '_tmpDir') == False:
+			self._tmpDir = self.stagingArea().workspaceFor(os.path.join(self.environmentName, self.newCommitID))
+		return self._tmpDir
+
+	def composerCache(self):
+		if hasattr(self, '_composerCache') == False:
+			self._composerCache = ComposerCache(self.locComposerCache, self.composerCacheMaxBytes, self.composerCacheMaxEntries)
+		return self._composerCache
+
+	# Outputs of build tasks declaring inputs and outputs, by a key of their
+	# inputs' blob SHAs, command and env (see ArtifactCache)
+	def artifactCache(self):
+		if hasattr(self, '_artifactCache') == False:
+			self._artifactCache = ArtifactCache(self.artifactCacheDir, self.artifactCacheMaxBytes, self.artifactCacheMaxEntries, self.artifactCacheCompress)
+		return self._artifactCache
+
+	# Packages by name, version and reference, kept in the composer cache dir;
+	# None with composerPackageStore off
+	def packageStore(self):
+		if self.composerPackageStore != True:
+			return None
+		if hasattr(self, '_packageStore') == False:
+			self._packageStore = PackageStore(os.path.join(self.locComposerCache, '.packages'))
+		return self._packageStore
+
+	# Each entry of the "reload" setting is one of:
+	#	'script'			the repo hooks' restartapache.sh (the default)
+	#	'apache-graceful'	apachectl graceful (through passwordless sudo)
+	#	'php-fpm'			reload php-fpm (through passwordless sudo)
+	#	'none'
+	#	{'command': [...]}	any command
+	#	{'url': '...'}		a URL to request, eg. a script calling opcache_reset()
+	# Note, sudo ones depend on the user (probably git) executing this having been
+	# given PASSWORDLESS sudo access to the commands. So: $: touch /etc/sudoers.d/gitdeploys
+	# $: sudo visudo /etc/sudoers.d/gitdeploys
+	# and add this line:
+	# {user}	ALL=NOPASSWD:/usr/sbin/apachectl graceful
+	# whereas user probably = git
+	# Also, to eliminate the could not reliably determine hostname, setup
+	# servername.conf in /etc/apache2/conf-available with
+	# ServerName localhost
+	# then sudo a2enconf servername
+	def reloadStrategies(self):
+		names = self.reloadStrategyNames
+		if not isinstance(names, list):
+			names = [names]
+		return [ReloadStrategy.fromSetting(name, self.repoHooksPath) for name in names]
+
+	def activator(self):
+		probe, probeTimeout, slowMs = None, 30, 1000
+		if self.healthCheck != None:
+			probe 		 = HealthProbe(self.healthCheck['url'], self.healthCheck.get('host'))
+			probeTimeout = self.healthCheck.get('timeout', probeTimeout)
+			slowMs 		 = self.healthCheck.get('slowMs', slowMs)
+		return Activator(self.symlinkPointer, self.reloadStrategies(), probe, probeTimeout, slowMs)
+
+	# Warmup of the release in releaseDir. The "warmup" setting is True (just
+	# the preload list), or a dict of:
+	#	'preload'		name of the preload script (default .opcache-preload.php), or False
+	#	'urls'			to request, eg. through a vhost serving ln-warmup
+	#	'host'			Host header for them
+	#	'concurrency'	how many are requested at once (default 4)
+	#	'timeout'		seconds activation waits at most (default 30)
+	def warmup(self, releaseDir):
+		warmupSettings = self.warmupSettings
+		if not isinstance(warmupSettings, dict):
+			warmupSettings = {}
+		preloadName = warmupSettings.get('preload', Warmup.PRELOAD_NAME)
+		if preloadName in [True, None]:
+			preloadName = Warmup.PRELOAD_NAME
+		elif preloadName == False:
+			preloadName = None
+		return Warmup(releaseDir, self.parsedBuildFile().composerWorkingDir, preloadName,
+			warmupSettings.get('urls', []), warmupSettings.get('host'),
+			warmupSettings.get('concurrency', 4), warmupSettings.get('timeout', 30))
+
+	# One target per entry of the "replicas" setting (see ReplicaTarget.fromSetting)
+	def replicator(self):
+		if hasattr(self, '_replicator') == False:
+			targets = [ReplicaTarget.fromSetting(replica, self.repoHooksPath) for replica in self.replicas]
+			self._replicator = Replicator(self.buildDir, targets, self.replicaWorkers, self.writablePaths())
+		return self._replicator
+
+	# Paths (relative to the project) the build may write to: composer's
+	# working dir, and each task's workingDir (the project root if not set)
+	# and outputs. Ones outside the project are left to fail the task
+	def writablePaths(self):
+		buildFile, paths = self.parsedBuildFile(), []
+		if buildFile.composer != None and buildFile.composerWorkingDir != None:
+			paths.append(buildFile.composerWorkingDir)
+		for spec in (buildFile.tasks or {}).values():
+			paths = paths + [spec.get('workingDir', '')] + spec.get('outputs', [])
+		return [os.path.normpath(path) for path in paths if not os.path.isabs(path) and os.path.normpath(path).split(os.sep)[0] != '..']
+
+	# What the composer phase's result (the vendor dir) depends on, for the
+	# keys of cached tasks depending on it: the blob SHA of composer.lock in
+	# the commit (see ReleaseBuilder.treeEntries). None if there isn't one
+	def composerResultKey(self, treeEntries):
+		composerWD = self.parsedBuildFile().composerWorkingDir
+		if self.parsedBuildFile().composer == None or composerWD == None:
+			return 'no composer'
+		lockPath = os.path.normpath(os.path.join(composerWD, 'composer.lock'))
+		for mode, size, path, sha in treeEntries:
+			if path == lockPath and self.parsedBuildFile().composerDev == False:
+				return 'composer.lock %s no-dev' % sha
+			if path == lockPath:
+				return 'composer.lock %s' % sha
+		return None
+
+	# Composer cache entries the releases under _application (the live one
+	# included) have their vendor dir symlinked to
+	def vendorHashesInUse(self):
+		inUse = []
+		composerWD = self.parsedBuildFile().composerWorkingDir
+		if composerWD == None or not os.path.isdir(self.locAppBundle):
+			return inUse
+		for release in os.listdir(self.locAppBundle):
+			vendorLink = os.path.join(self.locAppBundle, release, composerWD, 'vendor')
+			if FileSystem.isSymlink(vendorLink):
+				inUse.append(os.path.basename(os.path.normpath(os.readlink(vendorLink))))
+		return inUse
+
+	# Commit ID of the release ln-release currently points at (or None)
+	def liveCommitID(self):
+		if not FileSystem.isSymlink(self.symlinkPointer):
+			return None
+		return os.path.basename(os.path.normpath(os.readlink(self.symlinkPointer)))
 
 	def cloneProjectToTmpDir(self):
-		execCall = Git(['--work-tree=%s' % self.tmpDir(),
-			'checkout', '-f', self.newCommitID
-		])
-		return (execCall.process.returncode == 0)
+		builder = self.releaseBuilder()
+		if self.incrementalRelease == True:
+			liveCommitID = self.liveCommitID()
+			previousDir  = None
+			previousExportFilter = None
+			if liveCommitID != None:
+				previousDir = os.path.join(self.locAppBundle, liveCommitID)
+				previousExportFilter = self.exportFilterOf(liveCommitID)
+			if builder.incrementalCheckout(liveCommitID, previousDir, self.newCommitID, self.tmpDir(), self.incrementalLinkMode, previousExportFilter):
+				return True
+		return builder.fullCheckout(self.newCommitID, self.tmpDir())
+
+	# Whether the submodule at path can be left as the incremental build
+	# carried it over from the previous release
+	def submoduleIsCurrent(self, path):
+		builder = self.releaseBuilder()
+		return builder.mode == 'incremental' and path not in builder.changedGitlinks
 
 	def inspectSubmodules(self):
 		# if repo has submodules; it HAS to have .gitmodules in the root
@@ -320,31 +1045,56 @@ class PostReceive(PreReceive):
 		config = ConfigParser.SafeConfigParser(allow_no_value=True)
 		config.readfp(open(parseableTmpFile))
 
-		submodTempPaths = []
-		
-		# @todo: figure out the exact commit SHA1 to pull!
-		# http://stackoverflow.com/questions/16574625/how-do-i-add-files-in-git-to-the-path-of-a-former-submodule/16581096#16581096
+		submodCache = SubmoduleCache(self.submoduleCacheDir)
+
+		# Submodules are resolved and materialized concurrently; the first one
+		# to fail cancels the rest
+		workerCount = self.parsedBuildFile().submoduleWorkers
+		if workerCount == None:
+			workerCount = self.SUBMODULE_WORKERS
+		pool = WorkerPool(workerCount)
+		exportFilter = self.exportFilter()
 		for section in config.sections():
-			# Parsed path to submodule RELATIVE to repo root
-			_path 		= config.get(section, 'path')
-			
-			# Remote repo URL
-			_url 		= config.get(section, 'url')
-			
-			# Returns message w/ the status of the file target (in
-			# this case, its the path to the submodule) in format
-			# like "160000 commit {SHA} {path}"
-			_treeSpec	= Git([
-				'--git-dir', 
-				self.bareRepoPath,
-				'ls-tree',
-				'HEAD',
-				_path
-			])
-			
-			# Parse the response of the above system call and
-			# take the 3rd element in the array
-			_shaCommitID = _treeSpec.response.split()[2]
+			# Nothing in it would be exported
+			if exportFilter != None and not exportFilter.anyExportedUnder(config.get(section, 'path').strip('/')):
+				Output.line(Formatter('Submodule at path %s left out by export rules' % config.get(section, 'path')).indent())
+				continue
+			pool.submit(self.materializeSubmodule, pool, submodCache,
+				# Parsed path to submodule RELATIVE to repo root
+				config.get(section, 'path'),
+				# Remote repo URL
+				config.get(section, 'url')
+			)
+		pool.join()
+
+		Output.multiLine([
+			'',
+			Formatter('Cleaning up temp files').color('yellow').indent(),
+			''
+		])
+
+		# Remove the temporarily created parseableTmpFile
+		FileSystem.remove(parseableTmpFile)
+
+		failures = pool.failures()
+		if len(failures) > 0:
+			for job in failures:
+				if not isinstance(job.error, SystemExit):
+					Output.line(Formatter(str(job.error)).color('red').style(['bold', 'underline']).indent())
+			abortBuild()
+
+	# Runs in a worker thread (see inspectSubmodules); all of its output is
+	# grouped and written once the submodule is done, so it doesn't interleave
+	def materializeSubmodule(self, pool, submodCache, _path, _url):
+		Output.beginGroup()
+		try:
+			Tracer.phase('submodule %s' % _path)
+			# The gitlink entry (mode 160000, the submodule's commit SHA) at
+			# the path, in the commit being deployed
+			_treeEntry	= self.objectReader().entryAt(self.newCommitID, _path)
+			if _treeEntry == None or _treeEntry[0] != '160000':
+				raise Exception('No submodule commit found at path: %s' % _path)
+			_shaCommitID = _treeEntry[1]
 			
 			# Show whass going down...
 			Output.multiLine([
@@ -357,15 +1107,10 @@ class PostReceive(PreReceive):
 			# Full path where the submodule should exist, but in the tmp dir
 			# where the full repo has been cloned
 			fullProjectTmpBuildPath = os.path.join(self.tmpDir(), _path, '')
-			
-			# Temporary path where we clone the submodule repo
-			# so we can work on it
-			submodRepoCloneTmpPath = os.path.join(os.path.abspath(tempfile.gettempdir() + '/deploy_coord/submodules/%s' % _shaCommitID), '')
-			submodTempPaths.append(submodRepoCloneTmpPath)
-			
-			# If it already exists, nuke it so we're doing a fresh checkout...
-			if FileSystem.exists(submodRepoCloneTmpPath):
-				FileSystem.removeDir(submodRepoCloneTmpPath)
+
+			if self.submoduleIsCurrent(_path):
+				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Unchanged since previous release').indent())
+				return
 
 			# Handlers for streaming output from stdOut/stdErr
 			def cbStdOut(line):
@@ -373,63 +1118,37 @@ class PostReceive(PreReceive):
 			def cbStdErr(line):
 				Output.line(Formatter(line.rstrip()).indent())
 			processOptions = {
-				'streamResponse':True, 'receiveStdOut': cbStdOut, 'receiveStdErr': cbStdErr
+				'streamResponse':True, 'receiveStdOut': cbStdOut, 'receiveStdErr': cbStdErr,
+				# Kills the git process if another submodule fails meanwhile
+				'cancelEvent': pool.cancelEvent
 			}
 
-			# Actually clone the remote repo
-			cloneProc = Git([
-				'clone', 
-				_url, 
-				submodRepoCloneTmpPath
-			], processOptions)
-			if cloneProc.process.returncode != 0:
-				Output.line(Formatter('Clone failed!').color('red').style(['bold', 'underline']).indent())
-				abortBuild()
+			# Make sure the mirror has the commit (clones the mirror the first
+			# time a url is seen, fetches only if the SHA is missing)
+			pool.checkCancelled()
+			mirrorAction = submodCache.ensure(_url, _shaCommitID, processOptions)
+			if mirrorAction == 'cached':
+				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Using cached mirror').indent())
 			else:
-				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Cloned OK').indent())
-
-			# Check the repo out to specified commit ID
-			pullProc = Git([
-				'--git-dir=%s.git' % submodRepoCloneTmpPath,
-				'--work-tree=%s' % submodRepoCloneTmpPath, 
-				'checkout',
-				'-b',
-				_shaCommitID,
-				_shaCommitID
-			], processOptions)
-			if pullProc.process.returncode != 0:
-				Output.line(Formatter('Unable to checkout commit @ %s' % _shaCommitID).color('red').style(['bold', 'underline']).indent())
-				abortBuild()
-			else:
-				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Pulled target SHA OK').indent())
-
-			# Now run checkout-index (which works on the current head, ie. the
-			# the currently checked out branch); and copy everything to the destination
-			# of the full project build location
-			checkoutProc = Git([
-				'--git-dir=%s.git' % submodRepoCloneTmpPath,
-				'checkout-index',
-				'-a',
-				'-f',
-				'--prefix=%s' % fullProjectTmpBuildPath
-			], processOptions)
-			if checkoutProc.process.returncode != 0:
-				Output.line(Formatter('Unable to checkout index...').color('red').style(['bold', 'underline']).indent())
-				abortBuild()
-			else:
-				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Index Checked Out OK (Files Copied)').indent())
+				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Mirror %s OK' % mirrorAction).indent())
 
-			Output.line(Formatter('Submodule OK :)').color('green').indent())
+			# Copy the tree at the target commit straight from the mirror into
+			# the full project build location
+			pool.checkCancelled()
+			excluded = submodCache.checkout(_url, _shaCommitID, fullProjectTmpBuildPath, processOptions, self.exportFilter(), _path)
+			Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Index Checked Out OK (Files Copied)').indent())
+			if excluded > 0:
+				Output.line(Formatter('Export rules: %s path(s) left out' % excluded).indent())
 
-		Output.multiLine([
-			'',
-			Formatter('Cleaning up temp files').color('yellow').indent(),
-			''
-		])
-
-		# Remove temp directories
-		for tmpPath in submodTempPaths:
-			FileSystem.removeDir(tmpPath)
-
-		# Remove the temporarily created parseableTmpFile
-		FileSystem.remove(parseableTmpFile)
\ No newline at end of file
+			Output.line(Formatter('Submodule OK :)').color('green').indent())
+		except CancelledError:
+			Output.line(Formatter('Cancelled (another submodule failed)').color('yellow').indent())
+			raise
+		except Exception:
+			# Failed because its git process got killed after another submodule failed
+			if pool.isCancelled():
+				Output.line(Formatter('Cancelled (another submodule failed)').color('yellow').indent())
+				raise CancelledError('Cancelled')
+			raise
+		finally:
+			Output.endGroup()
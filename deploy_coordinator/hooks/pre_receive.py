@@ -1,29 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys
+import sys, os, time
 from deploy_coordinator.cli import Formatter, Output
 from deploy_coordinator.system.file_system import FileSystem
 from deploy_coordinator.system.parse_json import ParseJson
-from deploy_coordinator.system.execute import Git
+from deploy_coordinator.system.buildfile import BuildFile
+from deploy_coordinator.system.buildfile_cache import BuildFileCache
+from deploy_coordinator.system.execute import Executables, GitObjectReader
+from deploy_coordinator.system.export_filter import ExportFilter
+from deploy_coordinator.system.php_lint import PhpLint
 
 # How this works: the corresponding hook file in the git repo
 # just instantiates the PreReceive object declared below, and
-# the PreReceive init method passes itself to this function to
-# perform any logic / tasks
+# the PreReceive init method passes an instance per pushed branch
+# (see deployTargets) to this function to perform any logic / tasks
 def preReceiveRunner(PreReceiveInstance):
-	# If we're not on master branch, skip the rest of the pre-receive
-	if PreReceiveInstance.branchIsMaster() != True:
-		sys.exit(0)
-
-	# We are on master; try and clone the buildfile.json
-	if PreReceiveInstance.cloneBuildFileToTmpDir() != True:
+	# Read buildfile.json out of the pushed commit
+	if PreReceiveInstance.hasBuildFile() != True:
 		Output.multiLine([
 			'',
 			Formatter('Project must contain buildfile.json in the project root!').color('yellow').indent(),
 			Formatter('Commit aborted').color('red').style('bold').indent(),
 			''
 		])
-		PreReceiveInstance.cleanupTmpDir()
 		sys.exit(1)
 
 	# Attempt to parse the buildfile (which is cached) and see results
@@ -34,27 +33,61 @@ def preReceiveRunner(PreReceiveInstance):
 			'Push aborted',
 			''
 		])
-		PreReceiveInstance.cleanupTmpDir()
 		sys.exit(1)
 
-	# Check the buildfile contains a project name
-	projectName = PreReceiveInstance.parsedBuildFile().key('project.name')
-	if projectName == None:
-		Output.multiLine([
-			'',
-			'Buildfile ' + Formatter('must').color('red').style(['bold','underline']) + ' contain a project value',
-			Formatter('eg: {"project":{"name":"MyProject"},...}').color('yellow'),
-			Formatter('Push Aborted').color('red'),
-			''
-		])
-		PreReceiveInstance.cleanupTmpDir()
-		sys.exit(1)
+	# Check the buildfile against the schema (unless this exact buildfile
+	# passed already, on an earlier push); every problem is listed at once
+	if PreReceiveInstance.buildFileIsValidated() != True:
+		buildFile = PreReceiveInstance.parsedBuildFile()
+		for warning in buildFile.warnings:
+			Output.line(Formatter('Buildfile: %s' % warning).color('yellow'))
+		if buildFile.isValid() != True:
+			Output.multiLine([''] + [
+				Formatter('Buildfile: %s' % error).color('red') for error in buildFile.errors
+			] + [
+				Formatter('eg: {"project":{"name":"MyProject"},...}').color('yellow'),
+				Formatter('Push Aborted').color('red'),
+				''
+			])
+			sys.exit(1)
+		PreReceiveInstance.markBuildFileValidated()
+	projectName = PreReceiveInstance.parsedBuildFile().projectName
+	passed = ["Buildfile parsed OK (%s, branch %s)" % (str(projectName), PreReceiveInstance.branchName)]
+
+	# Lint the PHP files the push changes (when enabled, see phpLint()); every
+	# file with errors is listed at once
+	lint = PreReceiveInstance.phpLint()
+	if lint != None:
+		try:
+			lint.run(PreReceiveInstance.oldCommitID, PreReceiveInstance.newCommitID)
+		except Exception as e:
+			Output.multiLine([
+				'',
+				Formatter('PHP lint: %s' % e).color('red'),
+				Formatter('Push aborted').color('red'),
+				''
+			])
+			sys.exit(1)
+		if len(lint.unchecked()) > 0:
+			Output.line(Formatter('PHP lint: %s file(s) not linted within %ss' % (len(lint.unchecked()), lint.timeout)).color('yellow'))
+		if len(lint.failed()) > 0:
+			Output.multiLine([''] + [
+				Formatter('%s: %s' % (path, message)).color('red') for path, status, message in lint.failed()
+			] + [
+				Formatter('PHP lint: %s of %s changed file(s) failed' % (len(lint.failed()), len(lint.results))).color('red'),
+				Formatter('Push aborted').color('red'),
+				''
+			])
+			sys.exit(1)
+		passed.append("PHP lint OK (%s changed file(s), %.1fs)" % (len(lint.results) - len(lint.unchecked()), lint.duration))
 
 	# Commit can proceed to next steps
 	Output.multiLine([
 		'',
-		'-------------------------------------------------------',
-		" %s " % Formatter(Output.CHECKMARK).color('green') + "Buildfile parsed OK (%s)" % str(projectName),
+		'-------------------------------------------------------'
+	] + [
+		" %s " % Formatter(Output.CHECKMARK).color('green') + line for line in passed
+	] + [
 		'-------------------------------------------------------',
 	])
 
@@ -65,47 +98,210 @@ class PreReceive(object):
 
 	DEPLOYABLE_BRANCH 	= 'master'
 	BUILDFILE_NAME		= 'buildfile.json'
+	# What git passes as the new SHA when a ref is deleted
+	ZERO_SHA 			= '0' * 40
 
-	def __init__(self, inputs):
-		(
-			self.oldCommitID, 
-			self.newCommitID, 
-			self.commitRef
-		) = inputs.split()
-		self.branchName = self.commitRef.split('/')[-1]
+	# settings (optional for pre-receive):
+	#	executables		eg. {'git': '/usr/bin/git'}; otherwise looked up on the PATH (once)
+	#	buildFileCacheDir	where validated buildfiles are cached (by blob SHA)
+	#	environments	name: {'branch': ..., other settings}; see environments()
+	#	phpLint			True, or {'timeout': ..., 'workers': ..., 'exclude': [...]}; see phpLint()
+	#	output, outputSpoolDir, outputRateLimit	see configureOutput()
+	# The hook input can hold any number of ref updates (one per line); every
+	# one of them going to an environment gets checked (by the runner) on a
+	# separate instance, see deployTargets()
+	def __init__(self, inputs, settings={}):
+		Executables.configure(settings.get('executables', {}))
+		self.configureOutput(settings)
+		self.settings 	= settings
+		self.refUpdates = self.parseRefUpdates(inputs)
 		self._hookProcess()
 
+	# How output is written: 'tty' (the default; colored, for git to relay to
+	# the pushing terminal), 'plain' (buffered, for remotes that aren't a
+	# terminal) or 'json' (an event per line; subprocess output limited to
+	# outputRateLimit lines per second, each). With outputSpoolDir, every
+	# event of the run is also kept there, in full
+	def configureOutput(self, settings):
+		spoolFile = None
+		if settings.get('outputSpoolDir') != None:
+			if not os.path.isdir(settings['outputSpoolDir']):
+				os.makedirs(settings['outputSpoolDir'])
+			spoolFile = os.path.join(settings['outputSpoolDir'], '%s-%s-%s.ndjson' % (
+				time.strftime('%Y%m%d-%H%M%S'), self.__class__.__name__.lower(), os.getpid()))
+		Output.configure(settings.get('output', 'tty'), spoolFile, settings.get('outputRateLimit', 50))
+
+	# Settings of one deploy (environment); extending classes add their own
+	def _configure(self, settings):
+		self.buildFileCacheDir = settings.get('buildFileCacheDir', None)
+		# Lint the PHP files a push changes before accepting it
+		self.phpLintSettings = settings.get('phpLint', None)
+
 	# Since _hookProcess gets called in init, and we want to
 	# have this class be extendable (post-receive), but that will
 	# call a different function, we make this method overrideable
 	# so the extending class can implement a call to its own
 	# ...Runner() method.
 	def _hookProcess(self):
-		preReceiveRunner(self)
+		for deploy in self.deployTargets():
+			preReceiveRunner(deploy)
+
+	# (oldCommitID, newCommitID, ref) per line of hook input; deleted refs
+	# are left out, there's nothing to deploy
+	@classmethod
+	def parseRefUpdates(cls, inputs):
+		refUpdates = []
+		for line in inputs.splitlines():
+			fields = line.split()
+			if len(fields) != 3 or fields[1] == cls.ZERO_SHA:
+				continue
+			refUpdates.append(tuple(fields))
+		return refUpdates
+
+	# name: settings for every environment. Each entry of the "environments"
+	# setting is layered over the rest of the settings, eg.
+	#	{'production': {'branch': 'master'},
+	#	 'staging': {'branch': 'staging', 'buildDir': '/var/www/app-staging'}}
+	# Without it, DEPLOYABLE_BRANCH deploys to "production" with the settings as-is.
+	def environments(self):
+		environments = {}
+		for name, overrides in self.configuredEnvironments().items():
+			environmentSettings = dict([(key, value) for key, value in self.settings.items() if key != 'environments'])
+			environmentSettings.update(overrides)
+			environments[name] = environmentSettings
+		return environments
 
-	def branchIsMaster(self):
-		return self.branchName == self.DEPLOYABLE_BRANCH
+	# The "environments" setting as given (or the default)
+	def configuredEnvironments(self):
+		configured = self.settings.get('environments', None)
+		if configured == None:
+			configured = {'production': {'branch': self.DEPLOYABLE_BRANCH}}
+		return configured
+
+	# One instance per (ref update, environment the branch goes to), in
+	# environment name order; pushes to other refs are ignored
+	def deployTargets(self):
+		targets = []
+		environments = self.environments()
+		for refUpdate in self.refUpdates:
+			if not refUpdate[2].startswith('refs/heads/'):
+				continue
+			branchName = refUpdate[2][len('refs/heads/'):]
+			for name in sorted(environments.keys()):
+				if environments[name].get('branch') == branchName:
+					targets.append(self.forEnvironment(name, environments[name], refUpdate))
+		return targets
+
+	# A configured instance for one deploy (without running the hook again);
+	# deploys share the repository's cat-file session
+	def forEnvironment(self, name, settings, refUpdate):
+		deploy = self.__class__.__new__(self.__class__)
+		deploy.settings 		= self.settings
+		deploy.refUpdates 		= [refUpdate]
+		deploy.environmentName 	= name
+		(
+			deploy.oldCommitID,
+			deploy.newCommitID,
+			deploy.commitRef
+		) = refUpdate
+		deploy.branchName 		= deploy.commitRef[len('refs/heads/'):]
+		deploy._objectReader 	= self.objectReader()
+		deploy._configure(settings)
+		return deploy
+
+	# The repository being pushed to; hooks run inside it (git sets GIT_DIR)
+	def gitDir(self):
+		return os.path.abspath(os.environ.get('GIT_DIR', os.getcwd()))
+
+	# Shared cat-file session for object/tree lookups in the repository
+	def objectReader(self):
+		if hasattr(self, '_objectReader') == False:
+			self._objectReader = GitObjectReader(self.gitDir())
+		return self._objectReader
 
 	# @todo: error checking if temp dir creation failed...
+	# Per environment, so deploys of the same commit don't share it
 	def tmpDir(self):
 		if hasattr(self,'_tmpDir') == False:
-			self._tmpDir = FileSystem.tempDirFor(self.newCommitID)
+			self._tmpDir = FileSystem.tempDirFor(os.path.join('builds', self.environmentName, self.newCommitID))
 		return self._tmpDir
 
-	def cloneBuildFileToTmpDir(self):
-		execCall = Git(['--work-tree=%s' % self.tmpDir(),
-			'checkout', '-f', self.newCommitID, self.BUILDFILE_NAME
-		])
-		return (execCall.process.returncode == 0)
-
 	def cleanupTmpDir(self):
 		FileSystem.removeDir(self.tmpDir())
 
-	# @return instance of ParseJson
+	# (blobSHA, contents) of buildfile.json in the pushed commit, read
+	# straight out of the object database; None if there isn't one
+	def buildFileBlob(self):
+		if hasattr(self, '_buildFileBlob') == False:
+			self._buildFileBlob = None
+			result = self.objectReader().read('%s:%s' % (self.newCommitID, self.BUILDFILE_NAME))
+			if result != None and result[1] == 'blob':
+				self._buildFileBlob = (result[0], result[2])
+		return self._buildFileBlob
+
+	def hasBuildFile(self):
+		return self.buildFileBlob() != None
+
+	# In the repository by default, where only whoever can push already
+	# writes (see BuildFileCache)
+	def buildFileCache(self):
+		if hasattr(self, '_buildFileCache') == False:
+			cacheDir = self.buildFileCacheDir
+			if cacheDir == None:
+				cacheDir = os.path.join(self.gitDir(), 'deploy_coord', 'buildfiles')
+			self._buildFileCache = BuildFileCache(cacheDir)
+		return self._buildFileCache
+
+	# @return instance of BuildFile (see .errors); from the cache if this
+	# buildfile was validated before, otherwise compiled from the blob. None
+	# if it isn't a JSON object
 	def parsedBuildFile(self):
 		if hasattr(self, '_parsedBuildFile') == False:
-			try:
-				self._parsedBuildFile = ParseJson(self.tmpDir() + self.BUILDFILE_NAME)
-			except ValueError, e:
-				self._parsedBuildFile = None
-		return self._parsedBuildFile
\ No newline at end of file
+			self._parsedBuildFile 		= None
+			self._buildFileValidated 	= False
+			blob = self.buildFileBlob()
+			if blob != None:
+				self._parsedBuildFile = BuildFile.unserialize(self.buildFileCache().load(blob[0]))
+				if self._parsedBuildFile != None:
+					self._buildFileValidated = True
+				else:
+					try:
+						parsed = ParseJson.fromString(blob[1])
+						if isinstance(parsed.data, dict):
+							self._parsedBuildFile = BuildFile.compile(parsed.data)
+					except ValueError, e:
+						pass
+		return self._parsedBuildFile
+
+	def buildFileIsValidated(self):
+		self.parsedBuildFile()
+		return self._buildFileValidated
+
+	# Remember the buildfile passed; later pushes of it skip validation
+	def markBuildFileValidated(self):
+		if self.parsedBuildFile() != None and self.parsedBuildFile().isValid() and self._buildFileValidated != True:
+			self.buildFileCache().store(self.buildFileBlob()[0], self.parsedBuildFile().serialize())
+			self._buildFileValidated = True
+
+	# PhpLint for the files this push changes, or None unless the phpLint
+	# setting is on. Files the buildfile's export rules leave out aren't
+	# linted (they don't get deployed), nor ones matching its "exclude"
+	# patterns (same syntax, eg. tests/fixtures/)
+	def phpLint(self):
+		if hasattr(self, '_phpLint') == False:
+			self._phpLint = None
+			lintSettings = self.phpLintSettings
+			if lintSettings == True:
+				lintSettings = {}
+			if isinstance(lintSettings, dict):
+				buildFile 	 = self.parsedBuildFile()
+				include, exclude = None, list(lintSettings.get('exclude', []))
+				if buildFile != None:
+					include  = buildFile.exportInclude
+					exclude += buildFile.exportExclude or []
+				exportFilter = None
+				if include != None or len(exclude) > 0:
+					exportFilter = ExportFilter(include, exclude)
+				self._phpLint = PhpLint(self.gitDir(), self.objectReader(),
+					lintSettings.get('workers'), lintSettings.get('timeout', 30), exportFilter)
+		return self._phpLint
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, time, threading, urllib2
+from deploy_coordinator.system.execute import Execute
+from deploy_coordinator.system.tracer import Tracer
+
+# Ways to get the web server onto a new release once ln-release points at it.
+# Each strategy below has a reload(onLine), returning (ok, message); lines of
+# output go to onLine(line).
+class ReloadStrategy(object):
+
+	# The strategy for one entry of the "reload" hook setting (see
+	# PostReceive.reloadStrategies); 'script' runs restartapache.sh out of
+	# repoHooksPath
+	@staticmethod
+	def fromSetting(name, repoHooksPath=None):
+		if isinstance(name, dict) and name.get('command') != None:
+			return CommandReload(name['command'])
+		elif isinstance(name, dict) and name.get('url') != None:
+			return UrlReload(name['url'])
+		elif name == 'script':
+			if repoHooksPath == None:
+				raise Exception('Reload strategy "script" needs the repo hooks path (restartapache.sh)')
+			return ScriptReload(os.path.join(repoHooksPath, 'restartapache.sh'))
+		elif name == 'apache-graceful':
+			return CommandReload(['sudo', '-n', 'apachectl', 'graceful'])
+		elif name == 'php-fpm':
+			return CommandReload(['sudo', '-n', 'service', 'php-fpm', 'reload'])
+		elif name == 'none':
+			return NoReload()
+		raise Exception('Unknown reload strategy: %s' % name)
+
+
+# Runs a shell script, eg. the repo hooks' restartapache.sh (the original
+# behaviour; whether that's a stop/start or a graceful reload is up to it)
+class ScriptReload(ReloadStrategy):
+
+	def __init__(self, scriptPath):
+		self.scriptPath = scriptPath
+
+	def reload(self, onLine):
+		proc = Execute(['/bin/sh', '-c', self.scriptPath], {
+			'streamResponse': True, 'receiveStdOut': onLine, 'receiveStdErr': onLine
+		})
+		if proc.returncode != 0:
+			return (False, '%s exited with status %s' % (os.path.basename(self.scriptPath), proc.returncode))
+		return (True, '%s OK' % os.path.basename(self.scriptPath))
+
+
+# Runs a command, eg. a graceful reload (workers finish their requests first)
+class CommandReload(ReloadStrategy):
+
+	def __init__(self, args, timeout=60):
+		self.args 	 = args
+		self.timeout = timeout
+
+	def reload(self, onLine):
+		proc = Execute(self.args, {
+			'streamResponse': True, 'receiveStdOut': onLine, 'receiveStdErr': onLine, 'timeout': self.timeout
+		})
+		if proc.returncode != 0:
+			return (False, '%s exited with status %s' % (' '.join(self.args), proc.returncode))
+		return (True, '%s OK' % ' '.join(self.args))
+
+
+# Requests a URL, eg. a script calling opcache_reset() (opcache is per
+# server, so it has to be reset from inside it)
+class UrlReload(ReloadStrategy):
+
+	def __init__(self, url, timeout=10):
+		self.url 	 = url
+		self.timeout = timeout
+
+	def reload(self, onLine):
+		try:
+			response = urllib2.urlopen(self.url, timeout=self.timeout)
+			response.read()
+			return (True, '%s OK (%s)' % (self.url, response.getcode()))
+		except (urllib2.URLError, IOError) as e:
+			return (False, '%s failed: %s' % (self.url, e))
+
+
+class NoReload(ReloadStrategy):
+
+	def reload(self, onLine):
+		return (True, 'No reload')
+
+
+# GETs a (local) URL; healthy on a 2xx/3xx within timeout seconds. host
+# sets the Host header, for probing a vhost through 127.0.0.1
+class HealthProbe(object):
+
+	def __init__(self, url, host=None, timeout=2.0):
+		self.url 	 = url
+		self.host 	 = host
+		self.timeout = timeout
+
+	# (ok, detail, milliseconds)
+	def check(self):
+		request = urllib2.Request(self.url)
+		if self.host != None:
+			request.add_header('Host', self.host)
+		startedAt = time.time()
+		try:
+			response = urllib2.urlopen(request, timeout=self.timeout)
+			response.read()
+			status = response.getcode()
+			return (200 <= status < 400, 'HTTP %s' % status, (time.time() - startedAt) * 1000)
+		except urllib2.HTTPError as e:
+			return (False, 'HTTP %s' % e.code, (time.time() - startedAt) * 1000)
+		except (urllib2.URLError, IOError) as e:
+			return (False, str(e), (time.time() - startedAt) * 1000)
+
+	# Checks until healthy, or until deadline (seconds from now) passes;
+	# returns the last (ok, detail, milliseconds)
+	def waitUntilHealthy(self, deadline, interval=0.25):
+		giveUpAt = time.time() + deadline
+		while True:
+			result = self.check()
+			if result[0] or time.time() >= giveUpAt:
+				return result
+			time.sleep(interval)
+
+
+# Probes continuously (in a thread) while a release is being activated, to
+# tell how long the site was down (failing probes) or degraded (probes slower
+# than slowMs). Each probe accounts for the time until the next one started.
+class AvailabilityMonitor(object):
+
+	def __init__(self, probe, interval=0.05, slowMs=1000):
+		self.probe 		= probe
+		self.interval 	= interval
+		self.slowMs 	= slowMs
+		# (startedAt, ok, milliseconds)
+		self.samples 	= []
+		self._stop 		= threading.Event()
+		self._thread 	= None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread != None:
+			self._thread.join()
+		self._stoppedAt = time.time()
+
+	def unavailableMs(self):
+		return self._total(lambda ok, ms: not ok)
+
+	def degradedMs(self):
+		return self._total(lambda ok, ms: ok and ms > self.slowMs)
+
+	def _total(self, counts):
+		total = 0.0
+		for index, (startedAt, ok, ms) in enumerate(self.samples):
+			if not counts(ok, ms):
+				continue
+			if index + 1 < len(self.samples):
+				total += (self.samples[index + 1][0] - startedAt) * 1000
+			else:
+				total += (self._stoppedAt - startedAt) * 1000
+		return total
+
+	def _run(self):
+		while not self._stop.is_set():
+			startedAt 		= time.time()
+			ok, detail, ms 	= self.probe.check()
+			self.samples.append((startedAt, ok, ms))
+			self._stop.wait(self.interval)
+
+
+# Puts a release live: ln-release is swapped in one rename (a temp link
+# renamed over it, so there's always a release live), then the reload
+# strategies run in order. With a probe, the release has to be healthy within
+# probeTimeout seconds, or the previous release is swapped back (and reloaded).
+class Activator(object):
+
+	def __init__(self, symlinkPointer, strategies=[], probe=None, probeTimeout=30, slowMs=1000):
+		self.symlinkPointer = symlinkPointer
+		self.strategies 	= strategies
+		self.probe 			= probe
+		self.probeTimeout 	= probeTimeout
+		self.slowMs 		= slowMs
+		self.previousTarget = None
+		self.reverted 		= False
+		self.report 		= {'swapMs': 0.0, 'unavailableMs': None, 'degradedMs': None, 'probe': None, 'reloads': []}
+
+	# Points the link at target, atomically; returns what it pointed at before
+	def swap(self, target):
+		previous = None
+		if os.path.islink(self.symlinkPointer):
+			previous = os.readlink(self.symlinkPointer)
+		tmpLink = '%s.tmp-%s' % (self.symlinkPointer, os.getpid())
+		if os.path.lexists(tmpLink):
+			os.remove(tmpLink)
+		os.symlink(target, tmpLink)
+		os.rename(tmpLink, self.symlinkPointer)
+		return previous
+
+	def reload(self, onLine):
+		results = []
+		for strategy in self.strategies:
+			with Tracer.span('reload %s' % strategy.__class__.__name__):
+				ok, message = strategy.reload(onLine)
+			results.append((ok, message))
+			if not ok:
+				break
+		self.report['reloads'] += results
+		return len(results) == 0 or results[-1][0]
+
+	# Returns True if target is live (and healthy, if probed), False if it
+	# failed the probe (and got reverted, if there was a release before it).
+	# A failed reload alone doesn't fail it; see report['reloads']. Raises if
+	# the swap itself failed (nothing changed then)
+	def activate(self, target, onLine=lambda line: None):
+		monitor = None
+		if self.probe != None:
+			monitor = AvailabilityMonitor(self.probe, slowMs=self.slowMs)
+			monitor.start()
+		try:
+			startedAt = time.time()
+			self.previousTarget  = self.swap(target)
+			self.report['swapMs'] = (time.time() - startedAt) * 1000
+
+			self.reload(onLine)
+			if self.probe == None:
+				return True
+
+			with Tracer.span('health check'):
+				self.report['probe'] = self.probe.waitUntilHealthy(self.probeTimeout)
+			if self.report['probe'][0]:
+				return True
+
+			# Unhealthy; put the previous release back
+			if self.previousTarget != None:
+				with Tracer.span('revert'):
+					self.swap(self.previousTarget)
+					self.reload(onLine)
+					self.reverted = True
+					self.report['revertProbe'] = self.probe.waitUntilHealthy(self.probeTimeout)
+			return False
+		finally:
+			if monitor != None:
+				monitor.stop()
+				self.report['unavailableMs'] = monitor.unavailableMs()
+				self.report['degradedMs'] 	 = monitor.degradedMs()
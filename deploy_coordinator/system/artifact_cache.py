@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, json, hashlib, tarfile
+from deploy_coordinator.system.entry_cache import EntryCache
+from deploy_coordinator.system.export_filter import ExportFilter
+from deploy_coordinator.system.file_system import FileSystem
+
+# Outputs of build tasks, by a key of everything the task's result depends
+# on (see keyFor()): when the key is in the cache, the outputs are put in
+# place instead of running the task. What _composercache/<lock hash> does for
+# composer, for any task declaring "inputs" and "outputs".
+#
+# Entries are kept by EntryCache (a lock per key, entries published in one
+# rename, least recently used evicted above maxBytes / maxEntries, stats in
+# .stats.json). An entry holds the outputs as read-only hardlinks (see
+# FileSystem.linkTree(); restored as hardlinks too), or with compress, as one
+# outputs.tar.gz (smaller, nothing shared with the releases).
+class ArtifactCache(EntryCache):
+
+	# Part of every key; bumped when what goes into one changes
+	KEY_VERSION = 1
+	ARCHIVE_NAME = 'outputs.tar.gz'
+
+	def __init__(self, cacheDir, maxBytes=None, maxEntries=None, compress=False):
+		EntryCache.__init__(self, cacheDir, maxBytes, maxEntries)
+		self.compress = compress
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir)
+
+	# Key of a task (None if it can't be cached: no inputs or no outputs),
+	# from: its command, workingDir (relative to rootDir) and outputs, the
+	# values of the env vars it names, the blob SHAs of the paths in
+	# treeEntries (see ReleaseBuilder.treeEntries) its inputs match
+	# (submodules by their commit SHA), and the keys of the tasks it depends
+	# on. Nothing is read from disk. Inputs are patterns like export rules
+	# (see ExportFilter)
+	@classmethod
+	def keyFor(cls, task, rootDir, treeEntries, dependencyKeys=[], environ=os.environ):
+		if len(task.inputs) == 0 or len(task.outputs) == 0:
+			return None
+		inputs  = ExportFilter(task.inputs)
+		matched = []
+		for mode, size, path, sha in treeEntries:
+			if (mode == '160000' and inputs.anyExportedUnder(path)) or inputs.included(path):
+				matched.append([path, mode, sha])
+		return hashlib.sha1(json.dumps([
+			cls.KEY_VERSION, task.command, os.path.relpath(task.workingDir, rootDir), sorted(task.outputs),
+			[[name, environ.get(name)] for name in sorted(task.envNames)],
+			matched, list(dependencyKeys)
+		], sort_keys=True)).hexdigest()
+
+	# Puts the outputs stored under key in place in rootDir (anything at
+	# those paths is replaced); returns how many files
+	def restore(self, key, rootDir):
+		self.hit(key)
+		entryDir = self.pathFor(key)
+		fileHandle = open(os.path.join(entryDir, '.outputs.json'))
+		outputs = json.load(fileHandle)
+		fileHandle.close()
+		for output in outputs:
+			self._removePath(os.path.join(rootDir, output))
+		if os.path.isfile(os.path.join(entryDir, self.ARCHIVE_NAME)):
+			archive = tarfile.open(os.path.join(entryDir, self.ARCHIVE_NAME), 'r:gz')
+			try:
+				members = archive.getmembers()
+				archive.extractall(rootDir)
+			finally:
+				archive.close()
+			return len([member for member in members if member.isfile()])
+		restored = 0
+		for output in outputs:
+			restored += FileSystem.linkTree(os.path.join(entryDir, 'files', output), os.path.join(rootDir, output))
+		return restored
+
+	# Stores the outputs (paths relative to rootDir) under key; raises if
+	# one of them isn't there. Returns the entry's size in bytes
+	def store(self, key, rootDir, outputs):
+		for output in outputs:
+			if not os.path.lexists(os.path.join(rootDir, output)):
+				raise Exception('Output %s was not created' % output)
+		tmpPath = os.path.join(self.cacheDir, '.incoming-%s-%s' % (key, os.getpid()))
+		if os.path.lexists(tmpPath):
+			FileSystem.removeDir(tmpPath)
+		os.makedirs(tmpPath)
+		try:
+			if self.compress == True:
+				archive = tarfile.open(os.path.join(tmpPath, self.ARCHIVE_NAME), 'w:gz')
+				try:
+					for output in outputs:
+						archive.add(os.path.join(rootDir, output), output)
+				finally:
+					archive.close()
+			else:
+				for output in outputs:
+					FileSystem.linkTree(os.path.join(rootDir, output), os.path.join(tmpPath, 'files', output), True)
+			fileHandle = open(os.path.join(tmpPath, '.outputs.json'), 'w')
+			json.dump(list(outputs), fileHandle)
+			fileHandle.close()
+			size = self.dirSize(tmpPath)
+			self.publish(key, tmpPath)
+		except:
+			if os.path.lexists(tmpPath):
+				FileSystem.removeDir(tmpPath)
+			raise
+		return size
+
+	@staticmethod
+	def _removePath(path):
+		if os.path.islink(path) or os.path.isfile(path):
+			os.remove(path)
+		elif os.path.isdir(path):
+			FileSystem.removeDir(path)
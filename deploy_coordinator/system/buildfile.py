@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from deploy_coordinator.system.parse_json import ParseJson
+
+# A buildfile.json, compiled once: validated against FIELDS (every problem
+# at once, see compile()), with every value looked up in advance, both as the
+# attributes FIELDS names (eg. buildFile.composerWorkingDir) and by dotted
+# path for key() (eg. buildFile.key('composer.workingDir')).
+class BuildFile(ParseJson):
+
+	# Bumped whenever FIELDS changes, so buildfiles cached under the old
+	# rules get validated again
+	SCHEMA_VERSION = 4
+
+	# (path, type(s), required, attribute). A list of types means an array
+	# of those; * matches any key (eg. task names); required means required
+	# when its parent is there
+	FIELDS = [
+		('project', 					dict, 				True, 	None),
+		('project.name', 				basestring, 		True, 	'projectName'),
+		('storage', 					dict, 				False, 	None),
+		('storage.dirs', 				[basestring], 		False, 	'storageDirs'),
+		('composer', 					dict, 				False, 	'composer'),
+		('composer.workingDir', 		basestring, 		True, 	'composerWorkingDir'),
+		('composer.dev', 				bool, 				False, 	'composerDev'),
+		('submodules', 					dict, 				False, 	None),
+		('submodules.workers', 			int, 				False, 	'submoduleWorkers'),
+		('tasks', 						dict, 				False, 	'tasks'),
+		('tasks.*', 					dict, 				False, 	None),
+		('tasks.*.command', 			(basestring, list), True, 	None),
+		('tasks.*.workingDir', 			basestring, 		False, 	None),
+		('tasks.*.inputs', 				[basestring], 		False, 	None),
+		('tasks.*.dependsOn', 			[basestring], 		False, 	None),
+		('tasks.*.outputs', 			[basestring], 		False, 	None),
+		('tasks.*.env', 				[basestring], 		False, 	None),
+		('tasks.*.timeout', 			(int, float), 		False, 	None),
+		('taskWorkers', 				int, 				False, 	'taskWorkers'),
+		('export', 						dict, 				False, 	None),
+		('export.include', 				[basestring], 		False, 	'exportInclude'),
+		('export.exclude', 				[basestring], 		False, 	'exportExclude')
+	]
+
+	TYPE_NAMES = {dict: 'an object', basestring: 'a string', int: 'an integer', (int, float): 'a number', list: 'an array', bool: 'true/false'}
+
+	def __init__(self, data, errors=[], warnings=[]):
+		ParseJson.__init__(self, data=data)
+		self.errors 	= list(errors)
+		self.warnings 	= list(warnings)
+		self._values 	= {}
+		self._flatten(data, '')
+		for path, types, required, attribute in self.FIELDS:
+			if attribute is not None:
+				setattr(self, attribute, self._values.get(path))
+
+	# Validates data and compiles it; problems end up in .errors (the
+	# buildfile can't be used) and .warnings (unknown keys, ignored)
+	@classmethod
+	def compile(cls, data):
+		errors, warnings = [], []
+		if not isinstance(data, dict):
+			return cls({}, ['Buildfile must be an object'])
+		cls._validate(data, '', errors, warnings)
+		return cls(data, errors, warnings)
+
+	@classmethod
+	def fromString(cls, jsonString):
+		return cls.compile(ParseJson.fromString(jsonString).data)
+
+	def isValid(self):
+		return len(self.errors) == 0
+
+	def key(self, key):
+		return self._values.get(key)
+
+	# What the buildfile cache keeps (see BuildFileCache); only for valid
+	# buildfiles, which load back without being validated again
+	def serialize(self):
+		return {'schema': self.SCHEMA_VERSION, 'data': self.data, 'warnings': self.warnings}
+
+	@classmethod
+	def unserialize(cls, serialized):
+		if not isinstance(serialized, dict) or serialized.get('schema') != cls.SCHEMA_VERSION or not isinstance(serialized.get('data'), dict):
+			return None
+		return cls(serialized['data'], [], serialized.get('warnings', []))
+
+	def _flatten(self, value, path):
+		if path != '':
+			self._values[path] = value
+		if isinstance(value, dict):
+			for name, child in value.items():
+				self._flatten(child, name if path == '' else '%s.%s' % (path, name))
+
+	@classmethod
+	def _validate(cls, value, path, errors, warnings):
+		for name in sorted(value.keys()):
+			childPath = name if path == '' else '%s.%s' % (path, name)
+			field = cls._fieldFor(childPath)
+			if field is None:
+				warnings.append('Unknown key "%s" (ignored)' % childPath)
+				continue
+			if not cls._typeMatches(value[name], field[1]):
+				errors.append('"%s" must be %s' % (childPath, cls._typeName(field[1])))
+				continue
+			if isinstance(value[name], dict):
+				cls._validate(value[name], childPath, errors, warnings)
+		for required in cls._requiredUnder(path):
+			if required not in value:
+				errors.append('"%s" is required' % (required if path == '' else '%s.%s' % (path, required)))
+
+	@classmethod
+	def _fieldFor(cls, path):
+		parts = path.split('.')
+		for field in cls.FIELDS:
+			fieldParts = field[0].split('.')
+			if len(fieldParts) == len(parts) and all([fieldPart in ['*', part] for fieldPart, part in zip(fieldParts, parts)]):
+				return field
+		return None
+
+	# Names of the required keys directly under path
+	@classmethod
+	def _requiredUnder(cls, path):
+		parts = path.split('.') if path != '' else []
+		names = []
+		for field in cls.FIELDS:
+			fieldParts = field[0].split('.')
+			if field[2] and len(fieldParts) == len(parts) + 1 and all([fieldPart in ['*', part] for fieldPart, part in zip(fieldParts, parts)]):
+				names.append(fieldParts[-1])
+		return names
+
+	@classmethod
+	def _typeMatches(cls, value, types):
+		if isinstance(types, list):
+			return isinstance(value, list) and all([cls._typeMatches(item, types[0]) for item in value])
+		# JSON true/false aren't numbers here
+		if isinstance(value, bool):
+			return types is bool or (isinstance(types, tuple) and bool in types)
+		return isinstance(value, types)
+
+	@classmethod
+	def _typeName(cls, types):
+		if isinstance(types, list):
+			return 'an array of %s' % cls._typeName(types[0]).split(' ', 1)[1] + 's'
+		if isinstance(types, tuple) and types not in cls.TYPE_NAMES:
+			return ' or '.join([cls.TYPE_NAMES[_type] for _type in types])
+		return cls.TYPE_NAMES[types]
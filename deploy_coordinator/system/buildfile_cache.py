@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, stat, marshal
+from deploy_coordinator.system.file_system import FileSystem
+
+# Compiled buildfiles (BuildFile.serialize()), keyed by the blob SHA of
+# buildfile.json, ie. by its contents. Only buildfiles that passed pre-receive
+# validation are stored, so finding one means the push needn't validate it
+# again (and post-receive needn't parse it again). Stored with marshal, which
+# loads a good deal faster than JSON parses.
+#
+# Since what's found here is trusted, the dir is created private (0700), and
+# entries are only loaded if both the dir and the entry belong to this user
+# and nobody else can write to them.
+class BuildFileCache(object):
+
+	def __init__(self, cacheDir):
+		self.cacheDir = os.path.join(cacheDir, '')
+
+	def pathFor(self, blobSHA):
+		return os.path.join(self.cacheDir, '%s.marshal' % blobSHA)
+
+	# What was stored, or None if not cached (or unreadable, or not trusted)
+	def load(self, blobSHA):
+		try:
+			if not self.isPrivate(os.path.normpath(self.cacheDir)) or not self.isPrivate(self.pathFor(blobSHA)):
+				return None
+			fileHandle = open(self.pathFor(blobSHA), 'rb')
+			try:
+				return marshal.load(fileHandle)
+			finally:
+				fileHandle.close()
+		except (IOError, OSError, EOFError, ValueError, TypeError):
+			return None
+
+	# Written under a temp name and renamed, so readers never see half a file
+	def store(self, blobSHA, data):
+		if not os.path.isdir(self.cacheDir):
+			try:
+				os.makedirs(self.cacheDir, 0700)
+			except OSError:
+				pass
+		tmpPath = os.path.join(self.cacheDir, '.tmp-%s-%s' % (os.getpid(), blobSHA))
+		fileHandle = open(tmpPath, 'wb')
+		try:
+			marshal.dump(data, fileHandle)
+		finally:
+			fileHandle.close()
+		os.rename(tmpPath, self.pathFor(blobSHA))
+
+	# Owned by this user, and not writable by anyone else
+	@staticmethod
+	def isPrivate(path):
+		stats = os.lstat(path)
+		return stats.st_uid == os.geteuid() and not stat.S_ISLNK(stats.st_mode) and stats.st_mode & (stat.S_IWGRP | stat.S_IWOTH) == 0
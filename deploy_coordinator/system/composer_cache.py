@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from deploy_coordinator.system.entry_cache import EntryCache
+
+# Manages _composercache/<composer.lock hash> vendor builds, as an EntryCache
+# keyed by the lock file's hash: a deploy of a lock file another deploy is
+# building waits for that build, then uses it, and vendor dirs of releases
+# still kept are protected from eviction (see PostReceive.vendorHashesInUse)
+class ComposerCache(EntryCache):
+	pass
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, json, time, hashlib
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.file_system import FileSystem
+
+# Spool directory queue of deploys, shared by post-receive hooks (which
+# enqueue) and the deploy daemon (which runs them):
+#	pending/<key>/<jobID>.json	queued deploys; key identifies the project
+#								(environment + buildDir)
+#	running/<key>.json			the deploy in progress for a project (at most one)
+#	results/<jobID>.json		exit status, written by the process running the deploy
+#	done/<jobID>.json			finished, failed, superseded or interrupted deploys
+#								(and invalid ones, whose pending file couldn't be read)
+#	logs/<jobID>.log			the deploy's output
+# Changes happen under .lock and files appear by rename, so any number of
+# hooks (and daemons) can share the directory.
+class DeployQueue(object):
+
+	POLL_INTERVAL = 0.5
+
+	def __init__(self, spoolDir):
+		self.spoolDir = os.path.join(spoolDir, '')
+		for subDir in ['pending', 'running', 'results', 'done', 'logs']:
+			path = os.path.join(self.spoolDir, subDir)
+			if not os.path.isdir(path):
+				try:
+					os.makedirs(path)
+				except OSError:
+					pass
+
+	@staticmethod
+	def keyFor(environmentName, buildDir):
+		return '%s-%s' % (environmentName, hashlib.sha1(buildDir).hexdigest()[0:12])
+
+	def lock(self):
+		return FileLock(os.path.join(self.spoolDir, '.lock'))
+
+	def logPathFor(self, jobID):
+		return os.path.join(self.spoolDir, 'logs', '%s.log' % jobID)
+
+	# job is a dict with at least a 'key'; returns the new job's ID (which
+	# sorts by time queued)
+	def enqueue(self, job):
+		job = dict(job)
+		job['queuedAt'] = time.time()
+		job['jobID'] 	= '%017.6f-%s' % (job['queuedAt'], os.getpid())
+		with self.lock():
+			self._writeJSON(os.path.join(self.spoolDir, 'pending', job['key'], '%s.json' % job['jobID']), job)
+		return job['jobID']
+
+	def pendingKeys(self):
+		pendingDir = os.path.join(self.spoolDir, 'pending')
+		return sorted([key for key in os.listdir(pendingDir) if len(self._pendingFor(key)) > 0])
+
+	# Takes the newest pending deploy of the project, if nothing is running
+	# for it; everything queued before it is obsolete and marked superseded.
+	# Pending files that can't be read are marked invalid (see
+	# _discardInvalid) and the next newest is taken instead. Returns the job
+	# (now running) or None
+	def claim(self, key):
+		with self.lock():
+			runningPath = self._runningPathFor(key)
+			pending 	= self._pendingFor(key)
+			if os.path.exists(runningPath):
+				return None
+			job = None
+			while job == None and len(pending) > 0:
+				job = self._readJob(pending[-1])
+				if job == None:
+					self._discardInvalid(key, pending.pop())
+			if job == None:
+				return None
+			for path in pending[:-1]:
+				superseded = self._readJob(path)
+				if superseded == None:
+					self._discardInvalid(key, path)
+					continue
+				superseded.update({'status': 'superseded', 'supersededBy': job['jobID'], 'endedAt': time.time()})
+				self._writeJSON(self._donePathFor(superseded['jobID']), superseded)
+				FileSystem.remove(path)
+			job['startedAt'] = time.time()
+			job['attempts']  = job.get('attempts', 0) + 1
+			self._writeJSON(runningPath, job)
+			FileSystem.remove(pending[-1])
+		return job
+
+	def runningJobs(self):
+		runningDir = os.path.join(self.spoolDir, 'running')
+		jobs = []
+		for name in sorted(os.listdir(runningDir)):
+			if name.endswith('.json') and not name.startswith('.'):
+				job = self._readJSON(os.path.join(runningDir, name))
+				if job != None:
+					jobs.append(job)
+		return jobs
+
+	def runningJob(self, key):
+		return self._readJSON(self._runningPathFor(key))
+
+	def updateRunning(self, key, values):
+		with self.lock():
+			job = self._readJSON(self._runningPathFor(key))
+			if job != None:
+				job.update(values)
+				self._writeJSON(self._runningPathFor(key), job)
+
+	# Moves the project's running deploy to done/ with status
+	def finish(self, key, status):
+		with self.lock():
+			job = self._readJSON(self._runningPathFor(key))
+			if job == None:
+				return None
+			job.update({'status': status, 'endedAt': time.time()})
+			self._writeJSON(self._donePathFor(job['jobID']), job)
+			FileSystem.remove(self._runningPathFor(key))
+		return job
+
+	# Puts the project's running deploy back in the queue (same jobID)
+	def requeue(self, key):
+		with self.lock():
+			job = self._readJSON(self._runningPathFor(key))
+			if job == None:
+				return None
+			self._writeJSON(os.path.join(self.spoolDir, 'pending', key, '%s.json' % job['jobID']), job)
+			FileSystem.remove(self._runningPathFor(key))
+		return job
+
+	def hasNewerPending(self, key, jobID):
+		return len([path for path in self._pendingFor(key) if os.path.basename(path)[:-5] > jobID]) > 0
+
+	def writeResult(self, jobID, returncode):
+		self._writeJSON(os.path.join(self.spoolDir, 'results', '%s.json' % jobID), {'returncode': returncode, 'endedAt': time.time()})
+
+	def result(self, jobID):
+		return self._readJSON(os.path.join(self.spoolDir, 'results', '%s.json' % jobID))
+
+	def doneJob(self, jobID):
+		return self._readJSON(self._donePathFor(jobID))
+
+	# Hands the job's log to write(chunk) as it grows, until the job is done;
+	# returns its final status, or None if timeout (seconds) ran out first
+	def follow(self, jobID, write, timeout=None):
+		startedAt, offset = time.time(), 0
+		while True:
+			doneJob = self.doneJob(jobID)
+			if os.path.exists(self.logPathFor(jobID)):
+				fileHandle = open(self.logPathFor(jobID), 'rb')
+				fileHandle.seek(offset)
+				chunk = fileHandle.read()
+				fileHandle.close()
+				if chunk:
+					write(chunk)
+					offset += len(chunk)
+			if doneJob != None:
+				return doneJob['status']
+			if timeout != None and time.time() - startedAt > timeout:
+				return None
+			time.sleep(self.POLL_INTERVAL)
+
+	# Removes records and logs of deploys that ended more than maxAge seconds ago
+	def prune(self, maxAge):
+		cutoff = time.time() - maxAge
+		for subDir in ['done', 'results', 'logs']:
+			path = os.path.join(self.spoolDir, subDir)
+			for name in os.listdir(path):
+				fullPath = os.path.join(path, name)
+				if os.path.getmtime(fullPath) < cutoff:
+					FileSystem.remove(fullPath)
+
+	def _pendingFor(self, key):
+		keyDir = os.path.join(self.spoolDir, 'pending', key)
+		if not os.path.isdir(keyDir):
+			return []
+		return [os.path.join(keyDir, name) for name in sorted(os.listdir(keyDir)) if name.endswith('.json') and not name.startswith('.')]
+
+	# The job in a pending file, or None if it can't be read (eg. truncated)
+	def _readJob(self, path):
+		job = self._readJSON(path)
+		if not isinstance(job, dict) or not isinstance(job.get('jobID'), basestring):
+			return None
+		return job
+
+	# Moves a pending file that can't be read to done/<jobID>.invalid, with
+	# a done/<jobID>.json of status invalid for whoever follows the job
+	def _discardInvalid(self, key, path):
+		jobID = os.path.basename(path)[:-5]
+		self._writeJSON(self._donePathFor(jobID), {'jobID': jobID, 'key': key, 'status': 'invalid', 'endedAt': time.time()})
+		os.rename(path, os.path.join(self.spoolDir, 'done', '%s.invalid' % jobID))
+
+	def _runningPathFor(self, key):
+		return os.path.join(self.spoolDir, 'running', '%s.json' % key)
+
+	def _donePathFor(self, jobID):
+		return os.path.join(self.spoolDir, 'done', '%s.json' % jobID)
+
+	@staticmethod
+	def _readJSON(path):
+		try:
+			fileHandle = open(path)
+			try:
+				return json.load(fileHandle)
+			finally:
+				fileHandle.close()
+		except (IOError, ValueError):
+			return None
+
+	@staticmethod
+	def _writeJSON(path, data):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		tmpPath = os.path.join(os.path.dirname(path), '.tmp-%s-%s' % (os.getpid(), os.path.basename(path)))
+		fileHandle = open(tmpPath, 'w')
+		json.dump(data, fileHandle)
+		fileHandle.close()
+		os.rename(tmpPath, path)
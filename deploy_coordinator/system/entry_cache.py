@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, json, time
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.file_system import FileSystem
+
+# Bookkeeping of a cache of directories by key (cacheDir/<key>), eg. composer
+# vendor builds (ComposerCache) or build task outputs (ArtifactCache):
+# - builds of the same key are serialized through a per-key lock, so a
+#   second deploy waits for the first build and then uses it
+# - entries are published atomically (temp name in the cache dir, then rename)
+# - access times and sizes are tracked in an index, and least recently used
+#   entries are evicted above maxBytes / maxEntries
+# - hit/miss/eviction stats are written out to .stats.json
+# Everything the cache keeps for itself starts with a '.', so it never
+# collides with a key.
+class EntryCache(object):
+
+	INDEX_NAME 	= '.cacheindex.json'
+	STATS_NAME 	= '.stats.json'
+	LOCKS_DIR 	= '.locks'
+	# Entries used within this many seconds are never evicted; an in-flight
+	# build might be about to go live with them
+	MIN_AGE 	= 3600
+
+	def __init__(self, cacheDir, maxBytes=None, maxEntries=None):
+		self.cacheDir 	= os.path.join(cacheDir, '')
+		self.maxBytes 	= maxBytes
+		self.maxEntries = maxEntries
+		self.stats 		= {'hits': 0, 'misses': 0, 'waits': 0, 'evicted': 0, 'evictedBytes': 0}
+
+	def pathFor(self, key):
+		return os.path.join(self.cacheDir, key)
+
+	def exists(self, key):
+		return FileSystem.exists(self.pathFor(key))
+
+	def lockFor(self, key):
+		return FileLock(os.path.join(self.cacheDir, self.LOCKS_DIR, '%s.lock' % key))
+
+	def _indexLock(self):
+		return FileLock(os.path.join(self.cacheDir, self.LOCKS_DIR, 'index.lock'))
+
+	# Takes the key's lock, waiting for whoever holds it (another deploy
+	# building the same entry); returns the held lock
+	def acquire(self, key, onWait=None):
+		lock = self.lockFor(key)
+		if lock.acquire(blocking=False) != True:
+			self.stats['waits'] += 1
+			if onWait is not None:
+				onWait()
+			lock.acquire()
+		return lock
+
+	# Record a use of an existing entry
+	def hit(self, key):
+		self.stats['hits'] += 1
+		self._record(key)
+
+	# Move a freshly built dir into the cache under key; the entry appears
+	# in one rename, never half copied
+	def publish(self, key, sourceDir):
+		self.stats['misses'] += 1
+		size 	= self.dirSize(sourceDir)
+		tmpPath = os.path.join(self.cacheDir, '.tmp-%s-%s' % (key, os.getpid()))
+		if os.path.lexists(tmpPath):
+			FileSystem.removeDir(tmpPath)
+		FileSystem.mvFromTo(sourceDir, tmpPath)
+		os.rename(tmpPath, self.pathFor(key))
+		self._record(key, size)
+
+	# Evict least recently used entries until within limits. Entries in
+	# protect (eg. ones retained releases use), entries used recently and
+	# entries someone holds the lock for are never touched.
+	def evict(self, protect=[]):
+		if self.maxBytes == None and self.maxEntries == None:
+			return
+		with self._indexLock():
+			index = self._loadIndex()
+			# Entries on disk the index doesn't know about (created before
+			# the index existed); sized once, then remembered
+			for item in os.listdir(self.cacheDir):
+				if item.startswith('.') or item in index or not os.path.isdir(self.pathFor(item)):
+					continue
+				index[item] = {'lastAccess': os.path.getmtime(self.pathFor(item)), 'bytes': self.dirSize(self.pathFor(item))}
+			# ...and the other way around
+			for key in index.keys():
+				if not self.exists(key):
+					del index[key]
+
+			totalBytes = sum([entry['bytes'] for entry in index.values()])
+			now = time.time()
+			for key in sorted(index.keys(), key=lambda item: index[item]['lastAccess']):
+				overBytes 	= self.maxBytes != None and totalBytes > self.maxBytes
+				overEntries = self.maxEntries != None and len(index) > self.maxEntries
+				if not overBytes and not overEntries:
+					break
+				if key in protect or now - index[key]['lastAccess'] < self.MIN_AGE:
+					continue
+				lock = self.lockFor(key)
+				if lock.acquire(blocking=False) != True:
+					continue
+				try:
+					# Rename first so the entry disappears in one step
+					trashPath = os.path.join(self.cacheDir, '.evicted-%s-%s' % (key, os.getpid()))
+					os.rename(self.pathFor(key), trashPath)
+					FileSystem.removeDir(trashPath)
+				finally:
+					lock.release()
+				self.stats['evicted'] 		+= 1
+				self.stats['evictedBytes'] 	+= index[key]['bytes']
+				totalBytes -= index[key]['bytes']
+				del index[key]
+			self._saveIndex(index)
+
+	# Writes this deploy's stats and running totals
+	def writeStats(self):
+		with self._indexLock():
+			statsPath = os.path.join(self.cacheDir, self.STATS_NAME)
+			totals = {}
+			try:
+				fileHandle = open(statsPath)
+				totals = json.load(fileHandle).get('totals', {})
+				fileHandle.close()
+			except (IOError, ValueError):
+				pass
+			for key, value in self.stats.items():
+				totals[key] = totals.get(key, 0) + value
+			fileHandle = open(statsPath + '.tmp', 'w')
+			json.dump({'lastDeploy': dict(self.stats, time=time.time()), 'totals': totals}, fileHandle)
+			fileHandle.close()
+			os.rename(statsPath + '.tmp', statsPath)
+
+	@staticmethod
+	def dirSize(path):
+		total = 0
+		for dirPath, dirNames, fileNames in os.walk(path):
+			for name in fileNames:
+				total += os.lstat(os.path.join(dirPath, name)).st_size
+		return total
+
+	# Hit rate over every deploy so far (from .stats.json), or None
+	def hitRate(self):
+		try:
+			fileHandle = open(os.path.join(self.cacheDir, self.STATS_NAME))
+			totals = json.load(fileHandle).get('totals', {})
+			fileHandle.close()
+		except (IOError, ValueError):
+			return None
+		looked = totals.get('hits', 0) + totals.get('misses', 0)
+		if looked == 0:
+			return None
+		return totals.get('hits', 0) / float(looked)
+
+	def _record(self, key, size=None):
+		with self._indexLock():
+			index = self._loadIndex()
+			entry = index.get(key, {})
+			entry['lastAccess'] = time.time()
+			if size != None:
+				entry['bytes'] = size
+			elif 'bytes' not in entry:
+				entry['bytes'] = self.dirSize(self.pathFor(key))
+			index[key] = entry
+			self._saveIndex(index)
+
+	def _loadIndex(self):
+		try:
+			fileHandle = open(os.path.join(self.cacheDir, self.INDEX_NAME))
+			index = json.load(fileHandle)
+			fileHandle.close()
+			return dict([(str(key), value) for key, value in index.items()])
+		except (IOError, ValueError):
+			return {}
+
+	def _saveIndex(self, index):
+		indexPath = os.path.join(self.cacheDir, self.INDEX_NAME)
+		fileHandle = open(indexPath + '.tmp', 'w')
+		json.dump(index, fileHandle)
+		fileHandle.close()
+		os.rename(indexPath + '.tmp', indexPath)
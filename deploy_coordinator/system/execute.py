@@ -1,43 +1,333 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import subprocess, sys
+import subprocess, sys, os, time, signal, threading, Queue, distutils.spawn
+from deploy_coordinator.system.tracer import Tracer
+from deploy_coordinator.cli import Output
 
+# Runs a command to completion on construction. stdout and stderr are
+# pumped at the same time (a process filling one pipe while we wait on
+# the other can't deadlock us), and are always available afterwards as
+# .response / .error. Options (none are shared between instances):
+#	streamResponse	True to also get each line as it arrives via...
+#	receiveStdOut	callable(line), and
+#	receiveStdErr	callable(line); called on the thread that created the Execute
+#	env				dict of extra environment variables
+#	cwd				working directory
+#	input			string written to the process' stdin
+#	timeout			wall-clock seconds; then the whole process group gets killed
+#	cancelEvent		threading.Event; setting it kills the process group too
+# Both hold until stdout and stderr are closed, which can be after the
+# command itself exited (something it started in the background still has
+# them open).
+# Every run records startedAt, endedAt, returncode, timedOut and cancelled,
+# and is a span ('exec') when tracing. Output written while it runs (eg. by
+# the callbacks) carries its command ID.
 class Execute(object):
 
-	options = {
+	DEFAULT_OPTIONS = {
 		'streamResponse': False
 	}
 
+	# Seconds between SIGTERM and SIGKILL when killing a process group
+	KILL_GRACE 	  = 3
+	POLL_INTERVAL = 0.05
+
 	def __init__(self, args, options={}):
-		self.exec_args = args
+		self.exec_args 	= args
+		self.options 	= dict(self.DEFAULT_OPTIONS)
 		self.options.update(options)
-		self.__exec()
+		self.startedAt 	= None
+		self.endedAt 	= None
+		self.returncode = None
+		self.timedOut 	= False
+		self.cancelled 	= False
+		self._killedAt 	= None
+		with Tracer.span(self.traceName(), 'exec', args=' '.join(args)) as span:
+			commandID = Output.beginCommand(args)
+			try:
+				self.__exec()
+			finally:
+				Output.endCommand(commandID, self.returncode)
+			if span is not None:
+				span.args['returncode'] = self.returncode
+
+	# eg. "git read-tree": the program and the first argument that isn't an option
+	def traceName(self):
+		name = os.path.basename(self.exec_args[0])
+		for arg in self.exec_args[1:]:
+			if not arg.startswith('-'):
+				return '%s %s' % (name, os.path.basename(arg))
+		return name
+
+	def duration(self):
+		if self.startedAt is None or self.endedAt is None:
+			return 0.0
+		return self.endedAt - self.startedAt
+
+	def record(self):
+		return {
+			'args': self.exec_args,
+			'startedAt': self.startedAt,
+			'endedAt': self.endedAt,
+			'returncode': self.returncode,
+			'timedOut': self.timedOut,
+			'cancelled': self.cancelled
+		}
 
-	# @todo: error handling
 	def __exec(self):
-		self.process = subprocess.Popen(self.exec_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		
-		if self.options['streamResponse'] is not True:
-			self.response, self.error = self.process.communicate()
+		# Extra environment variables are layered on top of the current env
+		env = None
+		if self.options.get('env') is not None:
+			env = dict(os.environ)
+			env.update(self.options['env'])
+		# Data to feed to the process on stdin (eg. for --stdin style commands)
+		stdin = None
+		if self.options.get('input') is not None:
+			stdin = subprocess.PIPE
+
+		self.startedAt = time.time()
+		# Own process group (session), so a timeout can kill everything the
+		# command spawned; close_fds so children don't inherit our lock files
+		self.process = subprocess.Popen(self.exec_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+			env=env, cwd=self.options.get('cwd'), preexec_fn=os.setsid, close_fds=True)
+
+		lines = Queue.Queue()
+		pumps = [
+			threading.Thread(target=self._pump, args=(self.process.stdout, 'stdout', lines)),
+			threading.Thread(target=self._pump, args=(self.process.stderr, 'stderr', lines))
+		]
+		for pump in pumps:
+			pump.daemon = True
+			pump.start()
+
+		if stdin is not None:
+			try:
+				self.process.stdin.write(self.options['input'])
+				self.process.stdin.close()
+			except IOError:
+				# Process exited without reading everything; returncode tells
+				pass
+
+		collected = {'stdout': [], 'stderr': []}
+		callbacks = {}
+		if self.options['streamResponse'] is True:
+			callbacks = {'stdout': self.options.get('receiveStdOut'), 'stderr': self.options.get('receiveStdErr')}
+
+		# Lines are handed over through the queue so the callbacks run on
+		# this thread (which matters for Output groups)
+		openPipes = 2
+		while openPipes > 0:
+			try:
+				stream, line = lines.get(timeout=self.POLL_INTERVAL)
+			except Queue.Empty:
+				self._enforceLimits()
+				continue
+			if line is None:
+				openPipes -= 1
+				continue
+			collected[stream].append(line)
+			if callbacks.get(stream) is not None:
+				callbacks[stream](line)
+			self._enforceLimits()
+
+		while self.process.poll() is None:
+			self._enforceLimits()
+			time.sleep(self.POLL_INTERVAL)
+		for pump in pumps:
+			pump.join()
+
+		self.endedAt 	= time.time()
+		self.returncode = self.process.returncode
+		self.response 	= ''.join(collected['stdout'])
+		self.error 		= ''.join(collected['stderr'])
+
+	@staticmethod
+	def _pump(pipe, stream, lines):
+		for line in iter(pipe.readline, ''):
+			lines.put((stream, line))
+		pipe.close()
+		lines.put((stream, None))
+
+	# Also once the process itself exited: the rest of its session may still
+	# hold the pipes open (the group outlives its leader)
+	def _enforceLimits(self):
+		if self._killedAt is not None:
+			# Didn't go quietly
+			if time.time() - self._killedAt > self.KILL_GRACE:
+				self._signalGroup(signal.SIGKILL)
 			return
-		
+		timeout 	= self.options.get('timeout')
+		cancelEvent = self.options.get('cancelEvent')
+		if timeout is not None and time.time() - self.startedAt > timeout:
+			self.timedOut = True
+		elif cancelEvent is not None and cancelEvent.is_set():
+			self.cancelled = True
 		else:
-			for line in iter(self.process.stdout.readline, ''):
-				self.options['receiveStdOut'](line)
-			for line in iter(self.process.stderr.readline, ''):
-				self.options['receiveStdErr'](line)
-			self.process.communicate()[0]
+			return
+		self._killedAt = time.time()
+		self._signalGroup(signal.SIGTERM)
+
+	def _signalGroup(self, signum):
+		try:
+			os.killpg(self.process.pid, signum)
+		except OSError:
+			# Already gone
+			pass
+
+
+# Looks up executables on the PATH once per process (instead of forking
+# `which` for every command). Paths can be pinned with configure(), eg.
+# from the hook settings: Executables.configure({'git': '/usr/bin/git'})
+class Executables(object):
+
+	_paths 		= {}
+	_overrides 	= {}
+	_lock 		= threading.Lock()
+
+	@classmethod
+	def configure(cls, overrides):
+		with cls._lock:
+			cls._overrides.update(overrides)
+
+	@classmethod
+	def resolve(cls, name):
+		with cls._lock:
+			if name in cls._overrides:
+				return cls._overrides[name]
+			if name not in cls._paths:
+				execPath = distutils.spawn.find_executable(name)
+				if execPath is None:
+					raise Exception('Unable to find executable: %s' % name)
+				cls._paths[name] = execPath
+			return cls._paths[name]
 
 
 class Git(Execute):
 
 	def __init__(self, args, options={}):
-		execPath = str(Execute(['which', 'git'], {'streamResponse': False}).response.strip())
-		super(Git, self).__init__([execPath] + args, options)
+		super(Git, self).__init__([Executables.resolve('git')] + args, options)
 
 
 class Composer(Execute):
 
 	def __init__(self, args, options={}):
-		execPath = str(Execute(['which', 'composer'], {'streamResponse': False}).response.strip())
-		super(Composer, self).__init__([execPath] + args, options)
\ No newline at end of file
+		super(Composer, self).__init__([Executables.resolve('composer')] + args, options)
+
+
+# Long-lived `git cat-file --batch` / `--batch-check` processes for one
+# repository, so looking up many objects (and tree entries) costs a pipe
+# round trip each rather than a git process each. The processes are started
+# on first use; safe to share between threads.
+class GitObjectReader(object):
+
+	def __init__(self, gitDir):
+		self.gitDir = gitDir
+		self._procs = {}
+		self._lock 	= threading.Lock()
+
+	def __del__(self):
+		self.close()
+
+	# (sha, type, size) or None if there is no such object
+	def info(self, objectName):
+		with self._lock:
+			proc = self._process('--batch-check')
+			proc.stdin.write(objectName + '\n')
+			proc.stdin.flush()
+			header = proc.stdout.readline().split()
+		if len(header) != 3:
+			return None
+		return (header[0], header[1], int(header[2]))
+
+	def exists(self, objectName):
+		return self.info(objectName) is not None
+
+	# (sha, type, contents) or None if there is no such object
+	def read(self, objectName):
+		chunks = []
+		result = self.readInto(objectName, chunks.append)
+		if result is None:
+			return None
+		return (result[0], result[1], ''.join(chunks))
+
+	# Streams the object's contents to write(chunk) instead of holding it
+	# in memory; returns (sha, type, size) or None
+	def readInto(self, objectName, write):
+		with self._lock:
+			proc = self._process('--batch')
+			proc.stdin.write(objectName + '\n')
+			proc.stdin.flush()
+			header = proc.stdout.readline().split()
+			if len(header) != 3:
+				return None
+			remaining = int(header[2])
+			try:
+				while remaining > 0:
+					chunk = proc.stdout.read(min(remaining, 1048576))
+					if not chunk:
+						raise Exception('Unexpected end of object %s' % objectName)
+					write(chunk)
+					remaining -= len(chunk)
+				# Trailing newline after the contents
+				proc.stdout.read(1)
+			except:
+				# The rest of the object would be read as the next reply; the
+				# next call starts a new process instead
+				self._discard('--batch')
+				raise
+		return (header[0], header[1], int(header[2]))
+
+	# Entries of a tree object as a list of (mode, name, sha)
+	def treeEntries(self, treeish):
+		result = self.read(treeish)
+		if result is None or result[1] != 'tree':
+			return None
+		entries, data, offset = [], result[2], 0
+		# Binary format: "<mode> <name>\0<20 byte sha>" per entry
+		while offset < len(data):
+			nullAt 		= data.index('\0', offset)
+			mode, name 	= data[offset:nullAt].split(' ', 1)
+			sha 		= data[nullAt + 1:nullAt + 21].encode('hex')
+			entries.append((mode.rjust(6, '0'), name, sha))
+			offset = nullAt + 21
+		return entries
+
+	# (mode, sha) of path in commit, or None. Unlike "<commit>:<path>" this
+	# also works for submodules (gitlinks), whose commits aren't in this repo
+	def entryAt(self, commitID, path):
+		parentDir, name = os.path.split(path.strip('/'))
+		if parentDir == '':
+			treeish = '%s^{tree}' % commitID
+		else:
+			treeish = '%s:%s' % (commitID, parentDir)
+		for mode, entryName, sha in self.treeEntries(treeish) or []:
+			if entryName == name:
+				return (mode, sha)
+		return None
+
+	def close(self):
+		with self._lock:
+			for proc in self._procs.values():
+				try:
+					proc.stdin.close()
+					proc.wait()
+				except (IOError, OSError):
+					pass
+			self._procs = {}
+
+	def _discard(self, mode):
+		proc = self._procs.pop(mode, None)
+		if proc is None:
+			return
+		try:
+			proc.kill()
+			proc.wait()
+		except OSError:
+			pass
+
+	def _process(self, mode):
+		if mode not in self._procs:
+			self._procs[mode] = subprocess.Popen(
+				[Executables.resolve('git'), '--git-dir=%s' % self.gitDir, 'cat-file', mode],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+		return self._procs[mode]
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import re, posixpath
+
+# Which paths of a commit get written into a release (buildfile keys
+# export.include / export.exclude), decided before anything is written.
+# Patterns work like gitattributes' export-ignore ones:
+#	tests, *.md		no slash: matches a file or dir of that name at any depth
+#	/docs, web/src	a slash (other than a trailing one): relative to the root
+#	build/			trailing slash: only matches directories
+#	*, ?			don't match a /; ** does (eg. web/**/*.scss)
+# A pattern matching a directory covers everything under it. With include
+# patterns, only what (or whose directory) matches one is exported; exclude
+# patterns then leave things out of that. Paths are relative to the project
+# root, submodule contents included (eg. lib/sdk/tests). ALWAYS is exported
+# regardless, the hooks read it out of the build.
+class ExportFilter(object):
+
+	ALWAYS = ['buildfile.json', '.gitmodules']
+
+	# States of a directory (see _dirState)
+	EXCLUDED, INCLUDED, UNDECIDED = 'excluded', 'included', 'undecided'
+
+	def __init__(self, include=None, exclude=None):
+		self.include 	= list(include or [])
+		self.exclude 	= list(exclude or [])
+		self._includes 	= [self._compile(pattern) for pattern in self.include]
+		self._excludes 	= [self._compile(pattern) for pattern in self.exclude]
+		# dir path: state, filled as paths are checked
+		self._dirStates = {}
+
+	def __eq__(self, other):
+		return isinstance(other, ExportFilter) and (self.include, self.exclude) == (other.include, other.exclude)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def exported(self, path, isDir=False):
+		return path in self.ALWAYS or self.included(path, isDir)
+
+	# Whether the patterns alone let path through (ALWAYS aside), eg. to
+	# match a build task's inputs
+	def included(self, path, isDir=False):
+		state = self._dirState(posixpath.dirname(path))
+		if state == self.EXCLUDED or self._matches(self._excludes, path, isDir):
+			return False
+		return state == self.INCLUDED or self._matches(self._includes, path, isDir)
+
+	# Whether anything under dirPath can be exported (eg. whether a submodule
+	# there needs checking out at all)
+	def anyExportedUnder(self, dirPath):
+		state = self._dirState(dirPath)
+		if state != self.UNDECIDED:
+			return state == self.INCLUDED
+		parts = dirPath.split('/')
+		for regexes, anchoredParts, dirOnly in self._includes:
+			if anchoredParts is None:
+				return True
+			for index, part in enumerate(anchoredParts):
+				if part == '**':
+					return True
+				if index == len(parts):
+					return True
+				if not re.match(self._translate(part) + '$', parts[index]):
+					break
+		return False
+
+	def _dirState(self, dirPath):
+		if dirPath == '':
+			if len(self._includes) == 0:
+				return self.INCLUDED
+			return self.UNDECIDED
+		state = self._dirStates.get(dirPath)
+		if state is None:
+			state = self._dirState(posixpath.dirname(dirPath))
+			if state != self.EXCLUDED and self._matches(self._excludes, dirPath, True):
+				state = self.EXCLUDED
+			elif state == self.UNDECIDED and self._matches(self._includes, dirPath, True):
+				state = self.INCLUDED
+			self._dirStates[dirPath] = state
+		return state
+
+	@staticmethod
+	def _matches(patterns, path, isDir):
+		for regex, anchoredParts, dirOnly in patterns:
+			if (isDir or not dirOnly) and regex.match(path):
+				return True
+		return False
+
+	# (regex, the pattern's parts if it's anchored (else None), dirOnly)
+	@classmethod
+	def _compile(cls, pattern):
+		dirOnly  = pattern.endswith('/')
+		pattern  = pattern.rstrip('/')
+		anchored = '/' in pattern
+		pattern  = pattern.lstrip('/')
+		regex 	 = cls._translate(pattern)
+		if anchored:
+			return (re.compile(regex + '$'), pattern.split('/'), dirOnly)
+		return (re.compile('(?:.*/)?' + regex + '$'), None, dirOnly)
+
+	@staticmethod
+	def _translate(pattern):
+		regex, index = '', 0
+		while index < len(pattern):
+			if pattern.startswith('**/', index):
+				regex += '(?:.*/)?'
+				index += 3
+			elif pattern.startswith('**', index):
+				regex += '.*'
+				index += 2
+			elif pattern[index] == '*':
+				regex += '[^/]*'
+				index += 1
+			elif pattern[index] == '?':
+				regex += '[^/]'
+				index += 1
+			elif pattern[index] == '[' and pattern.find(']', index + 2) != -1:
+				end 	= pattern.find(']', index + 2)
+				chars 	= pattern[index + 1:end]
+				if chars.startswith('!'):
+					chars = '^' + chars[1:]
+				regex += '[%s]' % chars.replace('\\', '\\\\')
+				index = end + 1
+			else:
+				regex += re.escape(pattern[index])
+				index += 1
+		return regex
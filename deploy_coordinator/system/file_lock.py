@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, fcntl
+
+# Advisory (flock) lock on a file; the lock file itself is never removed
+# so every process agrees on the same inode. Take an exclusive lock for
+# anything that mutates the guarded resource, and a shared one to read it.
+# Usable as a context manager:
+#	with FileLock('/path/to/thing.lock'):
+#		...
+class FileLock(object):
+
+	def __init__(self, path, shared=False):
+		self.path 	 = path
+		self.shared  = shared
+		self._handle = None
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.release()
+
+	# Blocks until the lock is held, unless blocking=False in which case
+	# it returns False right away if someone else holds it
+	def acquire(self, blocking=True):
+		parentDir = os.path.dirname(self.path)
+		if parentDir and not os.path.exists(parentDir):
+			try:
+				os.makedirs(parentDir)
+			except OSError:
+				# Another process created it in the meantime
+				if not os.path.isdir(parentDir):
+					raise
+		self._handle = open(self.path, 'a')
+		mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+		if blocking != True:
+			mode = mode | fcntl.LOCK_NB
+		try:
+			fcntl.flock(self._handle.fileno(), mode)
+		except IOError:
+			self._handle.close()
+			self._handle = None
+			if blocking == True:
+				raise
+			return False
+		return True
+
+	def release(self):
+		if self._handle is None:
+			return
+		fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+		self._handle.close()
+		self._handle = None
+
+	def isHeld(self):
+		return self._handle is not None
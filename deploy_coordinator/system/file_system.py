@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys, os, shutil, tempfile
+import sys, os, stat, errno, shutil, tempfile
+from deploy_coordinator.system.tracer import traced
 
+# Every operation is a span ('fs') when tracing
 class FileSystem:
 
 	@classmethod
+	@traced('fs')
 	def tempDirFor(cls, name):
 		fullPath = tempfile.gettempdir() + '/deploy_coord/%s' % name + '/'
 		if not os.path.exists(fullPath):
@@ -12,47 +15,126 @@ class FileSystem:
 		return fullPath
 
 	@staticmethod
+	@traced('fs')
 	def removeDir(name):
 		shutil.rmtree(name)
 
 	@staticmethod
+	@traced('fs')
 	def mvFromTo(src,dst):
 		shutil.move(src,dst)
 
 	@staticmethod
+	@traced('fs')
 	def isSymlink(what):
 		return os.path.islink(what)
 
 	@staticmethod
+	@traced('fs')
 	def genSymlink(target, linkName):
 		os.symlink(target, linkName)
 
 	# File or symlink
 	@staticmethod
+	@traced('fs')
 	def remove(target):
 		os.remove(target)
 
-	# Purges only directories
+	# Replaces a file that has other hardlinks with a copy of its own (owner
+	# writable, like a checkout), so writing to it can't write through them
+	@staticmethod
+	def copyLinkedFile(fullPath):
+		stats = os.lstat(fullPath)
+		if not stat.S_ISREG(stats.st_mode) or stats.st_nlink < 2:
+			return False
+		tmpPath = os.path.join(os.path.dirname(fullPath), '.%s.copy-%s' % (os.path.basename(fullPath), os.getpid()))
+		shutil.copy2(fullPath, tmpPath)
+		os.chmod(tmpPath, stat.S_IMODE(stats.st_mode) | stat.S_IWUSR)
+		os.rename(tmpPath, fullPath)
+		return True
+
+	# copyLinkedFile() for path, or everything under it (symlinks aren't
+	# followed); returns how many files were copied
+	@classmethod
+	@traced('fs')
+	def copyLinkedFiles(cls, path):
+		if os.path.islink(path) or not os.path.exists(path):
+			return 0
+		if not os.path.isdir(path):
+			return int(cls.copyLinkedFile(path))
+		copied = 0
+		for dirPath, dirNames, fileNames in os.walk(path):
+			for name in fileNames:
+				if cls.copyLinkedFile(os.path.join(dirPath, name)):
+					copied += 1
+		return copied
+
+	# Hardlinks of the file or dir at source (symlinks are recreated; files
+	# are copied across filesystems); returns how many files. readOnly takes
+	# the write bits off the files, for stores sharing them between releases
+	# or vendor dirs (the object store, package store and artifact cache): a
+	# linked file is one file, so editing it in place anywhere would edit it
+	# everywhere it's linked
 	@classmethod
-	def purgeOtherDirectoriesInDirectoryExcept(cls, _dir, exceptedItems=[]):
-		dirItems = os.listdir(_dir)
-		for item in dirItems:
-			fullPath = os.path.abspath(os.path.join(_dir, item))
-			if cls.isSymlink(fullPath) == True:
-				continue
-			if item in exceptedItems:
-				continue
-			if os.path.isdir(fullPath) == False:
-				continue
-			# If we get here, it can be deleted
-			cls.removeDir(fullPath)
+	@traced('fs')
+	def linkTree(cls, source, destination, readOnly=False):
+		if not os.path.isdir(os.path.dirname(destination)):
+			os.makedirs(os.path.dirname(destination))
+		if os.path.islink(source):
+			os.symlink(os.readlink(source), destination)
+			return 0
+		if not os.path.isdir(source):
+			cls._linkFile(source, destination, readOnly)
+			return 1
+		linked = 0
+		os.mkdir(destination)
+		for dirPath, dirNames, fileNames in os.walk(source):
+			targetDir = os.path.normpath(os.path.join(destination, os.path.relpath(dirPath, source)))
+			for name in dirNames + fileNames:
+				path 	= os.path.join(dirPath, name)
+				target 	= os.path.join(targetDir, name)
+				if os.path.islink(path):
+					os.symlink(os.readlink(path), target)
+				elif name in dirNames:
+					os.mkdir(target)
+				else:
+					cls._linkFile(path, target, readOnly)
+					linked += 1
+		return linked
+
+	@staticmethod
+	def _linkFile(source, destination, readOnly):
+		if readOnly:
+			mode = stat.S_IMODE(os.lstat(source).st_mode)
+			if mode & 0222:
+				os.chmod(source, mode & ~0222)
+		try:
+			os.link(source, destination)
+		except OSError as e:
+			if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+				raise
+			shutil.copy2(source, destination)
 
 	# Does a file (specifically... it must be a file) exist
 	@staticmethod
+	@traced('fs')
 	def fileExists(path):
 		return os.path.isfile(path)
 
 	# Does the thing at the path exist? (path or directory)
 	@staticmethod
+	@traced('fs')
 	def exists(path):
-		return os.path.exists(path)
\ No newline at end of file
+		return os.path.exists(path)
+
+	# Human readable size, eg. 1.5 MB
+	@staticmethod
+	def formatBytes(size):
+		size = float(size)
+		for unit in ['B', 'KB', 'MB', 'GB']:
+			if size < 1024 or unit == 'GB':
+				break
+			size = size / 1024
+		if unit == 'B':
+			return '%d B' % size
+		return '%.1f %s' % (size, unit)
\ No newline at end of file
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, errno, shutil
+from deploy_coordinator.system.execute import Git
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.file_system import FileSystem
+
+# Content-addressed store of file contents keyed by git blob SHA, shareable
+# between releases and projects. Release trees are built out of hardlinks
+# into the store, so a file that is identical across releases (or projects
+# sharing a framework) exists on disk, and in the page cache, once.
+#
+# Objects are read-only (see FileSystem.linkTree()). Builds get copies of the
+# files they may write to (see ReleaseBuilder.copyWritable()), and root, which
+# read-only doesn't stop, can't link from the store at all. An object no
+# longer linked from anywhere has a link count of 1, which is all
+# collectGarbage() needs to know.
+#
+# The store has to be on the same filesystem as the build dirs for links to
+# work; otherwise objects are copied (and counted in stats['copiedCrossDevice']).
+class ObjectStore(object):
+
+	GITLINK_MODE 	= '160000'
+	SYMLINK_MODE 	= '120000'
+	EXEC_MODE 		= '100755'
+
+	# objectReader is a GitObjectReader on the bare repo
+	def __init__(self, storeDir, objectReader):
+		self.storeDir 		= os.path.join(storeDir, '')
+		self.objectReader 	= objectReader
+		self.bareRepoPath 	= objectReader.gitDir
+		self.stats 			= {'blobsReused': 0, 'bytesSaved': 0, 'blobsStored': 0, 'bytesStored': 0, 'copiedCrossDevice': 0}
+		if not os.path.exists(self.storeDir):
+			os.makedirs(self.storeDir)
+
+	# Builds hold a shared lock, garbage collection an exclusive one
+	def lock(self, shared=True):
+		return FileLock(os.path.join(self.storeDir, '.lock'), shared)
+
+	# Exec bit lives on the inode, so executables are stored separately
+	def objectPathFor(self, sha, mode):
+		suffix = ''
+		if mode == self.EXEC_MODE:
+			suffix = '.x'
+		return os.path.join(self.storeDir, sha[0:2], sha[2:] + suffix)
+
+	# List of (mode, type, sha, size, path) for every entry in the commit's tree
+	def treeEntries(self, commitID):
+		proc = Git(['--git-dir=%s' % self.bareRepoPath, 'ls-tree', '-r', '-l', '-z', '--full-tree', commitID])
+		if proc.process.returncode != 0:
+			raise Exception('Unable to list tree @ %s' % commitID)
+		entries = []
+		for record in proc.response.split('\0'):
+			if record == '':
+				continue
+			meta, path = record.split('\t', 1)
+			mode, _type, sha, size = meta.split()
+			entries.append((mode, _type, sha, size, path))
+		return entries
+
+	# Write the commit's tree (or just paths, if given) into destination
+	def materialize(self, commitID, destination, paths=None):
+		if os.geteuid() == 0:
+			raise Exception('The object store can\'t be used by a deploy running as root: its read-only links would be written through. Deploy as another user, or unset objectStoreDir')
+		entries = self.treeEntries(commitID)
+		if paths is not None:
+			wanted 	= set(paths)
+			entries = [entry for entry in entries if entry[4] in wanted]
+
+		with self.lock(shared=True):
+			missing = {}
+			for mode, _type, sha, size, path in entries:
+				if _type == 'blob' and not os.path.exists(self.objectPathFor(sha, mode)):
+					missing[(sha, mode)] = True
+			self._storeBlobs(missing.keys())
+
+			for mode, _type, sha, size, path in entries:
+				target = os.path.join(destination, path)
+				parentDir = os.path.dirname(target)
+				if not os.path.isdir(parentDir):
+					os.makedirs(parentDir)
+				if os.path.lexists(target) and not os.path.isdir(target):
+					FileSystem.remove(target)
+
+				if mode == self.GITLINK_MODE:
+					if not os.path.isdir(target):
+						os.makedirs(target)
+					continue
+
+				objectPath = self.objectPathFor(sha, mode)
+				if mode == self.SYMLINK_MODE:
+					fileHandle = open(objectPath, 'rb')
+					os.symlink(fileHandle.read(), target)
+					fileHandle.close()
+					continue
+
+				try:
+					os.link(objectPath, target)
+				except OSError as e:
+					if e.errno != errno.EXDEV:
+						raise
+					shutil.copy2(objectPath, target)
+					self.stats['copiedCrossDevice'] += 1
+					continue
+				if (sha, mode) not in missing:
+					self.stats['blobsReused'] += 1
+					self.stats['bytesSaved'] += int(size)
+		return True
+
+	# Removes every object nothing links to anymore; returns (count, bytes)
+	def collectGarbage(self):
+		removed, freed = 0, 0
+		with self.lock(shared=False):
+			for prefix in os.listdir(self.storeDir):
+				prefixDir = os.path.join(self.storeDir, prefix)
+				if len(prefix) != 2 or not os.path.isdir(prefixDir):
+					continue
+				for name in os.listdir(prefixDir):
+					objectPath = os.path.join(prefixDir, name)
+					stats = os.lstat(objectPath)
+					# Leftovers of an interrupted write go too
+					if stats.st_nlink <= 1 or name.startswith('.tmp-'):
+						FileSystem.remove(objectPath)
+						removed += 1
+						freed 	+= stats.st_size
+				if not os.listdir(prefixDir):
+					os.rmdir(prefixDir)
+		return (removed, freed)
+
+	# Streams the blobs out of git through the shared cat-file session;
+	# each is written under a temp name and renamed into place
+	def _storeBlobs(self, blobs):
+		for sha, mode in blobs:
+			objectPath = self.objectPathFor(sha, mode)
+			if not os.path.isdir(os.path.dirname(objectPath)):
+				try:
+					os.makedirs(os.path.dirname(objectPath))
+				except OSError:
+					pass
+			tmpPath = os.path.join(os.path.dirname(objectPath), '.tmp-%s-%s' % (os.getpid(), os.path.basename(objectPath)))
+			fileHandle = open(tmpPath, 'wb')
+			try:
+				result = self.objectReader.readInto(sha, fileHandle.write)
+			finally:
+				fileHandle.close()
+			if result is None or result[1] != 'blob':
+				FileSystem.remove(tmpPath)
+				raise Exception('Unable to read blob %s' % sha)
+
+			if mode == self.EXEC_MODE:
+				os.chmod(tmpPath, 0555)
+			else:
+				os.chmod(tmpPath, 0444)
+			os.rename(tmpPath, objectPath)
+			self.stats['blobsStored'] += 1
+			self.stats['bytesStored'] += result[2]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, stat, json, hashlib
+from deploy_coordinator.system.file_system import FileSystem
+
+# Composer packages, one copy each, keyed by (name, version, reference) from
+# composer.lock. The composer cache holds whole vendor dirs per lock file
+# hash, so without this a single package bump means installing every package
+# again; with it, a vendor dir for a new lock file starts out as hardlinks to
+# every package the store has (assemble()), and composer only installs the
+# rest (and dumps the autoloader). Packages of a finished vendor dir are
+# added as hardlinks too (ingest()), so the store costs no extra disk space.
+#
+# composer only leaves alone what vendor/composer/installed.json says is
+# installed, so assemble() writes one listing the linked packages, in the
+# format the composer that built the last vendor dir uses (see FORMAT_NAME).
+#
+# Files in the store are read-only (see FileSystem.linkTree()). A package
+# nothing else links to anymore (its vendor dirs were evicted from the cache)
+# goes in collectGarbage().
+class PackageStore(object):
+
+	# installed.json format of the composer in use: 1 (a list of packages)
+	# or 2 ({"packages": [...], ...}); recorded by ingest()
+	FORMAT_NAME = '.installed-format'
+
+	def __init__(self, storeDir):
+		self.storeDir 	= os.path.join(storeDir, '')
+		self.stats 		= {'linked': 0, 'stored': 0, 'removed': 0}
+
+	# [(package, isDev)] of a parsed composer.lock
+	@staticmethod
+	def lockedPackages(lockData):
+		return [(package, False) for package in lockData.get('packages') or []] + [(package, True) for package in lockData.get('packages-dev') or []]
+
+	# None for packages that aren't kept: metapackages (no files), path
+	# repositories and dev versions without a reference (their contents
+	# can change under the same name and version)
+	@staticmethod
+	def keyFor(package):
+		name, version = package.get('name'), package.get('version')
+		if not isinstance(name, basestring) or not isinstance(version, basestring) or package.get('type') == 'metapackage':
+			return None
+		dist, source = package.get('dist') or {}, package.get('source') or {}
+		if dist.get('type') == 'path':
+			return None
+		reference = dist.get('reference') or source.get('reference') or ''
+		if reference == '' and (version.startswith('dev-') or version.endswith('-dev')):
+			return None
+		return hashlib.sha1('%s\0%s\0%s' % (name, version, reference)).hexdigest()
+
+	def pathFor(self, key):
+		return os.path.join(self.storeDir, key[0:2], key[2:])
+
+	def has(self, package):
+		key = self.keyFor(package)
+		return key != None and os.path.isdir(self.pathFor(key))
+
+	# Links every package of the lock file the store has into vendorDir (at
+	# vendor/<name>, with their vendor/bin links) and lists them in
+	# installed.json. Without dev (composer install --no-dev), packages-dev
+	# are left out. Returns (linked, total); nothing is written when none
+	# are linked (or no composer has been seen yet)
+	def assemble(self, vendorDir, lockData, dev=True):
+		packages = [(package, isDev) for package, isDev in self.lockedPackages(lockData) if dev or not isDev]
+		linked 	 = [(package, isDev) for package, isDev in packages if self.has(package)]
+		installedFormat = self._readFormat()
+		if installedFormat == None or len(linked) == 0:
+			return (0, len(packages))
+		for package, isDev in linked:
+			FileSystem.linkTree(self.pathFor(self.keyFor(package)), os.path.join(vendorDir, package['name']))
+			for binary in package.get('bin') or []:
+				binDir = os.path.join(vendorDir, 'bin')
+				if not os.path.isdir(binDir):
+					os.makedirs(binDir)
+				binLink = os.path.join(binDir, os.path.basename(binary))
+				if not os.path.lexists(binLink):
+					os.symlink(os.path.join('..', package['name'], binary), binLink)
+		self._writeInstalled(vendorDir, linked, installedFormat, dev)
+		self.stats['linked'] += len(linked)
+		return (len(linked), len(packages))
+
+	# Adds the packages of a finished vendor dir (eg. a composer cache entry)
+	# the store doesn't have yet, as hardlinks; returns how many
+	def ingest(self, vendorDir, lockData):
+		installedFormat = self._installedFormat(vendorDir)
+		if installedFormat == None:
+			return 0
+		if self._readFormat() != installedFormat:
+			self._writeFormat(installedFormat)
+		stored = 0
+		for package, isDev in self.lockedPackages(lockData):
+			key 	= self.keyFor(package)
+			source 	= os.path.join(vendorDir, package.get('name') or '')
+			if key == None or os.path.isdir(self.pathFor(key)) or os.path.islink(source) or not os.path.isdir(source):
+				continue
+			# Linked under a temp name, then renamed into place; a concurrent
+			# deploy storing the same package first wins
+			tmpPath = os.path.join(self.storeDir, '.tmp-%s-%s' % (key, os.getpid()))
+			if os.path.lexists(tmpPath):
+				FileSystem.removeDir(tmpPath)
+			FileSystem.linkTree(source, tmpPath, True)
+			if not os.path.isdir(os.path.dirname(self.pathFor(key))):
+				try:
+					os.makedirs(os.path.dirname(self.pathFor(key)))
+				except OSError:
+					pass
+			try:
+				os.rename(tmpPath, self.pathFor(key))
+			except OSError:
+				FileSystem.removeDir(tmpPath)
+				continue
+			stored += 1
+		self.stats['stored'] += stored
+		return stored
+
+	# Removes every package none of whose files are linked from anywhere
+	# else anymore; returns how many
+	def collectGarbage(self):
+		if not os.path.isdir(self.storeDir):
+			return 0
+		removed = 0
+		for prefix in os.listdir(self.storeDir):
+			prefixDir = os.path.join(self.storeDir, prefix)
+			if len(prefix) != 2 or not os.path.isdir(prefixDir):
+				continue
+			for name in os.listdir(prefixDir):
+				if not self._inUse(os.path.join(prefixDir, name)):
+					FileSystem.removeDir(os.path.join(prefixDir, name))
+					removed += 1
+			if not os.listdir(prefixDir):
+				os.rmdir(prefixDir)
+		self.stats['removed'] += removed
+		return removed
+
+	@staticmethod
+	def _inUse(packageDir):
+		for dirPath, dirNames, fileNames in os.walk(packageDir):
+			for name in fileNames:
+				stats = os.lstat(os.path.join(dirPath, name))
+				if stat.S_ISREG(stats.st_mode) and stats.st_nlink > 1:
+					return True
+		return False
+
+	@staticmethod
+	def _installedFormat(vendorDir):
+		try:
+			fileHandle = open(os.path.join(vendorDir, 'composer', 'installed.json'))
+			try:
+				installed = json.load(fileHandle)
+			finally:
+				fileHandle.close()
+		except (IOError, ValueError):
+			return None
+		if isinstance(installed, list):
+			return 1
+		if isinstance(installed, dict) and isinstance(installed.get('packages'), list):
+			return 2
+		return None
+
+	def _readFormat(self):
+		try:
+			fileHandle = open(os.path.join(self.storeDir, self.FORMAT_NAME))
+			try:
+				return int(fileHandle.read().strip())
+			finally:
+				fileHandle.close()
+		except (IOError, ValueError):
+			return None
+
+	def _writeFormat(self, installedFormat):
+		if not os.path.isdir(self.storeDir):
+			os.makedirs(self.storeDir)
+		tmpPath = os.path.join(self.storeDir, '%s.tmp-%s' % (self.FORMAT_NAME, os.getpid()))
+		fileHandle = open(tmpPath, 'w')
+		fileHandle.write(str(installedFormat))
+		fileHandle.close()
+		os.rename(tmpPath, os.path.join(self.storeDir, self.FORMAT_NAME))
+
+	# installed.json as composer writes it, for the linked packages
+	@staticmethod
+	def _writeInstalled(vendorDir, linked, installedFormat, dev):
+		entries = []
+		for package, isDev in linked:
+			entry = dict(package)
+			entry['installation-source'] = 'dist'
+			if not package.get('dist'):
+				entry['installation-source'] = 'source'
+			if installedFormat == 2:
+				entry['install-path'] = '../%s' % package['name']
+			entries.append(entry)
+		installed = entries
+		if installedFormat == 2:
+			installed = {
+				'packages': entries,
+				'dev': dev,
+				'dev-package-names': [package['name'] for package, isDev in linked if isDev]
+			}
+		composerDir = os.path.join(vendorDir, 'composer')
+		if not os.path.isdir(composerDir):
+			os.makedirs(composerDir)
+		fileHandle = open(os.path.join(composerDir, 'installed.json'), 'w')
+		json.dump(installed, fileHandle, indent=4)
+		fileHandle.close()
@@ -4,24 +4,32 @@ import sys, os, json
 
 class ParseJson:
 
-	def __init__(self, jsonFilePath):
-		fileHandle = open(jsonFilePath)
-		self.data = json.load(fileHandle)
-		fileHandle.close()
+	# Dotted paths (see key()), split once per process
+	_paths = {}
 
-	# Pass in a string to get it from the JSON file
-	# eg: ParseJson().key('nested.params.infinite')
-	def key(self, key):
-		value = None
-		_dict = self.data
-		_keys = key.split('.')
+	# From a file, or from already parsed data (eg. ParseJson(data={...}))
+	def __init__(self, jsonFilePath=None, data=None):
+		if jsonFilePath != None:
+			fileHandle = open(jsonFilePath)
+			data = json.load(fileHandle)
+			fileHandle.close()
+		self.data = data
 
-		if len(_keys) == 1:
-			return _dict.get(_keys[0], None)
+	# eg. contents read straight out of the git object database
+	@classmethod
+	def fromString(cls, jsonString):
+		return cls(data=json.loads(jsonString))
 
-		_last = None
-		for index, item in enumerate(_keys):
-			if isinstance(_dict.get(item,None), dict):
-				_dict = _dict.get(item)
-			_last = item
-		return _dict.get(_last, None)
\ No newline at end of file
+	# Pass in a string to get it from the JSON file
+	# eg: ParseJson().key('nested.params.infinite'); None unless every
+	# part of the path is there (and everything before the last an object)
+	def key(self, key):
+		_keys = self._paths.get(key)
+		if _keys is None:
+			_keys = self._paths[key] = tuple(key.split('.'))
+		value = self.data
+		for item in _keys:
+			if not isinstance(value, dict):
+				return None
+			value = value.get(item, None)
+		return value
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time, multiprocessing
+from deploy_coordinator.system.execute import Execute, Executables, Git
+from deploy_coordinator.system.worker_pool import WorkerPool
+
+# `php -l` over the .php files a push adds or changes (between two commits,
+# by `git diff-tree`), so how long it takes depends on the size of the push,
+# not of the repository. Nothing is checked out: each file's contents are
+# read out of the object database (the shared cat-file session) and piped to
+# its own `php -l`, up to workers (defaults to the number of CPUs) at once.
+#
+# Every file gets linted (no stopping at the first error), within timeout
+# seconds overall: files still waiting by then aren't linted, and linting
+# ones get killed. Results are (path, status, message) with status 'ok',
+# 'error' (message being php's, with the path filled in) or 'unchecked'.
+class PhpLint(object):
+
+	EXTENSION 	= '.php'
+	# What to diff against for a branch without history (new refs)
+	EMPTY_TREE 	= '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+	ZERO_SHA 	= '0' * 40
+	# Regular files (and executable ones); symlinks and submodules aren't linted
+	FILE_MODES 	= ['100644', '100755']
+	# How php names code it read from stdin, in its messages
+	STDIN_NAME 	= 'Standard input code'
+
+	def __init__(self, gitDir, objectReader, workers=None, timeout=30, exportFilter=None):
+		if workers == None:
+			workers = multiprocessing.cpu_count()
+		self.gitDir 		= gitDir
+		self.objectReader 	= objectReader
+		self.workers 		= workers
+		self.timeout 		= timeout
+		# ExportFilter; files it doesn't export aren't linted
+		self.exportFilter 	= exportFilter
+		# Set by run()
+		self.results 		= []
+		self.duration 		= 0.0
+
+	# [(path, blobSHA)] of the .php files added or changed from oldCommitID
+	# to newCommitID
+	def changedFiles(self, oldCommitID, newCommitID):
+		if oldCommitID == self.ZERO_SHA:
+			oldCommitID = self.EMPTY_TREE
+		proc = Git(['--git-dir=%s' % self.gitDir,
+			'diff-tree', '-r', '-z', '--no-renames', '--no-commit-id', '--diff-filter=AMT', oldCommitID, newCommitID
+		])
+		if proc.process.returncode != 0:
+			raise Exception('Unable to diff %s..%s: %s' % (oldCommitID[0:7], newCommitID[0:7], proc.error.strip()))
+		files = []
+		tokens = proc.response.split('\0')
+		# Format is ":oldMode newMode oldSHA newSHA status\0path\0" per change
+		for index in range(0, len(tokens) - 1, 2):
+			meta, path = tokens[index].lstrip(':').split(), tokens[index + 1]
+			if len(meta) < 5 or meta[1] not in self.FILE_MODES or not path.lower().endswith(self.EXTENSION):
+				continue
+			if self.exportFilter != None and not self.exportFilter.exported(path):
+				continue
+			files.append((path, meta[3]))
+		return files
+
+	# Lints the files changed from oldCommitID to newCommitID; returns the
+	# results (also kept in .results), in path order
+	def run(self, oldCommitID, newCommitID):
+		startedAt 	= time.time()
+		deadline 	= startedAt + self.timeout
+		phpPath 	= Executables.resolve('php')
+		pool 		= WorkerPool(self.workers, failFast=False)
+		for path, sha in self.changedFiles(oldCommitID, newCommitID):
+			pool.submit(self._lint, phpPath, path, sha, deadline)
+		self.results = []
+		for job in pool.join():
+			if job.status == 'done':
+				self.results.append(job.result)
+			else:
+				self.results.append((job.args[1], 'error', 'Not linted: %s' % job.error))
+		self.results.sort()
+		self.duration = time.time() - startedAt
+		return self.results
+
+	def failed(self):
+		return [result for result in self.results if result[1] == 'error']
+
+	def unchecked(self):
+		return [result for result in self.results if result[1] == 'unchecked']
+
+	def _lint(self, phpPath, path, sha, deadline):
+		if time.time() >= deadline:
+			return (path, 'unchecked', None)
+		blob = self.objectReader.read(sha)
+		if blob == None:
+			raise Exception('Object %s is missing' % sha)
+		# -n: no php.ini, so nothing configured (extensions, auto_prepend_file)
+		# slows each run down or runs any code
+		proc = Execute([phpPath, '-n', '-d', 'display_errors=1', '-d', 'log_errors=0', '-l'], {
+			'input': blob[2],
+			'timeout': max(0.1, deadline - time.time())
+		})
+		if proc.timedOut:
+			return (path, 'unchecked', None)
+		if proc.returncode == 0:
+			return (path, 'ok', None)
+		return (path, 'error', self.messageFrom(proc.response + proc.error, path))
+
+	# php's output without the summary lines, about path instead of stdin
+	@classmethod
+	def messageFrom(cls, output, path):
+		lines = []
+		for line in output.splitlines():
+			line = line.strip()
+			if line == '' or line.startswith('Errors parsing') or line.startswith('No syntax errors'):
+				continue
+			lines.append(line.replace(cls.STDIN_NAME, path))
+		if len(lines) == 0:
+			return 'php -l failed'
+		return '; '.join(lines)
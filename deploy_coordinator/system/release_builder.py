@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, stat, json, shutil, tempfile
+from deploy_coordinator.system.execute import Execute, Git
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.system.release_collector import ReleaseCollector
+
+# Writes the tree of a commit into a (tmp) build dir, either as a full
+# checkout or incrementally: copy the previous release with reflinks or
+# hardlinks (no file data gets written), then apply only what
+# `git diff-tree` reports changed between the two commits.
+#
+# With hardlinks, only the files git tracks stay linked to the previous
+# release (see breakLinks()), and only outside the paths the build writes to
+# (see copyWritable()); anything else is copied, so a build writing a file in
+# place can't write through into the live release (or ones kept for rollback).
+#
+# Each release gets a manifest (path -> size/mtime/perms, symlink targets)
+# once it is live. If the previous release doesn't match its manifest
+# anymore (files edited on the server...) it is not used as a base.
+#
+# With an ExportFilter, paths it leaves out are never written (they're
+# skipped in the list of paths checked out, and in the changes applied).
+class ReleaseBuilder(object):
+
+	GITLINK_MODE = '160000'
+
+	# cp arguments per link mode; 'auto' tries them in order
+	LINK_MODES = {
+		'reflink':	['cp', '-a', '--reflink=always'],
+		'hardlink':	['cp', '-a', '-l']
+	}
+
+	# objectReader is a GitObjectReader on the bare repo
+	def __init__(self, objectReader, manifestDir, objectStore=None, exportFilter=None):
+		self.objectReader 	 = objectReader
+		self.bareRepoPath 	 = objectReader.gitDir
+		self.manifestDir 	 = os.path.join(manifestDir, '')
+		# Optional ObjectStore; files are then hardlinked from it instead of checked out
+		# (but see copyWritable())
+		self.objectStore 	 = objectStore
+		self.exportFilter 	 = exportFilter
+		# 'full' or 'incremental' once a checkout ran
+		self.mode 			 = None
+		# Why the incremental path wasn't taken (None if it was)
+		self.reason 		 = None
+		# Link mode the previous release was copied with
+		self.linkMode 		 = None
+		self.stats 			 = {'added': 0, 'modified': 0, 'deleted': 0, 'excluded': 0, 'copied': 0}
+		# Submodule paths whose commit changed (or were added) vs. the previous
+		# release; anything else under a gitlink was carried over as is
+		self.changedGitlinks = set()
+		self._treeEntries 	 = {}
+
+	def fullCheckout(self, commitID, destination):
+		self.mode = 'full'
+		return self._checkoutIndex(commitID, destination, None)
+
+	# Returns False (with self.reason set) when the previous release can't
+	# be used as a base; the caller should fall back to fullCheckout().
+	# previousExportFilter is what the previous release was exported with
+	def incrementalCheckout(self, previousCommitID, previousDir, commitID, destination, linkMode='auto', previousExportFilter=None):
+		if previousCommitID is None or not os.path.isdir(previousDir):
+			self.reason = 'no previous release'
+			return False
+
+		if not self.objectReader.exists('%s^{commit}' % previousCommitID):
+			self.reason = 'previous release is not a known commit'
+			return False
+
+		if not self.matchesManifest(previousCommitID, previousDir):
+			self.reason = 'previous release was modified (or has no manifest)'
+			return False
+
+		if previousExportFilter != self.exportFilter:
+			self.reason = 'export rules changed'
+			return False
+
+		changes = self.diffTree(previousCommitID, commitID)
+		if changes is None:
+			self.reason = 'unable to diff against previous release'
+			return False
+
+		self.linkMode = self.copyTree(previousDir, destination, linkMode)
+		if self.linkMode is None:
+			self.reason = 'unable to link previous release (different filesystem?)'
+			return False
+
+		if self.applyChanges(changes, commitID, destination) != True:
+			self.reason = 'failed applying changes'
+			return False
+
+		if self.linkMode == 'hardlink' and self.breakLinks(commitID, destination) != True:
+			self.reason = 'unable to list the files of the commit'
+			return False
+
+		self.mode = 'incremental'
+		return True
+
+	# List of (oldMode, newMode, status, path) for every path that differs
+	def diffTree(self, fromCommitID, toCommitID):
+		proc = Git(['--git-dir=%s' % self.bareRepoPath,
+			'diff-tree', '-r', '-z', '--no-renames', '--no-commit-id', fromCommitID, toCommitID
+		])
+		if proc.process.returncode != 0:
+			return None
+		changes = []
+		tokens = proc.response.split('\0')
+		# Format is ":oldMode newMode oldSHA newSHA status\0path\0" per change
+		for index in range(0, len(tokens) - 1, 2):
+			meta = tokens[index].lstrip(':').split()
+			if len(meta) < 5:
+				continue
+			changes.append((meta[0], meta[1], meta[4][0], tokens[index + 1]))
+		return changes
+
+	# Copies source into (a fresh) destination without writing file data;
+	# returns the link mode used, or None
+	def copyTree(self, source, destination, linkMode='auto'):
+		if linkMode == 'auto':
+			modes = ['reflink', 'hardlink']
+		else:
+			modes = [linkMode]
+		for mode in modes:
+			self._resetDir(destination)
+			proc = Execute(self.LINK_MODES[mode] + [os.path.join(source, '.'), destination])
+			if proc.process.returncode == 0:
+				return mode
+		self._resetDir(destination)
+		return None
+
+	def applyChanges(self, changes, commitID, destination):
+		checkoutPaths = []
+		# Remove anything deleted or changed first. Changed files are removed
+		# too, so the new version gets its own inode (and never writes through
+		# a hardlink into the previous release)
+		for oldMode, newMode, status, path in changes:
+			if not self.isExported(path, {True: oldMode, False: newMode}[status == 'D']):
+				self.stats['excluded'] += 1
+				continue
+			fullPath = os.path.join(destination, path)
+			if status != 'A':
+				self._removePath(fullPath)
+			if status == 'D':
+				self.stats['deleted'] += 1
+				self._pruneEmptyParents(os.path.dirname(fullPath), destination)
+				continue
+			if status == 'A':
+				self.stats['added'] += 1
+			else:
+				self.stats['modified'] += 1
+			if newMode == self.GITLINK_MODE:
+				self.changedGitlinks.add(path)
+				self._removePath(fullPath)
+				os.makedirs(fullPath)
+			else:
+				checkoutPaths.append(path)
+
+		if len(checkoutPaths) == 0:
+			return True
+		return self._checkoutIndex(commitID, destination, checkoutPaths)
+
+	# Replaces every file still hardlinked to the previous release that isn't
+	# a blob of commitID (build output, untracked files, submodule contents)
+	# with a copy of its own. Blobs keep sharing their inode, except under the
+	# paths the build writes to (see copyWritable())
+	def breakLinks(self, commitID, destination):
+		entries = self.treeEntries(commitID)
+		if entries is None:
+			return False
+		blobs = set([path for mode, size, path, sha in entries if mode in ['100644', '100755']])
+		for dirPath, dirNames, fileNames in os.walk(destination):
+			for name in fileNames:
+				fullPath = os.path.join(dirPath, name)
+				if os.path.relpath(fullPath, destination) not in blobs and FileSystem.copyLinkedFile(fullPath):
+					self.stats['copied'] += 1
+		return True
+
+	# Gives every file under paths (relative to destination: the dirs build
+	# tasks and composer run in, task outputs) a copy of its own if it's
+	# still linked to the previous release or the object store, so whatever
+	# the build writes in place there stays in this build. Returns how many
+	# were copied
+	def copyWritable(self, destination, paths):
+		if self.linkMode != 'hardlink' and self.objectStore is None:
+			return 0
+		copied = 0
+		for path in sorted(set([os.path.normpath(path) for path in paths])):
+			copied += FileSystem.copyLinkedFiles(os.path.join(destination, path))
+		self.stats['copied'] += copied
+		return copied
+
+	def isExported(self, path, mode):
+		if self.exportFilter is None:
+			return True
+		if mode == self.GITLINK_MODE:
+			return self.exportFilter.anyExportedUnder(path)
+		return self.exportFilter.exported(path)
+
+	# List of (mode, size, path, sha) for every entry in the commit's tree (size
+	# is '-' for anything but blobs); listed once per commit
+	def treeEntries(self, commitID):
+		if commitID not in self._treeEntries:
+			proc = Git(['--git-dir=%s' % self.bareRepoPath, 'ls-tree', '-r', '-l', '-z', '--full-tree', commitID])
+			if proc.process.returncode != 0:
+				return None
+			entries = []
+			for record in proc.response.split('\0'):
+				if record == '':
+					continue
+				meta, path = record.split('\t', 1)
+				mode, _type, sha, size = meta.split()
+				entries.append((mode, size, path, sha))
+			self._treeEntries[commitID] = entries
+		return self._treeEntries[commitID]
+
+	# Paths in the commit's tree the export filter lets through
+	def exportedPaths(self, commitID):
+		entries = self.treeEntries(commitID)
+		if entries is None:
+			return None
+		paths = []
+		for mode, size, path, sha in entries:
+			if self.isExported(path, mode):
+				paths.append(path)
+			else:
+				self.stats['excluded'] += 1
+		return paths
+
+	# (bytes, files and directories) of what a full checkout of commitID writes
+	def treeStats(self, commitID):
+		entries = self.treeEntries(commitID)
+		if entries is None:
+			return None
+		total, files, dirs = 0, 0, set()
+		for mode, size, path, sha in entries:
+			if not self.isExported(path, mode):
+				continue
+			files += 1
+			if size != '-':
+				total += int(size)
+			while '/' in path:
+				path = path.rsplit('/', 1)[0]
+				dirs.add(path)
+		return (total, files + len(dirs))
+
+	def manifestPathFor(self, commitID):
+		return os.path.join(self.manifestDir, '%s.json' % commitID)
+
+	# Everything in a release except directories themselves: regular files
+	# by size/mtime/permissions, symlinks by target
+	@staticmethod
+	def snapshot(rootDir):
+		entries = {}
+		for dirPath, dirNames, fileNames in os.walk(rootDir):
+			for name in dirNames + fileNames:
+				fullPath = os.path.join(dirPath, name)
+				relPath  = os.path.relpath(fullPath, rootDir)
+				stats 	 = os.lstat(fullPath)
+				if stat.S_ISLNK(stats.st_mode):
+					entries[relPath] = ['l', os.readlink(fullPath)]
+				elif stat.S_ISREG(stats.st_mode):
+					entries[relPath] = ['f', stats.st_size, int(stats.st_mtime), stat.S_IMODE(stats.st_mode)]
+		return entries
+
+	def writeManifest(self, commitID, releaseDir):
+		if not os.path.exists(self.manifestDir):
+			os.makedirs(self.manifestDir)
+		tmpPath = self.manifestPathFor(commitID) + '.tmp'
+		fileHandle = open(tmpPath, 'w')
+		json.dump(self.snapshot(releaseDir), fileHandle)
+		fileHandle.close()
+		os.rename(tmpPath, self.manifestPathFor(commitID))
+
+	def matchesManifest(self, commitID, releaseDir):
+		if not FileSystem.fileExists(self.manifestPathFor(commitID)):
+			return False
+		try:
+			fileHandle = open(self.manifestPathFor(commitID))
+			recorded = json.load(fileHandle)
+			fileHandle.close()
+			# Round trip so both sides have the same (unicode) types
+			return json.loads(json.dumps(self.snapshot(releaseDir))) == recorded
+		except (ValueError, UnicodeDecodeError):
+			return False
+
+	def purgeManifestsExcept(self, commitIDs=[]):
+		if not os.path.exists(self.manifestDir):
+			return
+		# <commitID>.json, and anything else kept per release (eg. replica
+		# manifests); activation records are the ReleaseCollector's
+		for item in os.listdir(self.manifestDir):
+			if item.split('.')[0] not in commitIDs and not item.endswith(ReleaseCollector.ACTIVATED_SUFFIX):
+				FileSystem.remove(os.path.join(self.manifestDir, item))
+
+	# read-tree into a private index (never touches the bare repo's own
+	# index or HEAD) and check out either everything or just paths
+	def _checkoutIndex(self, commitID, destination, paths):
+		if paths is None and self.exportFilter is not None:
+			paths = self.exportedPaths(commitID)
+			if paths is None:
+				return False
+		if self.objectStore is not None:
+			return self.objectStore.materialize(commitID, destination, paths)
+		destination = os.path.join(destination, '')
+		indexDir 	= tempfile.mkdtemp(prefix='deploy_coord_index')
+		gitOptions 	= {'env': {'GIT_INDEX_FILE': os.path.join(indexDir, 'index')}}
+		try:
+			if Git(['--git-dir=%s' % self.bareRepoPath, 'read-tree', commitID], gitOptions).process.returncode != 0:
+				return False
+			args = ['--git-dir=%s' % self.bareRepoPath, '--work-tree=%s' % destination,
+				'checkout-index', '-f', '--prefix=%s' % destination]
+			if paths is None:
+				args.append('-a')
+			else:
+				args = args + ['-z', '--stdin']
+				gitOptions['input'] = '\0'.join(paths) + '\0'
+			return Git(args, gitOptions).process.returncode == 0
+		finally:
+			shutil.rmtree(indexDir, True)
+
+	@staticmethod
+	def _resetDir(path):
+		if os.path.lexists(path):
+			FileSystem.removeDir(path)
+		os.makedirs(path)
+
+	@staticmethod
+	def _removePath(fullPath):
+		if os.path.islink(fullPath) or os.path.isfile(fullPath):
+			FileSystem.remove(fullPath)
+		elif os.path.isdir(fullPath):
+			FileSystem.removeDir(fullPath)
+
+	@staticmethod
+	def _pruneEmptyParents(path, stopAt):
+		stopAt = os.path.normpath(stopAt)
+		path   = os.path.normpath(path)
+		while path != stopAt and path.startswith(stopAt) and os.path.isdir(path) and not os.listdir(path):
+			os.rmdir(path)
+			path = os.path.dirname(path)
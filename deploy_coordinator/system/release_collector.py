@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, os, time, errno, argparse, subprocess, distutils.spawn
+from deploy_coordinator.cli import Formatter, Output
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.execute import GitObjectReader
+from deploy_coordinator.system.object_store import ObjectStore
+
+# Retires old releases under _application/ by a retention policy: the live
+# release, the `keep` most recently activated ones and any activated less than
+# maxAge seconds ago stay. Retiring is a rename into _trash/ (instant; the
+# release is out of _application/ right away). Deleting happens afterwards,
+# in a process of its own (spawn()) the hook doesn't wait for, at most
+# filesPerSecond files a second and in the idle I/O class (ionice) when idle
+# is set, so it doesn't compete with the live site for the disk. It goes file
+# by file, so an interrupted collector leaves a partly deleted dir in _trash/
+# for the next one to carry on with. One collector deletes at a time.
+#
+# When a release went live is recorded in _manifests/<commitID>.activated
+# (recordActivation()) rather than read off the release dir, whose mtime
+# changes whenever the app writes into it.
+class ReleaseCollector(object):
+
+	ACTIVATED_SUFFIX = '.activated'
+
+	def __init__(self, buildDir, keep=3, maxAge=None, filesPerSecond=500, idle=True):
+		self.buildDir 		= os.path.join(buildDir, '')
+		self.appBundle 		= os.path.join(self.buildDir, '_application', '')
+		self.trashDir 		= os.path.join(self.buildDir, '_trash', '')
+		self.manifestDir 	= os.path.join(self.buildDir, '_manifests', '')
+		self.keep 			= max(1, int(keep))
+		self.maxAge 		= maxAge
+		self.filesPerSecond = filesPerSecond
+		self.idle 			= idle
+		self.stats 			= {'filesDeleted': 0, 'bytesFreed': 0}
+		self._startedAt 	= None
+
+	# Commit IDs of the releases, most recently activated first
+	def releases(self):
+		if not os.path.isdir(self.appBundle):
+			return []
+		releases = []
+		for name in os.listdir(self.appBundle):
+			path = os.path.join(self.appBundle, name)
+			if name.startswith('.') or os.path.islink(path) or not os.path.isdir(path):
+				continue
+			releases.append((self.activatedAt(name), name))
+		return [name for activatedAt, name in sorted(releases, reverse=True)]
+
+	# Releases the policy lets go of (never liveCommitID)
+	def expired(self, liveCommitID):
+		expired, kept = [], 0
+		for name in self.releases():
+			age = time.time() - self.activatedAt(name)
+			if name == liveCommitID or kept < self.keep or (self.maxAge != None and age < self.maxAge):
+				kept += 1
+				continue
+			expired.append(name)
+		return expired
+
+	def activationPathFor(self, commitID):
+		return os.path.join(self.manifestDir, commitID + self.ACTIVATED_SUFFIX)
+
+	# Records that the release just went live (or went live at activatedAt)
+	def recordActivation(self, commitID, activatedAt=None):
+		if activatedAt == None:
+			activatedAt = time.time()
+		if not os.path.isdir(self.manifestDir):
+			os.makedirs(self.manifestDir)
+		tmpPath = '%s.tmp-%s' % (self.activationPathFor(commitID), os.getpid())
+		fileHandle = open(tmpPath, 'w')
+		fileHandle.write('%.3f' % activatedAt)
+		fileHandle.close()
+		os.rename(tmpPath, self.activationPathFor(commitID))
+
+	# When the release last went live; the mtime of its dir for releases
+	# from before activations were recorded
+	def activatedAt(self, commitID):
+		try:
+			fileHandle = open(self.activationPathFor(commitID))
+			try:
+				return float(fileHandle.read().strip())
+			finally:
+				fileHandle.close()
+		except (IOError, ValueError):
+			return os.stat(os.path.join(self.appBundle, commitID)).st_mtime
+
+	# Moves the expired releases into the trash, and drops the activation
+	# records of releases that are gone; returns their commit IDs
+	def retire(self, liveCommitID):
+		expired = self.expired(liveCommitID)
+		for name in expired:
+			self.discard(os.path.join(self.appBundle, name))
+		if os.path.isdir(self.manifestDir):
+			kept = self.releases()
+			for item in os.listdir(self.manifestDir):
+				if item.endswith(self.ACTIVATED_SUFFIX) and item[0:-len(self.ACTIVATED_SUFFIX)] not in kept:
+					os.remove(os.path.join(self.manifestDir, item))
+		return expired
+
+	# Moves a dir into the trash (named so the same release can be retired
+	# more than once)
+	def discard(self, path):
+		if not os.path.isdir(self.trashDir):
+			os.makedirs(self.trashDir)
+		name = '%s.%s-%s' % (os.path.basename(os.path.normpath(path)), int(time.time() * 1000), os.getpid())
+		os.rename(path, os.path.join(self.trashDir, name))
+
+	def hasTrash(self):
+		return len(self._trash()) > 0
+
+	# Deletes everything in the trash, throttled; False if another collector
+	# is at it already (it picks up whatever lands in the trash meanwhile)
+	def collect(self):
+		lock = FileLock(os.path.join(self.trashDir, '.lock'))
+		if lock.acquire(blocking=False) != True:
+			return False
+		try:
+			self._startedAt = time.time()
+			trash = self._trash()
+			while len(trash) > 0:
+				for name in trash:
+					self._delete(os.path.join(self.trashDir, name))
+				trash = self._trash()
+		finally:
+			lock.release()
+		return True
+
+	# Starts a collector process (which also collects the object store's
+	# garbage once the trash is empty, if there is one), detached so the hook
+	# can exit; its output goes to _trash/.log. Returns its pid
+	def spawn(self, objectStoreDir=None, gitDir=None):
+		args = [sys.executable, '-m', 'deploy_coordinator.system.release_collector', self.buildDir, '--files-per-second', str(self.filesPerSecond or 0)]
+		if objectStoreDir != None:
+			args += ['--object-store', objectStoreDir, '--git-dir', gitDir]
+		if self.idle == True and distutils.spawn.find_executable('ionice') != None:
+			args = [distutils.spawn.find_executable('ionice'), '-c', '3'] + args
+		env = dict(os.environ)
+		env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), env.get('PYTHONPATH', '')])
+		if not os.path.isdir(self.trashDir):
+			os.makedirs(self.trashDir)
+		logHandle = open(os.path.join(self.trashDir, '.log'), 'a')
+		try:
+			proc = subprocess.Popen(args, stdin=open(os.devnull), stdout=logHandle, stderr=subprocess.STDOUT,
+				cwd='/', env=env, preexec_fn=os.setsid, close_fds=True)
+		finally:
+			logHandle.close()
+		return proc.pid
+
+	def _trash(self):
+		if not os.path.isdir(self.trashDir):
+			return []
+		return sorted([name for name in os.listdir(self.trashDir) if not name.startswith('.')])
+
+	# Bottom up, without following symlinks (eg. vendor -> _composercache)
+	def _delete(self, path):
+		if os.path.islink(path) or not os.path.isdir(path):
+			self._unlink(path)
+			return
+		for dirPath, dirNames, fileNames in os.walk(path, topdown=False):
+			for name in fileNames:
+				self._unlink(os.path.join(dirPath, name))
+			for name in dirNames:
+				if os.path.islink(os.path.join(dirPath, name)):
+					self._unlink(os.path.join(dirPath, name))
+				else:
+					self._rmdir(os.path.join(dirPath, name))
+		self._rmdir(path)
+
+	def _unlink(self, path):
+		try:
+			size = os.lstat(path).st_size
+			os.remove(path)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+			return
+		self.stats['filesDeleted'] += 1
+		self.stats['bytesFreed'] 	+= size
+		self._throttle()
+
+	def _rmdir(self, path):
+		try:
+			os.rmdir(path)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	# Sleeps (every tenth of a second's worth of files) to stay at filesPerSecond
+	def _throttle(self):
+		if not self.filesPerSecond:
+			return
+		if self.stats['filesDeleted'] % max(1, int(self.filesPerSecond / 10)) != 0:
+			return
+		delay = self._startedAt + self.stats['filesDeleted'] / float(self.filesPerSecond) - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Deletes retired releases (the _trash dir of a build dir)')
+	parser.add_argument('buildDir')
+	parser.add_argument('--files-per-second', type=float, default=500, dest='filesPerSecond', help='0 for no limit')
+	parser.add_argument('--object-store', dest='objectStore', help='object store to collect the garbage of afterwards')
+	parser.add_argument('--git-dir', dest='gitDir')
+	args = parser.parse_args()
+	# stdout is _trash/.log (see spawn())
+	Output.configure('plain')
+	collector = ReleaseCollector(args.buildDir, filesPerSecond=args.filesPerSecond)
+	if collector.collect() != True:
+		Output.line(Formatter('%s another collector is running' % time.strftime('%Y-%m-%d %H:%M:%S')))
+		sys.exit(0)
+	message = '%s deleted %s files (%s bytes)' % (time.strftime('%Y-%m-%d %H:%M:%S'), collector.stats['filesDeleted'], collector.stats['bytesFreed'])
+	if args.objectStore != None:
+		removed, freed = ObjectStore(args.objectStore, GitObjectReader(args.gitDir)).collectGarbage()
+		message += '; object store GC removed %s blobs (%s bytes)' % (removed, freed)
+	Output.line(Formatter(message))
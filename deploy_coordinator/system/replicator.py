@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, stat, json, time, shutil, hashlib
+from deploy_coordinator.system.activation import Activator, ReloadStrategy
+from deploy_coordinator.system.composer_cache import ComposerCache
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.system.release_collector import ReleaseCollector
+from deploy_coordinator.system.worker_pool import WorkerPool
+from deploy_coordinator.system.tracer import traced
+
+# Copies of a finished release in other build dirs (more docroots, or nodes
+# whose build dir is mounted here), laid out like the build dir itself:
+# _application/<commitID>, the _composercache entry its vendor symlink points
+# at, and the _permanent dirs its storage symlinks point at (created empty;
+# what's in them belongs to the target). Symlinks pointing into the source
+# build dir are pointed into the target's.
+#
+# Releases are compared by manifest (per path: size, mtime, mode and sha1 of
+# the contents), so only files that changed are copied; the rest are
+# hardlinked from the target's live release, after checking the target's
+# copy still has the size and mtime recorded for it. Files under copyPaths
+# (relative to the release; the paths its build wrote to, which the source
+# doesn't link either) are always copied. A new vendor dir links files from
+# the vendor dirs the live release uses that have the same sha1. Hashes of
+# the source release are carried over from the previous release's manifest
+# for files with the same size and mtime, so mostly just changed files get
+# read.
+#
+# Activation is two-phase: every target receives the release first (in
+# parallel; a release appears in a target's _application/ in one rename),
+# and only once all of them have does any ln-release get swapped. If one
+# fails, none is switched, and what the others received is removed.
+class Replicator(object):
+
+	MANIFEST_SUFFIX = '.replica.json'
+
+	def __init__(self, sourceBuildDir, targets=[], workers=4, copyPaths=[]):
+		self.sourceBuildDir = os.path.join(sourceBuildDir, '')
+		self.manifestDir 	= os.path.join(self.sourceBuildDir, '_manifests', '')
+		self.targets 		= targets
+		self.workers 		= workers
+		self.copyPaths 		= list(copyPaths)
+		self.stats 			= {'filesHashed': 0, 'bytesHashed': 0}
+
+	# Manifest of the release at releaseDir (see class comment), kept in the
+	# source's _manifests/; hashes come from previousCommitID's where the
+	# file looks the same
+	@traced('fs')
+	def sourceManifest(self, commitID, releaseDir, previousCommitID=None):
+		manifestPath = os.path.join(self.manifestDir, commitID + self.MANIFEST_SUFFIX)
+		previous = {}
+		if previousCommitID != None and previousCommitID != commitID:
+			previous = self.readManifest(os.path.join(self.manifestDir, previousCommitID + self.MANIFEST_SUFFIX)) or {}
+		entries = {}
+		for dirPath, dirNames, fileNames in os.walk(releaseDir):
+			for name in dirNames + fileNames:
+				fullPath = os.path.join(dirPath, name)
+				relPath  = os.path.relpath(fullPath, releaseDir)
+				stats 	 = os.lstat(fullPath)
+				if stat.S_ISLNK(stats.st_mode):
+					entries[relPath] = ['l', os.readlink(fullPath)]
+				elif stat.S_ISDIR(stats.st_mode):
+					entries[relPath] = ['d', stat.S_IMODE(stats.st_mode)]
+				elif stat.S_ISREG(stats.st_mode):
+					entry = ['f', stats.st_size, int(stats.st_mtime), stat.S_IMODE(stats.st_mode)]
+					known = previous.get(relPath)
+					if known != None and known[0:3] == entry[0:3]:
+						entries[relPath] = entry + [known[4]]
+					else:
+						entries[relPath] = entry + [self.hashFile(fullPath)]
+						self.stats['filesHashed'] += 1
+						self.stats['bytesHashed'] += stats.st_size
+		self.writeManifest(manifestPath, entries)
+		return entries
+
+	# Phase one: every target receives the release, in parallel. Returns
+	# [(target, error)] of the targets that failed; the first failure cancels
+	# the rest
+	def prepare(self, commitID, releaseDir, previousCommitID=None):
+		manifest = self.sourceManifest(commitID, releaseDir, previousCommitID)
+		pool = WorkerPool(self.workers)
+		jobs = [(target, pool.submit(target.receive, commitID, releaseDir, manifest, self.sourceBuildDir, pool, self.copyPaths)) for target in self.targets]
+		pool.join()
+		return [(target, job.error) for target, job in jobs if job.status == 'failed']
+
+	# Removes what the targets received of commitID (where it isn't live)
+	def discard(self, commitID):
+		for target in self.targets:
+			target.discard(commitID)
+
+	# Phase two: points every target's ln-release at the release, one right
+	# after the other. If one can't be swapped, those already swapped are
+	# swapped back, and it raises
+	def swap(self, commitID):
+		swapped = []
+		try:
+			for target in self.targets:
+				target.swap(commitID)
+				swapped.append(target)
+		except:
+			for target in swapped:
+				target.revert()
+			raise
+
+	# Runs every target's reload strategies, in parallel; False if any failed
+	def reload(self, onLine=lambda line: None):
+		pool = WorkerPool(self.workers, failFast=False)
+		for target in self.targets:
+			pool.submit(target.reload, onLine)
+		pool.join()
+		return len(pool.failures()) == 0 and False not in [ok for target in self.targets for ok, message in target.activator.report['reloads']]
+
+	# Puts every target back on the release it was on before swap()
+	def revert(self, onLine=lambda line: None):
+		for target in self.targets:
+			target.revert()
+		pool = WorkerPool(self.workers, failFast=False)
+		for target in self.targets:
+			pool.submit(target.reload, onLine)
+		pool.join()
+
+	@staticmethod
+	def hashFile(path):
+		digest = hashlib.sha1()
+		fileHandle = open(path, 'rb')
+		try:
+			while True:
+				chunk = fileHandle.read(1024 * 1024)
+				if not chunk:
+					break
+				digest.update(chunk)
+		finally:
+			fileHandle.close()
+		return digest.hexdigest()
+
+	@staticmethod
+	def readManifest(path):
+		try:
+			fileHandle = open(path)
+			try:
+				return json.load(fileHandle)
+			finally:
+				fileHandle.close()
+		except (IOError, ValueError):
+			return None
+
+	@staticmethod
+	def writeManifest(path, entries):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		tmpPath = '%s.tmp-%s' % (path, os.getpid())
+		fileHandle = open(tmpPath, 'w')
+		json.dump(entries, fileHandle)
+		fileHandle.close()
+		os.rename(tmpPath, path)
+
+
+# A build dir a release is replicated to. name is what output calls it (its
+# build dir, by default); strategies reload its web server (see
+# ReloadStrategy) once it's switched
+class ReplicaTarget(object):
+
+	# Files copied between checks of whether the replication got cancelled
+	CANCEL_CHECK_EVERY = 200
+
+	def __init__(self, buildDir, strategies=[], name=None):
+		# Settings out of JSON (eg. the deploy daemon's) are unicode; paths
+		# walked in the source release are bytes, and get joined onto these
+		if isinstance(buildDir, unicode):
+			buildDir = buildDir.encode('utf-8')
+		if isinstance(name, unicode):
+			name = name.encode('utf-8')
+		self.buildDir 		= os.path.join(buildDir, '')
+		self.name 			= name or buildDir
+		self.symlinkPointer = os.path.join(self.buildDir, 'ln-release')
+		self.appBundle 		= os.path.join(self.buildDir, '_application', '')
+		self.permanentDir 	= os.path.join(self.buildDir, '_permanent', '')
+		self.composerCache 	= ComposerCache(os.path.join(self.buildDir, '_composercache', ''))
+		self.manifestDir 	= os.path.join(self.buildDir, '_manifests', '')
+		self.activator 		= Activator(self.symlinkPointer, strategies)
+		self.stats 			= {'filesCopied': 0, 'bytesCopied': 0, 'filesLinked': 0, 'vendorEntries': [], 'seconds': 0.0, 'alreadyLive': False}
+
+	# The target for one entry of the "replicas" hook setting: a build dir,
+	# or a dict of:
+	#	'buildDir'
+	#	'reload'	strategies to reload its web server with, like the "reload"
+	#				setting (default none, eg. for docroots this server serves)
+	#	'name'		what the output calls it
+	@staticmethod
+	def fromSetting(replica, repoHooksPath=None):
+		if not isinstance(replica, dict):
+			replica = {'buildDir': replica}
+		names = replica.get('reload', ['none'])
+		if not isinstance(names, list):
+			names = [names]
+		strategies = [ReloadStrategy.fromSetting(name, repoHooksPath) for name in names]
+		return ReplicaTarget(replica['buildDir'], strategies, replica.get('name'))
+
+	def liveCommitID(self):
+		if not os.path.islink(self.symlinkPointer):
+			return None
+		return os.path.basename(os.path.normpath(os.readlink(self.symlinkPointer)))
+
+	def manifestPathFor(self, commitID):
+		return os.path.join(self.manifestDir, commitID + Replicator.MANIFEST_SUFFIX)
+
+	# Writes the release described by manifest (files read from sourceDir)
+	# to _application/<commitID>, plus the composer cache entries and
+	# permanent dirs it links to. Files under copyPaths are never linked
+	def receive(self, commitID, sourceDir, manifest, sourceBuildDir, pool=None, copyPaths=[]):
+		startedAt = time.time()
+		previousCommitID = self.liveCommitID()
+		if previousCommitID == commitID and os.path.isdir(os.path.join(self.appBundle, commitID)):
+			self.stats['alreadyLive'] = True
+			return
+		for path in [self.appBundle, self.permanentDir, self.composerCache.cacheDir]:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+		# What's known about the live release's files, and the vendor dirs it uses
+		previousDir, previous, previousVendors = None, {}, []
+		if previousCommitID != None:
+			previousDir = os.path.join(self.appBundle, previousCommitID)
+			previous 	= Replicator.readManifest(self.manifestPathFor(previousCommitID)) or {}
+			for entry in previous.values():
+				cacheEntry = self._cacheEntryOf(entry, self.buildDir)
+				if cacheEntry != None:
+					previousVendors.append(cacheEntry)
+
+		incoming = os.path.join(self.appBundle, '.incoming-%s-%s' % (commitID, os.getpid()))
+		if os.path.lexists(incoming):
+			FileSystem.removeDir(incoming)
+		os.makedirs(incoming)
+		received = {}
+		try:
+			# Parents sort before what's in them
+			for relPath in sorted(manifest.keys()):
+				entry 	= manifest[relPath]
+				target 	= os.path.join(incoming, relPath)
+				if entry[0] == 'd':
+					os.mkdir(target)
+					received[relPath] = entry
+				elif entry[0] == 'l':
+					received[relPath] = ['l', self._linkInto(entry[1], sourceBuildDir, os.path.dirname(os.path.join(sourceDir, relPath)), previousVendors, pool)]
+					os.symlink(received[relPath][1], target)
+				elif not self._isUnder(relPath, copyPaths) and self._reuse(previous.get(relPath), entry, previousDir, relPath, target):
+					received[relPath] = previous[relPath]
+				else:
+					self._copy(os.path.join(sourceDir, relPath), target, pool)
+					received[relPath] = entry
+			# Dir modes last, a read-only dir couldn't be written into
+			for relPath in sorted(manifest.keys(), reverse=True):
+				if manifest[relPath][0] == 'd':
+					os.chmod(os.path.join(incoming, relPath), manifest[relPath][1])
+
+			releaseDir = os.path.join(self.appBundle, commitID)
+			if os.path.isdir(releaseDir):
+				ReleaseCollector(self.buildDir).discard(releaseDir)
+			Replicator.writeManifest(self.manifestPathFor(commitID), received)
+			os.rename(incoming, releaseDir)
+		except:
+			if os.path.lexists(incoming):
+				FileSystem.removeDir(incoming)
+			raise
+		finally:
+			self.stats['seconds'] = time.time() - startedAt
+
+	# Removes a received (not live) release
+	def discard(self, commitID):
+		releaseDir = os.path.join(self.appBundle, commitID)
+		if self.liveCommitID() != commitID and os.path.isdir(releaseDir):
+			ReleaseCollector(self.buildDir).discard(releaseDir)
+
+	def swap(self, commitID):
+		self.activator.previousTarget = self.activator.swap('_application/' + commitID)
+
+	def reload(self, onLine):
+		return self.activator.reload(onLine)
+
+	# Back onto the release that was live before swap() (if there was one)
+	def revert(self):
+		if self.activator.previousTarget != None:
+			self.activator.swap(self.activator.previousTarget)
+			self.activator.reverted = True
+
+	# Records commitID (live now) as activated, then retires old releases
+	# (like the source's; see ReleaseCollector) and their manifests; returns
+	# the collector, for deleting what's retired
+	def retire(self, commitID, keep=3, maxAge=None, filesPerSecond=500, idle=True):
+		collector = ReleaseCollector(self.buildDir, keep, maxAge, filesPerSecond, idle)
+		collector.recordActivation(commitID)
+		collector.retire(commitID)
+		kept = collector.releases()
+		if os.path.isdir(self.manifestDir):
+			for item in os.listdir(self.manifestDir):
+				if item.split('.')[0] not in kept:
+					FileSystem.remove(os.path.join(self.manifestDir, item))
+		return collector
+
+	# Evicts composer cache entries (see ComposerCache.evict) none of the
+	# target's releases use
+	def trimComposerCache(self, maxBytes=None, maxEntries=None):
+		inUse = []
+		for commitID in ReleaseCollector(self.buildDir).releases():
+			for entry in (Replicator.readManifest(self.manifestPathFor(commitID)) or {}).values():
+				if self._cacheEntryOf(entry, self.buildDir) != None:
+					inUse.append(self._cacheEntryOf(entry, self.buildDir))
+		cache = ComposerCache(self.composerCache.cacheDir, maxBytes, maxEntries)
+		cache.evict(inUse)
+		return cache.stats['evicted']
+
+	# A file of the live release can be linked instead of copied if it has
+	# the same contents and mode, and still looks like it did when received
+	def _reuse(self, known, entry, previousDir, relPath, target):
+		if known == None or known[0] != 'f' or known[3:5] != entry[3:5]:
+			return False
+		try:
+			stats = os.lstat(os.path.join(previousDir, relPath))
+			if not stat.S_ISREG(stats.st_mode) or stats.st_size != known[1] or int(stats.st_mtime) != known[2]:
+				return False
+			os.link(os.path.join(previousDir, relPath), target)
+		except OSError:
+			return False
+		self.stats['filesLinked'] += 1
+		return True
+
+	def _copy(self, source, target, pool):
+		shutil.copy2(source, target)
+		self.stats['filesCopied'] += 1
+		self.stats['bytesCopied'] += os.lstat(target).st_size
+		if pool != None and self.stats['filesCopied'] % self.CANCEL_CHECK_EVERY == 0:
+			pool.checkCancelled()
+
+	# The link's target on this target (pointed into its build dir if it
+	# pointed into the source's), with the composer cache entry or permanent
+	# dir it points at in place
+	def _linkInto(self, linkTarget, sourceBuildDir, linkDir, previousVendors, pool):
+		resolved = os.path.normpath(os.path.join(linkDir, linkTarget))
+		if not resolved.startswith(sourceBuildDir):
+			return linkTarget
+		relPath = resolved[len(sourceBuildDir):]
+		if relPath.startswith('_composercache/'):
+			self._receiveCacheEntry(relPath.split('/')[1], sourceBuildDir, previousVendors, pool)
+		elif relPath.startswith('_permanent/') and not os.path.isdir(os.path.join(self.buildDir, relPath)):
+			os.makedirs(os.path.join(self.buildDir, relPath))
+		if os.path.isabs(linkTarget):
+			return os.path.join(self.buildDir, relPath)
+		return linkTarget
+
+	# Copies a composer cache entry the target doesn't have, linking what's
+	# the same in the vendor dirs its live release uses
+	def _receiveCacheEntry(self, lockHash, sourceBuildDir, previousVendors, pool):
+		hashLock = self.composerCache.acquire(lockHash)
+		try:
+			if self.composerCache.exists(lockHash):
+				self.composerCache.hit(lockHash)
+				return
+			incoming = os.path.join(self.composerCache.cacheDir, '.incoming-%s-%s' % (lockHash, os.getpid()))
+			if os.path.lexists(incoming):
+				FileSystem.removeDir(incoming)
+			references = [self.composerCache.pathFor(name) for name in previousVendors if self.composerCache.exists(name)]
+			self._copyTree(os.path.join(sourceBuildDir, '_composercache', lockHash), incoming, references, pool)
+			self.composerCache.publish(lockHash, incoming)
+			self.stats['vendorEntries'].append(lockHash)
+		finally:
+			hashLock.release()
+
+	# Copies source to destination; files with the same size, mtime, mode and
+	# contents in one of the reference dirs (at the same path) are linked from
+	# there. Composer keeps the archives' mtimes, so size and mtime alone can
+	# match files that differ
+	def _copyTree(self, source, destination, references, pool):
+		os.makedirs(destination)
+		for dirPath, dirNames, fileNames in os.walk(source):
+			relDir = os.path.relpath(dirPath, source)
+			for name in dirNames + fileNames:
+				path 	= os.path.join(dirPath, name)
+				target 	= os.path.normpath(os.path.join(destination, relDir, name))
+				stats 	= os.lstat(path)
+				if stat.S_ISLNK(stats.st_mode):
+					os.symlink(os.readlink(path), target)
+				elif stat.S_ISDIR(stats.st_mode):
+					os.mkdir(target)
+				elif not self._linkSame(path, stats, [os.path.normpath(os.path.join(reference, relDir, name)) for reference in references], target):
+					self._copy(path, target, pool)
+
+	def _linkSame(self, path, stats, candidates, target):
+		digest = None
+		for candidate in candidates:
+			try:
+				known = os.lstat(candidate)
+				if stat.S_ISREG(known.st_mode) and known.st_size == stats.st_size and int(known.st_mtime) == int(stats.st_mtime) and known.st_mode == stats.st_mode:
+					if digest == None:
+						digest = Replicator.hashFile(path)
+					if Replicator.hashFile(candidate) != digest:
+						continue
+					os.link(candidate, target)
+					self.stats['filesLinked'] += 1
+					return True
+			except OSError:
+				pass
+		return False
+
+	@staticmethod
+	def _isUnder(relPath, paths):
+		for path in paths:
+			if path == '.' or relPath == path or relPath.startswith(os.path.join(path, '')):
+				return True
+		return False
+
+	# The composer cache entry an (absolute) link entry points at under buildDir
+	@staticmethod
+	def _cacheEntryOf(entry, buildDir):
+		if entry[0] != 'l' or not entry[1].startswith(os.path.join(buildDir, '_composercache', '')):
+			return None
+		return entry[1][len(os.path.join(buildDir, '_composercache', '')):].split('/')[0]
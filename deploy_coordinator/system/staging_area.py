@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, shutil, tempfile
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.system.tracer import traced
+
+# Where builds are put together before they're published into _application/.
+# By default that's <buildDir>/_staging/, on the filesystem of the releases
+# (and of the composer cache), so publishing a build, and moving a fresh
+# vendor dir into the cache, is a rename however big they are; in the tmp dir
+# (often tmpfs, or another disk) both were a copy of every file.
+#
+# That it's the same filesystem is checked (st_dev), not assumed. A stagingDir
+# elsewhere (or the tmp dir, if the staging dir can't be created) still works,
+# but publish() copies then; fallbackReason says why. Either way a release
+# appears in _application/ in a single rename.
+class StagingArea(object):
+
+	DEFAULT_DIR = '_staging'
+
+	def __init__(self, buildDir, stagingDir=None):
+		self.buildDir 		= os.path.join(buildDir, '')
+		self.appBundle 		= os.path.join(self.buildDir, '_application', '')
+		if stagingDir == None:
+			stagingDir = os.path.join(self.buildDir, self.DEFAULT_DIR)
+		self.stagingDir 	= os.path.join(stagingDir, '')
+		# Set by prepare()
+		self.sameFilesystem = None
+		self.fallbackReason = None
+
+	def pathFor(self, name):
+		return os.path.join(self.stagingDir, name, '')
+
+	# An empty workspace named name (anything an interrupted build left
+	# there is removed first)
+	def workspaceFor(self, name):
+		self.prepare()
+		path = self.pathFor(name)
+		if os.path.lexists(path):
+			FileSystem.removeDir(path)
+		os.makedirs(path)
+		return path
+
+	# Creates the dirs, and checks where they are
+	def prepare(self):
+		if self.sameFilesystem != None:
+			return
+		if not os.path.isdir(self.appBundle):
+			os.makedirs(self.appBundle)
+		notCreated = None
+		try:
+			if not os.path.isdir(self.stagingDir):
+				os.makedirs(self.stagingDir)
+		except OSError as e:
+			notCreated 		= 'unable to create %s (%s)' % (self.stagingDir, e.strerror)
+			self.stagingDir = os.path.join(tempfile.gettempdir(), 'deploy_coord', 'builds', '')
+			if not os.path.isdir(self.stagingDir):
+				os.makedirs(self.stagingDir)
+		self.sameFilesystem = os.stat(self.stagingDir).st_dev == os.stat(self.appBundle).st_dev
+		reasons = []
+		if notCreated != None:
+			reasons.append('%s; staging in %s' % (notCreated, self.stagingDir))
+		if self.sameFilesystem != True:
+			reasons.append('%s is on a different filesystem than %s' % (self.stagingDir, self.appBundle))
+		if len(reasons) > 0:
+			self.fallbackReason = '; '.join(reasons)
+
+	# List of (ok, message), one per filesystem a build of about requiredBytes
+	# and requiredInodes gets written to: ok if it fits and leaves at least
+	# minFreeBytes and minFreeInodes
+	def checkSpace(self, requiredBytes, requiredInodes, minFreeBytes=0, minFreeInodes=0):
+		self.prepare()
+		paths = [self.stagingDir]
+		if self.sameFilesystem != True:
+			paths.append(self.appBundle)
+		results = []
+		for path in paths:
+			stats 		= os.statvfs(path)
+			freeBytes 	= stats.f_bavail * stats.f_frsize
+			ok 			= freeBytes - requiredBytes >= minFreeBytes
+			message 	= '%s: %s free' % (path, FileSystem.formatBytes(freeBytes))
+			# No inode limit (eg. btrfs) when it reports none at all
+			if stats.f_files > 0:
+				ok 		 = ok and stats.f_favail - requiredInodes >= minFreeInodes
+				message += ', %s inodes' % stats.f_favail
+			message += ' (build needs about %s, %s inodes)' % (FileSystem.formatBytes(requiredBytes), requiredInodes)
+			results.append((ok, message))
+		return results
+
+	# Moves workspace to destination (a release dir in _application/) in one
+	# rename; off the filesystem, it's copied next to destination first and
+	# renamed into place from there. Returns 'rename' or 'copy'
+	@traced('fs')
+	def publish(self, workspace, destination):
+		self.prepare()
+		workspace 	= os.path.normpath(workspace)
+		destination = os.path.normpath(destination)
+		if self.sameFilesystem == True:
+			os.rename(workspace, destination)
+			return 'rename'
+		incoming = os.path.join(os.path.dirname(destination), '.incoming-%s-%s' % (os.path.basename(destination), os.getpid()))
+		if os.path.lexists(incoming):
+			FileSystem.removeDir(incoming)
+		try:
+			shutil.copytree(workspace, incoming, symlinks=True)
+			os.rename(incoming, destination)
+		except:
+			if os.path.lexists(incoming):
+				FileSystem.removeDir(incoming)
+			raise
+		FileSystem.removeDir(workspace)
+		return 'copy'
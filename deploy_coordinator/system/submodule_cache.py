@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, hashlib, shutil, tempfile
+from deploy_coordinator.system.execute import Git
+from deploy_coordinator.system.file_lock import FileLock
+from deploy_coordinator.system.file_system import FileSystem
+
+# Long-lived store of bare mirrors for submodule remotes, keyed by the
+# remote URL. Mirrors are only fetched when the commit we need isn't in
+# there already, and files are checked out straight from the mirror (no
+# work tree clone). Mirrors are shared between deploys (and projects), so
+# mutating a mirror takes an exclusive lock, and reading from it (including
+# looking for a commit) a shared one.
+class SubmoduleCache(object):
+
+	def __init__(self, cacheDir):
+		self.cacheDir = os.path.join(cacheDir, '')
+		if not os.path.exists(self.cacheDir):
+			os.makedirs(self.cacheDir)
+
+	def mirrorPathFor(self, url):
+		return os.path.join(self.cacheDir, hashlib.sha1(url).hexdigest() + '.git')
+
+	def lockFor(self, url, shared=False):
+		return FileLock(self.mirrorPathFor(url) + '.lock', shared)
+
+	def hasCommit(self, mirrorPath, shaCommitID):
+		proc = Git(['--git-dir=%s' % mirrorPath, 'cat-file', '-e', '%s^{commit}' % shaCommitID])
+		return proc.process.returncode == 0
+
+	# Make sure a mirror of url exists and contains shaCommitID; returns
+	# what had to be done to get there: 'cached', 'fetched' or 'cloned'.
+	# Looking only takes the shared lock, so deploys finding the commit in
+	# there already don't wait on each other; the exclusive one is taken to
+	# clone or fetch (after looking again, someone may have done it meanwhile)
+	def ensure(self, url, shaCommitID, processOptions={}):
+		mirrorPath = self.mirrorPathFor(url)
+		with self.lockFor(url, shared=True):
+			if FileSystem.exists(mirrorPath) and self.hasCommit(mirrorPath, shaCommitID):
+				return 'cached'
+		with self.lockFor(url):
+			if not FileSystem.exists(mirrorPath):
+				# Clone under a temp name and rename once complete, so an
+				# interrupted clone never looks like a usable mirror
+				partialPath = '%s.partial-%s' % (mirrorPath, os.getpid())
+				if FileSystem.exists(partialPath):
+					FileSystem.removeDir(partialPath)
+				cloneProc = Git(['clone', '--mirror', url, partialPath], processOptions)
+				if cloneProc.process.returncode != 0:
+					if FileSystem.exists(partialPath):
+						FileSystem.removeDir(partialPath)
+					raise Exception('Unable to mirror %s' % url)
+				os.rename(partialPath, mirrorPath)
+				action = 'cloned'
+			elif self.hasCommit(mirrorPath, shaCommitID):
+				return 'cached'
+			else:
+				fetchProc = Git(['--git-dir=%s' % mirrorPath, 'fetch', '--prune', 'origin'], processOptions)
+				if fetchProc.process.returncode != 0:
+					raise Exception('Unable to fetch %s into mirror' % url)
+				action = 'fetched'
+
+			if not self.hasCommit(mirrorPath, shaCommitID):
+				raise Exception('Commit %s does not exist in %s' % (shaCommitID, url))
+		return action
+
+	# Write the tree at shaCommitID into destination. Uses a private index
+	# file so concurrent checkouts from the same mirror don't trip over each other.
+	# With an ExportFilter, only what it lets through gets written (prefix is
+	# the submodule's path in the project); returns how many files it left out
+	def checkout(self, url, shaCommitID, destination, processOptions={}, exportFilter=None, prefix=''):
+		mirrorPath  = self.mirrorPathFor(url)
+		destination = os.path.join(destination, '')
+		indexDir	= tempfile.mkdtemp(prefix='deploy_coord_index')
+		gitOptions	= dict(processOptions)
+		gitOptions['env'] = {'GIT_INDEX_FILE': os.path.join(indexDir, 'index')}
+		try:
+			with self.lockFor(url, shared=True):
+				readProc = Git(['--git-dir=%s' % mirrorPath, 'read-tree', shaCommitID], gitOptions)
+				if readProc.process.returncode != 0:
+					raise Exception('Unable to read tree @ %s' % shaCommitID)
+				args = [
+					'--git-dir=%s' % mirrorPath,
+					'--work-tree=%s' % destination,
+					'checkout-index',
+					'-f',
+					'--prefix=%s' % destination
+				]
+				excluded = 0
+				if exportFilter is None:
+					args.append('-a')
+				else:
+					paths, excluded = self.exportedPaths(mirrorPath, gitOptions, exportFilter, prefix)
+					args += ['-z', '--stdin']
+					gitOptions['input'] = ''.join([path + '\0' for path in paths])
+				checkoutProc = Git(args, gitOptions)
+				if checkoutProc.process.returncode != 0:
+					raise Exception('Unable to checkout index...')
+		finally:
+			shutil.rmtree(indexDir, True)
+		return excluded
+
+	# Paths in the (read-tree'd) index the filter lets through, and how many it didn't
+	def exportedPaths(self, mirrorPath, gitOptions, exportFilter, prefix):
+		listOptions = {'env': gitOptions['env']}
+		if gitOptions.get('cancelEvent') is not None:
+			listOptions['cancelEvent'] = gitOptions['cancelEvent']
+		listProc = Git(['--git-dir=%s' % mirrorPath, 'ls-files', '-s', '-z'], listOptions)
+		if listProc.process.returncode != 0:
+			raise Exception('Unable to list index...')
+		paths, excluded = [], 0
+		for record in listProc.response.split('\0'):
+			if record == '':
+				continue
+			meta, path = record.split('\t', 1)
+			fullPath = '%s/%s' % (prefix.strip('/'), path) if prefix.strip('/') != '' else path
+			if meta.split()[0] == '160000':
+				exported = exportFilter.anyExportedUnder(fullPath)
+			else:
+				exported = exportFilter.exported(fullPath)
+			if exported:
+				paths.append(path)
+			else:
+				excluded += 1
+		return (paths, excluded)
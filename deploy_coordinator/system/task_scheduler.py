@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, time, threading, multiprocessing
+from deploy_coordinator.cli import Formatter, Output
+from deploy_coordinator.system.execute import Execute
+from deploy_coordinator.system.file_system import FileSystem
+from deploy_coordinator.system.worker_pool import WorkerPool
+from deploy_coordinator.system.tracer import Tracer
+
+# One node of the build graph. run is a callable taking the task, which
+# raises on failure; fromSpec() builds one that runs a shell command.
+class BuildTask(object):
+
+	def __init__(self, name, run, dependsOn=[], inputs=[], workingDir=None, command=None, outputs=[], envNames=[]):
+		self.name 		= name
+		self.run 		= run
+		self.dependsOn 	= list(dependsOn)
+		self.inputs 	= list(inputs)
+		self.workingDir = workingDir
+		self.command 	= command
+		self.outputs 	= list(outputs)
+		self.envNames 	= list(envNames)
+		# With an artifact cache (see useCache): None, 'hit' or 'stored'
+		self.cacheStatus = None
+		# For a task that isn't cached itself, what its result depends on (eg.
+		# composer: the lock file), so tasks depending on it can be; without
+		# one, they can't
+		self.resultKey 	= None
+		# pending | queued | running | done | failed | skipped
+		self.status 	= 'pending'
+		self.error 		= None
+		self.startedAt 	= None
+		self.endedAt 	= None
+
+	def duration(self):
+		if self.startedAt is None or self.endedAt is None:
+			return 0.0
+		return self.endedAt - self.startedAt
+
+	# From a buildfile "tasks" entry, eg:
+	#	"assets": {"command": "npm run build", "workingDir": "web/theme",
+	#		"inputs": ["web/theme/src/**"], "dependsOn": ["composer"],
+	#		"outputs": ["web/theme/dist"], "env": ["NODE_ENV"]}
+	# The command runs through /bin/sh (or as-is if given as a list) in
+	# workingDir, relative to buildDir, with DEPLOY_* variables in its env,
+	# and is killed if it runs longer than timeout seconds (if given).
+	# outputs (relative to buildDir) and env (names of the variables its
+	# result depends on) are for the artifact cache
+	@classmethod
+	def fromSpec(cls, name, spec, buildDir, env={}):
+		if not isinstance(spec, dict) or spec.get('command') == None:
+			raise Exception('Task "%s" must define a command' % name)
+		dependsOn = spec.get('dependsOn', [])
+		inputs 	  = spec.get('inputs', [])
+		outputs   = spec.get('outputs', [])
+		envNames  = spec.get('env', [])
+		if not isinstance(dependsOn, list) or not isinstance(inputs, list) or not isinstance(outputs, list) or not isinstance(envNames, list):
+			raise Exception('Task "%s": dependsOn, inputs, outputs and env must be arrays' % name)
+		workingDir = os.path.abspath(os.path.join(buildDir, spec.get('workingDir', '')))
+		if not workingDir.startswith(os.path.abspath(buildDir)):
+			raise Exception('Task "%s": workingDir must be inside the project' % name)
+		for output in outputs:
+			if os.path.isabs(output) or os.path.normpath(output).split(os.sep)[0] in ['..', '.']:
+				raise Exception('Task "%s": outputs must be paths inside the project' % name)
+		command = spec['command']
+
+		def runCommand(task):
+			if not os.path.isdir(task.workingDir):
+				raise Exception('workingDir does not exist: %s' % spec.get('workingDir', ''))
+			args = command
+			if not isinstance(command, list):
+				args = ['/bin/sh', '-c', command]
+			# Streamed, so each line carries the command's ID (see Output.beginCommand)
+			def cbLine(line):
+				Output.line(Formatter(line.rstrip()).indent())
+			proc = Execute(args, {
+				'cwd': task.workingDir, 'env': env, 'timeout': spec.get('timeout'),
+				'streamResponse': True, 'receiveStdOut': cbLine, 'receiveStdErr': cbLine
+			})
+			if proc.timedOut:
+				raise Exception('timed out after %ss' % spec.get('timeout'))
+			if proc.process.returncode != 0:
+				raise Exception('exited with status %s' % proc.process.returncode)
+
+		return cls(name, runCommand, dependsOn, inputs, workingDir, command, [os.path.normpath(output) for output in outputs], envNames)
+
+	# Goes through cache (an ArtifactCache) from now on: the outputs are
+	# restored from it if key is there, else stored into it after running.
+	# The key's lock is held meanwhile, so a concurrent build of the same
+	# key waits for this one. Failing to store only gets a warning
+	def useCache(self, cache, key, rootDir):
+		run = self.run
+		def runCached(task):
+			def cbWaiting():
+				Output.line(Formatter('Waiting for another deploy running the same task...').color('yellow').indent())
+			keyLock = cache.acquire(key, cbWaiting)
+			try:
+				if cache.exists(key):
+					restored = cache.restore(key, rootDir)
+					task.cacheStatus = 'hit'
+					Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' Restored %s file(s) from the artifact cache (%s)' % (restored, key[0:12])).indent())
+					return
+				run(task)
+				try:
+					size = cache.store(key, rootDir, task.outputs)
+					task.cacheStatus = 'stored'
+					Output.line(Formatter('Outputs stored in the artifact cache (%s, %s)' % (key[0:12], FileSystem.formatBytes(size))).indent())
+				except (Exception, IOError, OSError) as e:
+					Output.line(Formatter('Outputs not cached: %s' % e).color('yellow').indent())
+			finally:
+				keyLock.release()
+		self.run = runCached
+
+
+# Runs a graph of BuildTasks: everything whose dependencies are done runs
+# at the same time, up to maxWorkers (defaults to the number of CPUs). A
+# failing task only takes down the tasks depending on it (skipped); the rest
+# carry on. Each task's output is written as one block when it finishes.
+class TaskScheduler(object):
+
+	def __init__(self, maxWorkers=None):
+		if maxWorkers == None:
+			maxWorkers = multiprocessing.cpu_count()
+		self.maxWorkers = maxWorkers
+		self.tasks 		= []
+		self._lock 		= threading.Lock()
+		self._pool 		= None
+
+	def add(self, task):
+		if self.get(task.name) is not None:
+			raise Exception('Duplicate task name "%s"' % task.name)
+		self.tasks.append(task)
+		return task
+
+	def get(self, name):
+		for task in self.tasks:
+			if task.name == name:
+				return task
+		return None
+
+	# Unknown dependencies and cycles, all reported at once
+	def validate(self):
+		errors = []
+		for task in self.tasks:
+			for dependency in task.dependsOn:
+				if self.get(dependency) is None:
+					errors.append('Task "%s" depends on unknown task "%s"' % (task.name, dependency))
+		if len(errors) == 0:
+			visiting, visited = set(), set()
+			def visit(task, trail):
+				if task.name in visited:
+					return
+				if task.name in visiting:
+					errors.append('Task dependency cycle: %s' % ' -> '.join(trail + [task.name]))
+					return
+				visiting.add(task.name)
+				for dependency in task.dependsOn:
+					visit(self.get(dependency), trail + [task.name])
+				visiting.discard(task.name)
+				visited.add(task.name)
+			for task in self.tasks:
+				visit(task, [])
+		if len(errors) > 0:
+			raise Exception('; '.join(errors))
+
+	# Tasks declaring inputs and outputs go through cache (see
+	# ArtifactCache.keyFor, and BuildTask.useCache); a task's key includes
+	# those of the tasks it depends on, so one depending on a task whose
+	# result has no key (not cached, and no resultKey) isn't cached either.
+	# Returns {name: key} of the cached tasks
+	def useCache(self, cache, rootDir, treeEntries):
+		self.validate()
+		keys, resultKeys = {}, {}
+		def resultKeyOf(task):
+			if task.name not in resultKeys:
+				resultKeys[task.name] = task.resultKey
+				dependencyKeys = [[dependency, resultKeyOf(self.get(dependency))] for dependency in task.dependsOn]
+				if task.resultKey == None and None not in [key for dependency, key in dependencyKeys]:
+					keys[task.name] = cache.keyFor(task, rootDir, treeEntries, dependencyKeys)
+					resultKeys[task.name] = keys[task.name]
+			return resultKeys[task.name]
+		for task in self.tasks:
+			resultKeyOf(task)
+			if keys.get(task.name) != None:
+				task.useCache(cache, keys[task.name], rootDir)
+		return dict([(name, key) for name, key in keys.items() if key != None])
+
+	# Returns the tasks that failed (skipped ones not included)
+	def run(self):
+		self.validate()
+		self._pool = WorkerPool(self.maxWorkers, failFast=False)
+		with self._lock:
+			for task in self.tasks:
+				if len(task.dependsOn) == 0:
+					self._queue(task)
+		self._pool.join()
+		return [task for task in self.tasks if task.status == 'failed']
+
+	def _queue(self, task):
+		task.status = 'queued'
+		self._pool.submit(self._execute, task)
+
+	def _execute(self, task):
+		Tracer.phase('task %s' % task.name)
+		Output.beginGroup()
+		try:
+			Output.multiLine([
+				'',
+				Formatter('Task: %s' % task.name).color('cyan').style(['bold']).indent()
+			])
+			task.status 	= 'running'
+			task.startedAt 	= time.time()
+			try:
+				task.run(task)
+				task.status = 'done'
+			except BaseException as e:
+				task.status = 'failed'
+				task.error 	= e
+				if not isinstance(e, SystemExit):
+					Output.line(Formatter('Task %s failed: %s' % (task.name, e)).color('red').indent())
+			task.endedAt = time.time()
+			if task.status == 'done':
+				Output.line(Formatter(Formatter(Output.CHECKMARK).color('green') + ' %s done (%.2fs)' % (task.name, task.duration())).indent())
+		finally:
+			Output.endGroup()
+
+		with self._lock:
+			self._release(task)
+
+	# Queue whatever just became runnable; skip whatever can't run anymore
+	def _release(self, finished):
+		for task in self.tasks:
+			if task.status != 'pending' or finished.name not in task.dependsOn:
+				continue
+			if finished.status != 'done':
+				task.status = 'skipped'
+				Output.line(Formatter('Task %s skipped (%s did not complete)' % (task.name, finished.name)).color('yellow').indent())
+				self._release(task)
+			elif all([self.get(dependency).status == 'done' for dependency in task.dependsOn]):
+				self._queue(task)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, time, json, thread, threading, functools, cProfile, pstats
+
+# One timed section of work. category is 'phase' (pipeline steps, tasks,
+# submodules...), 'job' (a WorkerPool job), 'exec' (a subprocess) or 'fs'
+# (a FileSystem operation)
+class Span(object):
+
+	def __init__(self, name, category, parent, args):
+		self.name 		= name
+		self.category 	= category
+		self.parent 	= parent
+		self.args 		= args
+		self.isPhase 	= False
+		self.threadID 	= thread.get_ident()
+		self.threadName = threading.current_thread().name
+		self.startedAt 	= time.time()
+		self.endedAt 	= None
+
+	def duration(self):
+		if self.endedAt is None:
+			return time.time() - self.startedAt
+		return self.endedAt - self.startedAt
+
+
+class _SpanContext(object):
+
+	def __init__(self, tracer, name, category, parent, args):
+		self.tracer = tracer
+		self.span 	= Span(name, category, parent, args)
+
+	def __enter__(self):
+		self.tracer._push(self.span)
+		return self.span
+
+	def __exit__(self, excType, excValue, excTraceback):
+		self.tracer._pop(self.span)
+		return False
+
+
+class _NoSpan(object):
+
+	def __enter__(self):
+		return None
+
+	def __exit__(self, excType, excValue, excTraceback):
+		return False
+
+
+# Records nested spans (per thread; a WorkerPool job's spans nest under the
+# span that submitted it) while a tracer is active. Everything goes through
+# the class methods, which do nothing when no tracer is active, eg:
+#	with Tracer.span('composer install', 'exec'):
+#		...
+#	Tracer.phase('move')	# ends the current phase (if any), starts "move"
+# At the end: summary() lines, or writeChromeTrace() for chrome://tracing
+# (or https://ui.perfetto.dev)
+class Tracer(object):
+
+	active 	= None
+	_local 	= threading.local()
+	_noSpan = _NoSpan()
+
+	def __init__(self):
+		self.spans 		= []
+		self.startedAt 	= time.time()
+		self._lock 		= threading.Lock()
+
+	@classmethod
+	def start(cls):
+		cls.active = cls()
+		return cls.active
+
+	def stop(self):
+		if Tracer.active is self:
+			Tracer.active = None
+
+	@classmethod
+	def span(cls, name, category='phase', parent=None, **args):
+		if cls.active is None:
+			return cls._noSpan
+		return _SpanContext(cls.active, name, category, parent, args)
+
+	# Sequential steps without nesting blocks: ends the phase this thread
+	# has open at the current level (if any), then opens the next one. Open
+	# phases end with the span they're in. Meant for the top level steps of a
+	# runner or job; code called from inside a phase uses span() instead
+	@classmethod
+	def phase(cls, name, **args):
+		tracer = cls.active
+		if tracer is None:
+			return
+		stack = cls._stack()
+		if len(stack) > 0 and stack[-1].isPhase:
+			tracer._pop(stack[-1])
+		span = Span(name, 'phase', None, args)
+		span.isPhase = True
+		tracer._push(span)
+
+	@classmethod
+	def currentSpan(cls):
+		stack = cls._stack()
+		if len(stack) > 0:
+			return stack[-1]
+		return None
+
+	# Name of the phase this thread is in (through the spans it's nested in,
+	# so a job's phase is the one it was submitted from); None if none
+	@classmethod
+	def currentPhase(cls):
+		span = cls.currentSpan()
+		while span is not None and span.category != 'phase':
+			span = span.parent
+		if span is None:
+			return None
+		return span.name
+
+	@classmethod
+	def _stack(cls):
+		if getattr(cls._local, 'stack', None) is None:
+			cls._local.stack = []
+		return cls._local.stack
+
+	def _push(self, span):
+		stack = self._stack()
+		if span.parent is None and len(stack) > 0:
+			span.parent = stack[-1]
+		stack.append(span)
+		with self._lock:
+			self.spans.append(span)
+
+	def _pop(self, span):
+		stack = self._stack()
+		if span not in stack:
+			return
+		# Phases still open inside it end with it
+		while len(stack) > 0:
+			top = stack.pop()
+			top.endedAt = time.time()
+			if top is span:
+				break
+
+	def chromeTrace(self):
+		events, threads = [], {}
+		with self._lock:
+			spans = list(self.spans)
+		for span in spans:
+			threads[span.threadID] = span.threadName
+			events.append({
+				'name': span.name, 'cat': span.category, 'ph': 'X',
+				'ts': (span.startedAt - self.startedAt) * 1000000,
+				'dur': span.duration() * 1000000,
+				'pid': os.getpid(), 'tid': span.threadID,
+				'args': dict([(key, str(value)) for key, value in span.args.items()])
+			})
+		for threadID, threadName in threads.items():
+			events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': threadID, 'args': {'name': threadName}})
+		return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+	def writeChromeTrace(self, path):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		fileHandle = open(path, 'w')
+		json.dump(self.chromeTrace(), fileHandle)
+		fileHandle.close()
+
+	# The phases as a tree of {'name', 'seconds', 'count', 'exec': [count,
+	# seconds], 'fs': [count, seconds], 'children'}, where exec/fs are the
+	# subprocesses and filesystem operations run directly in the phase. Phases
+	# of the same name at the same place are added up. Jobs are left out
+	# (their phases show under the phase that started them)
+	def phaseTree(self):
+		with self._lock:
+			spans = list(self.spans)
+
+		# Nearest enclosing phase of each span
+		def phaseOf(span):
+			parent = span.parent
+			while parent is not None and parent.category != 'phase':
+				parent = parent.parent
+			return parent
+
+		nodes, roots = {}, []
+		def nodeFor(span):
+			parent = phaseOf(span)
+			key 	= (id(nodeFor(parent)) if parent is not None else None, span.name)
+			if key not in nodes:
+				nodes[key] = {'name': span.name, 'seconds': 0.0, 'count': 0, 'exec': [0, 0.0], 'fs': [0, 0.0], 'children': []}
+				if parent is None:
+					roots.append(nodes[key])
+				else:
+					nodeFor(parent)['children'].append(nodes[key])
+			return nodes[key]
+
+		for span in spans:
+			if span.category == 'phase':
+				node = nodeFor(span)
+				node['seconds'] += span.duration()
+				node['count'] 	+= 1
+			elif span.category in ['exec', 'fs'] and phaseOf(span) is not None:
+				totals = nodeFor(phaseOf(span))[span.category]
+				totals[0] += 1
+				totals[1] += span.duration()
+		return roots
+
+	# Lines of "name  seconds  (subprocesses, filesystem ops)" for the
+	# phases (see phaseTree), nested up to maxDepth
+	def summary(self, maxDepth=3):
+		lines = []
+		def render(node, depth):
+			details = []
+			if node['exec'][0] > 0:
+				details.append('%s processes %.2fs' % tuple(node['exec']))
+			if node['fs'][0] > 0:
+				details.append('%s fs ops %.2fs' % tuple(node['fs']))
+			name = '  ' * depth + node['name']
+			if node['count'] > 1:
+				name += ' (x%s)' % node['count']
+			line = '%-40s %8.2fs' % (name, node['seconds'])
+			if len(details) > 0:
+				line += '   ' + ', '.join(details)
+			lines.append(line)
+			if depth + 1 < maxDepth:
+				for child in node['children']:
+					render(child, depth + 1)
+		for root in self.phaseTree():
+			render(root, 0)
+		return lines
+
+
+# Wraps a function in a span named after it (first argument recorded as
+# the path); nearly free when no tracer is active
+def traced(category):
+	def decorate(fn):
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			if Tracer.active is None:
+				return fn(*args, **kwargs)
+			spanArgs = {}
+			for arg in args:
+				if isinstance(arg, basestring):
+					spanArgs['path'] = arg
+					break
+			with Tracer.span(fn.__name__, category, **spanArgs):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorate
+
+
+# cProfile of the thread that started it plus every WorkerPool job (cProfile
+# only sees the thread it's enabled in), merged into one .pstats file for
+# pstats / snakeviz. Everything goes through the class methods, like Tracer
+class Profiler(object):
+
+	active = None
+
+	def __init__(self):
+		self.profile = cProfile.Profile()
+		self.stats 	 = None
+		self._lock 	 = threading.Lock()
+
+	@classmethod
+	def start(cls):
+		cls.active = cls()
+		cls.active.profile.enable()
+		return cls.active
+
+	# Runs fn(*args) under its own profile, merged in once done
+	@classmethod
+	def run(cls, fn, *args):
+		profiler = cls.active
+		if profiler is None:
+			return fn(*args)
+		profile = cProfile.Profile()
+		profile.enable()
+		try:
+			return fn(*args)
+		finally:
+			profile.disable()
+			profiler._add(profile)
+
+	def stop(self, path):
+		self.profile.disable()
+		if Profiler.active is self:
+			Profiler.active = None
+		self._add(self.profile)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.stats.dump_stats(path)
+
+	def _add(self, profile):
+		with self._lock:
+			if self.stats is None:
+				self.stats = pstats.Stats(profile)
+			else:
+				self.stats.add(profile)
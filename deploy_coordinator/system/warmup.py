@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os, re, time
+from deploy_coordinator.system.activation import HealthProbe
+from deploy_coordinator.system.worker_pool import WorkerPool
+
+# Warms a release up before it goes live, within timeout seconds overall:
+#
+# - writes an opcache preload script into it (preloadName, at the release
+#   root), compiling every file of composer's classmap and every .php file
+#   of the release's own (vendor aside, that's what the classmap is for).
+#   With opcache.preload pointing at it through ln-release, the web server
+#   compiles them when it (re)starts, instead of the first requests doing it
+# - requests urls, concurrency at a time (host sets the Host header), eg.
+#   through a vhost serving ln-warmup (pointed at the release before this
+#   runs), so application caches built on the first requests (and opcache,
+#   where the reload doesn't reset it) are filled before real traffic comes
+#
+# Neither fails the deploy; what went wrong is counted in .report. Both
+# count against timeout: a preload list still being put together by then is
+# written as far as it got (report['preload'] 'partial', or 'skipped' if
+# there was no time left for it at all), and URLs not requested by then are
+# left out (counted as skipped).
+class Warmup(object):
+
+	PRELOAD_NAME = '.opcache-preload.php'
+	# Entries of vendor/composer/autoload_classmap.php: $vendorDir . '/path'
+	CLASSMAP_ENTRY = re.compile(r"\$(vendorDir|baseDir)\s*\.\s*'([^']+)'")
+
+	def __init__(self, releaseDir, composerWorkingDir=None, preloadName=PRELOAD_NAME, urls=[], host=None, concurrency=4, timeout=30, requestTimeout=10):
+		self.releaseDir 		= os.path.join(releaseDir, '')
+		self.composerWorkingDir = composerWorkingDir
+		self.preloadName 		= preloadName
+		self.urls 				= list(urls)
+		self.host 				= host
+		self.concurrency 		= concurrency
+		self.timeout 			= timeout
+		self.requestTimeout 	= requestTimeout
+		self.report 			= {
+			'preload': None, 'preloadFiles': None, 'classmapFiles': 0, 'preloadMs': 0.0,
+			'requests': 0, 'errors': [], 'skipped': 0, 'requestMs': [], 'seconds': 0.0
+		}
+
+	def run(self):
+		startedAt = time.time()
+		deadline  = startedAt + self.timeout
+		if self.preloadName != None:
+			self.writePreload(deadline)
+		if len(self.urls) > 0:
+			self.requestUrls(deadline)
+		self.report['seconds'] = time.time() - startedAt
+		return self.report
+
+	# Paths (relative to the release) of the files the preload script
+	# compiles: (classmap files, the release's own .php files, complete);
+	# when deadline passes, what was found so far (complete False)
+	def preloadFiles(self, deadline=None):
+		classmapFiles, seen = [], set()
+		for index, path in enumerate(self.classmapFiles()):
+			if deadline != None and index % 100 == 0 and time.time() >= deadline:
+				return (classmapFiles, [], False)
+			if path not in seen and os.path.isfile(os.path.join(self.releaseDir, path)):
+				classmapFiles.append(path)
+				seen.add(path)
+		projectFiles = []
+		vendorDir = self.vendorDir()
+		# Symlinks (the vendor dir from the composer cache, storage dirs) aren't followed
+		for dirPath, dirNames, fileNames in os.walk(self.releaseDir):
+			if deadline != None and time.time() >= deadline:
+				return (classmapFiles, projectFiles, False)
+			dirNames[:] = sorted([name for name in dirNames if os.path.relpath(os.path.join(dirPath, name), self.releaseDir) != vendorDir])
+			for name in sorted(fileNames):
+				path = os.path.relpath(os.path.join(dirPath, name), self.releaseDir)
+				if name.lower().endswith('.php') and path != self.preloadName and path not in seen:
+					projectFiles.append(path)
+		return (classmapFiles, projectFiles, True)
+
+	# The vendor dir, relative to the release (None without composer)
+	def vendorDir(self):
+		if self.composerWorkingDir == None:
+			return None
+		return os.path.normpath(os.path.join(self.composerWorkingDir, 'vendor'))
+
+	# Files of composer's classmap (relative to the release), in its order
+	def classmapFiles(self):
+		vendorDir = self.vendorDir()
+		if vendorDir == None:
+			return []
+		try:
+			fileHandle = open(os.path.join(self.releaseDir, vendorDir, 'composer', 'autoload_classmap.php'))
+			try:
+				contents = fileHandle.read()
+			finally:
+				fileHandle.close()
+		except IOError:
+			return []
+		files = []
+		for base, path in self.CLASSMAP_ENTRY.findall(contents):
+			path = os.path.normpath(os.path.join({'vendorDir': vendorDir, 'baseDir': self.composerWorkingDir}[base], path.lstrip('/')))
+			if not path.startswith('..'):
+				files.append(path)
+		return files
+
+	# Writes the preload script, with the files found before deadline
+	def writePreload(self, deadline=None):
+		startedAt = time.time()
+		if deadline != None and startedAt >= deadline:
+			self.report['preload'] = 'skipped'
+			return
+		classmapFiles, projectFiles, complete = self.preloadFiles(deadline)
+		lines = [
+			'<?php',
+			'// Written by the deploy (see opcache.preload); compiles the files of this',
+			'// release that are listed below into opcache, without running them',
+			'$files = array('
+		] + ["\t'%s'," % path.replace('\\', '\\\\').replace("'", "\\'") for path in classmapFiles + projectFiles] + [
+			');',
+			'foreach ($files as $file) {',
+			'\tif (is_file(__DIR__ . \'/\' . $file)) {',
+			'\t\ttry {',
+			'\t\t\topcache_compile_file(__DIR__ . \'/\' . $file);',
+			'\t\t} catch (\\Throwable $e) {',
+			'\t\t}',
+			'\t}',
+			'}',
+			''
+		]
+		tmpPath = os.path.join(self.releaseDir, '%s.tmp-%s' % (self.preloadName, os.getpid()))
+		fileHandle = open(tmpPath, 'w')
+		fileHandle.write('\n'.join(lines))
+		fileHandle.close()
+		os.rename(tmpPath, os.path.join(self.releaseDir, self.preloadName))
+		self.report['preload'] 			= {True: 'complete', False: 'partial'}[complete]
+		self.report['preloadFiles'] 	= len(classmapFiles) + len(projectFiles)
+		self.report['classmapFiles'] 	= len(classmapFiles)
+		self.report['preloadMs'] 		= (time.time() - startedAt) * 1000
+
+	# Requests every URL once, until deadline
+	def requestUrls(self, deadline):
+		pool = WorkerPool(self.concurrency, failFast=False)
+		for url in self.urls:
+			pool.submit(self._request, url, deadline)
+		for job in pool.join():
+			if job.status != 'done':
+				self.report['errors'].append((job.args[0], str(job.error)))
+			elif job.result == None:
+				self.report['skipped'] += 1
+			else:
+				ok, detail, ms = job.result
+				self.report['requests'] += 1
+				self.report['requestMs'].append(ms)
+				if not ok:
+					self.report['errors'].append((job.args[0], detail))
+
+	def _request(self, url, deadline):
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return None
+		return HealthProbe(url, self.host, min(self.requestTimeout, remaining)).check()
+
+	# Median and slowest request, in milliseconds (None without requests)
+	def requestTimes(self):
+		times = sorted(self.report['requestMs'])
+		if len(times) == 0:
+			return None
+		return (times[len(times) // 2], times[-1])
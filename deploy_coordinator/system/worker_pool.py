@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys, time, threading, traceback, Queue
+from deploy_coordinator.cli import Output
+from deploy_coordinator.system.tracer import Tracer, Profiler
+
+# Raised by a job (via pool.checkCancelled()) to bail out early
+# once the pool has been cancelled
+class CancelledError(Exception):
+	pass
+
+
+class Job(object):
+
+	def __init__(self, fn, args):
+		self.fn 		= fn
+		self.args 		= args
+		# Output group of whoever submitted the job; the job's output goes there
+		self.outputGroup = Output.currentGroup()
+		# ...and its spans nest under the submitter's when tracing
+		self.traceParent = Tracer.currentSpan()
+		# pending | running | done | failed | cancelled
+		self.status 	= 'pending'
+		self.result 	= None
+		self.error 		= None
+		self.traceback 	= None
+		self.startedAt 	= None
+		self.endedAt 	= None
+
+	def duration(self):
+		if self.startedAt is None or self.endedAt is None:
+			return 0.0
+		return self.endedAt - self.startedAt
+
+
+# Bounded pool of worker threads. Jobs can be submitted at any time
+# (including from inside other jobs); join() waits for all of them.
+# With failFast, the first failing job cancels the pool: jobs that haven't
+# started yet are skipped, and running ones see it via checkCancelled() (or
+# get their commands killed, if they pass cancelEvent to Execute).
+# Note a job raising SystemExit (eg. abortBuild()) counts as a failure.
+# Jobs submitted from inside an Output group write into that group.
+class WorkerPool(object):
+
+	def __init__(self, maxWorkers, failFast=True):
+		self.maxWorkers = max(1, int(maxWorkers))
+		self.failFast 	= failFast
+		self.jobs 		= []
+		self._queue 	= Queue.Queue()
+		# Set once cancelled; can be handed to Execute (cancelEvent) so running
+		# commands get killed as well
+		self.cancelEvent = threading.Event()
+		self._lock 		= threading.Lock()
+		self._threads 	= []
+
+	def submit(self, fn, *args):
+		job = Job(fn, args)
+		with self._lock:
+			self.jobs.append(job)
+			if len(self._threads) < self.maxWorkers:
+				thread = threading.Thread(target=self._work, name='WorkerPool-%s-%s' % (id(self), len(self._threads) + 1))
+				thread.daemon = True
+				self._threads.append(thread)
+				thread.start()
+		self._queue.put(job)
+		return job
+
+	def cancel(self):
+		self.cancelEvent.set()
+
+	def isCancelled(self):
+		return self.cancelEvent.is_set()
+
+	def checkCancelled(self):
+		if self.isCancelled():
+			raise CancelledError('Cancelled')
+
+	# Blocks until every submitted job has finished (or been skipped), then
+	# stops the worker threads; returns all jobs in submission order
+	def join(self):
+		self._queue.join()
+		with self._lock:
+			threads = list(self._threads)
+			self._threads = []
+		for thread in threads:
+			self._queue.put(None)
+		for thread in threads:
+			thread.join()
+		return self.jobs
+
+	def failures(self):
+		return [job for job in self.jobs if job.status == 'failed']
+
+	def _work(self):
+		while True:
+			job = self._queue.get()
+			try:
+				if job is None:
+					return
+				self._runJob(job)
+			finally:
+				self._queue.task_done()
+
+	def _runJob(self, job):
+		if self.isCancelled():
+			job.status = 'cancelled'
+			return
+		job.status 	  = 'running'
+		job.startedAt = time.time()
+		if job.outputGroup is not None:
+			Output.beginGroup(job.outputGroup)
+		try:
+			with Tracer.span(getattr(job.fn, '__name__', 'job'), 'job', job.traceParent):
+				job.result = Profiler.run(job.fn, *job.args)
+			job.status = 'done'
+		except CancelledError:
+			job.status = 'cancelled'
+		except BaseException as e:
+			job.status 	  = 'failed'
+			job.error 	  = e
+			job.traceback = traceback.format_exc()
+			if self.failFast == True:
+				self.cancel()
+		finally:
+			job.endedAt = time.time()
+			if job.outputGroup is not None:
+				Output.endGroup()